@@ -13,17 +13,30 @@
 # limitations under the License.
 """Database for a library."""
 
+import base64
 import collections
+import contextlib
+import dataclasses
 import enum
 import itertools
-from typing import Generator, Iterable, Optional
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Collection, Dict, FrozenSet, Generator, Iterable, List, Mapping, Optional, Sequence, Set, Tuple, Type, TypeVar, Union
 
 import frozendict
 
+from pepper_music_player.library import query as query_lib
 from pepper_music_player.library import scan
+from pepper_music_player.metadata import collation
 from pepper_music_player.metadata import entity
 from pepper_music_player.metadata import tag
 from pepper_music_player.metadata import token
+from pepper_music_player import pubsub
 from pepper_music_player import sqlite3_db
 
 
@@ -37,36 +50,236 @@ class _EntityType(enum.Enum):
     ALBUM = 'album'
 
 
+class _ChangeType(enum.Enum):
+    """What happened to an entity in a transaction, see EntityChange below."""
+    ADDED = 'added'
+    REMOVED = 'removed'
+    MODIFIED = 'modified'
+
+
 _TYPE_NAME_TO_TOKEN_TYPE = frozendict.frozendict({
     _EntityType.TRACK.value: token.Track,
     _EntityType.MEDIUM.value: token.Medium,
     _EntityType.ALBUM.value: token.Album,
 })
+_TOKEN_TYPE_TO_TYPE_NAME = frozendict.frozendict({
+    token_type: type_name
+    for type_name, token_type in _TYPE_NAME_TO_TOKEN_TYPE.items()
+})
+
+# Pseudo-tags that are specific to each file, so counting their values for
+# facets would only waste space.
+_UNFACETED_TAGS = frozenset((
+    tag.BASENAME.name,
+    tag.DIRNAME.name,
+    tag.DURATION_HUMAN.name,
+    tag.DURATION_SECONDS.name,
+    tag.FILENAME.name,
+))
+
+# Tags with counts for every pair of their values, so that facets of these tags
+# filtered by another of these tags don't need to read the Tag table.
+_FACET_FILTER_TAGS = frozenset((
+    tag.ALBUMARTIST.name,
+    tag.ARTIST.name,
+    tag.GENRE.name,
+    tag.MEDIA.name,
+    tag.PARSED_YEAR.name,
+))
+
+
+def _sql_list(values: Iterable[str]) -> str:
+    """Returns a SQL list of string literals, for values known in advance."""
+    return '(' + ', '.join(
+        "'" + value.replace("'", "''") + "'" for value in sorted(values)) + ')'
+
+
+def _facet_pairs_sql(row: str, *, row_deleted: bool) -> str:
+    """Returns a query for the FacetPairCount keys that a Tag row is part of.
+
+    Args:
+        row: 'NEW' or 'OLD', for use in a trigger on Tag.
+        row_deleted: Whether the row was already deleted from Tag, so its pair
+            with itself has to be added separately.
+    """
+    other_tags = f"""
+        FROM Entity JOIN Tag AS Other ON Other.entity_id = Entity.entity_id
+        WHERE Entity.entity_id = {row}.entity_id
+        AND Other.tag_name IN {_sql_list(_FACET_FILTER_TAGS)}
+    """
+    pairs = f"""
+        SELECT
+            Entity.type, Other.tag_name, Other.tag_value,
+            {row}.tag_name, {row}.tag_value
+        {other_tags}
+        UNION ALL
+        SELECT
+            Entity.type, {row}.tag_name, {row}.tag_value,
+            Other.tag_name, Other.tag_value
+        {other_tags}
+        AND Other.tag_id != {row}.tag_id
+    """
+    if row_deleted:
+        pairs += f"""
+            UNION ALL
+            SELECT
+                type, {row}.tag_name, {row}.tag_value,
+                {row}.tag_name, {row}.tag_value
+            FROM Entity
+            WHERE entity_id = {row}.entity_id
+        """
+    return pairs
+
+
+_FACET_PAIR_COLUMNS = """(
+    type, filter_name, filter_value, tag_name, tag_value, entity_count
+)"""
+
+
+def _create_schema_items(transaction: sqlite3_db.Transaction) -> None:
+    """Migration step that creates everything in _SCHEMA.
+
+    TODO(#20): When the schema changes again, replace this with a frozen copy
+    of the items in v1alpha2, and migrate from v1alpha2 separately.
+    """
+    for item in _SCHEMA.items:
+        transaction.execute(item.create)
+
+
+def _migrate_v1alpha_entities(transaction: sqlite3_db.Transaction) -> None:
+    """Migration step that copies entities from the v1alpha tables.
+
+    Entity IDs are the v1alpha rowids. Tracks' tags are derived again and their
+    parents' tags are composed again, since derived and composed tags might
+    have changed since they were written.
+
+    Args:
+        transaction: Transaction with the v1alpha tables renamed to
+            V1AlphaFile, V1AlphaEntity, and V1AlphaTag.
+    """
+    track_tags = collections.defaultdict(lambda: collections.defaultdict(list))
+    # TODO(https://github.com/google/yapf/issues/792): Remove yapf disable.
+    for token_, name, value in transaction.execute(
+            """
+            SELECT token, tag_name, tag_value
+            FROM V1AlphaTag
+            WHERE token IN (
+                SELECT token FROM V1AlphaEntity WHERE type = ?
+            )
+            ORDER BY token, tag_name, tag_value_order
+            """,
+            (_EntityType.TRACK.value,),
+    ).fetchall():  # yapf: disable
+        track_tags[token_][name].append(value)
+    ids_by_token = {}
+    browse_keys = {}
+    child_ids = collections.defaultdict(list)
+    ids_by_type = collections.defaultdict(list)
+    tags_by_id = {}
+    # Parents are inserted before their children, so that their browse keys
+    # are known.
+    for entity_type in (_EntityType.ALBUM, _EntityType.MEDIUM,
+                        _EntityType.TRACK):
+        # TODO(https://github.com/google/yapf/issues/792): Remove yapf disable.
+        for entity_id, token_, filename, parent_token, sort_key in (
+                transaction.execute(
+                    """
+                    SELECT rowid, token, filename, parent_token, sort_key
+                    FROM V1AlphaEntity
+                    WHERE type = ?
+                    ORDER BY rowid
+                    """,
+                    (entity_type.value,),
+                ).fetchall()):  # yapf: disable
+            if parent_token is None:
+                parent_id, parent_browse_key = None, b''
+            else:
+                parent_id = ids_by_token[parent_token]
+                parent_browse_key = browse_keys[parent_id]
+                child_ids[parent_id].append(entity_id)
+            ids_by_token[token_] = entity_id
+            browse_keys[entity_id] = _browse_key(parent_browse_key, sort_key,
+                                                 entity_id)
+            ids_by_type[entity_type].append(entity_id)
+            if entity_type is _EntityType.TRACK:
+                tags_by_id[entity_id] = tag.Tags(track_tags[token_]).derive()
+            transaction.execute(
+                """
+                INSERT INTO Entity (
+                    entity_id, token, type, filename, parent_id, sort_key,
+                    browse_key
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    entity_id,
+                    token_,
+                    entity_type.value,
+                    filename,
+                    parent_id,
+                    sort_key,
+                    browse_keys[entity_id],
+                ),
+            )
+    # Mediums are composed first, since albums' tags come from them.
+    for entity_type in (_EntityType.MEDIUM, _EntityType.ALBUM):
+        for entity_id in ids_by_type[entity_type]:
+            tags_by_id[entity_id] = tag.compose(
+                tuple(tags_by_id[child_id]
+                      for child_id in sorted(child_ids[entity_id],
+                                             key=browse_keys.__getitem__)))
+    for entity_id, tags in tags_by_id.items():
+        _write_entity_tags(transaction, entity_id, tags)
+
 
 _SCHEMA = sqlite3_db.Schema(
     name='library',
-    version='v1alpha',  # TODO(#20): Change to v1.
+    version='v1alpha2',  # TODO(#20): Change to v1.
     items=(
         # Files that the entities in the library come from.
         #
-        # TODO(dseomn): Add more columns here so that it's possible to update
-        # the library efficiently without re-parsing files that are unchanged.
-        #
         # Columns:
         #   filename: Absolute filename.
+        #   size, mtime_ns, inode, device: Fingerprint of the file when it was
+        #       read, see scan.Fingerprint. These are all NULL if the
+        #       fingerprint is unknown.
+        #   partial_hash: See scan.AudioFile, or NULL if it's unknown.
         sqlite3_db.SchemaItem("""
             CREATE TABLE File (
                 filename TEXT NOT NULL,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER,
+                device INTEGER,
+                partial_hash BLOB,
                 PRIMARY KEY (filename)
             )
         """),
 
+        # Directories that have been scanned.
+        #
+        # Columns:
+        #   dirname: Absolute name of the directory.
+        #   mtime_ns: See scan.Directory.
+        #   entry_count: See scan.Directory.
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE Directory (
+                dirname TEXT NOT NULL,
+                mtime_ns INTEGER,
+                entry_count INTEGER NOT NULL,
+                PRIMARY KEY (dirname)
+            )
+        """),
+
         # Entities in the library, e.g., tracks, mediums, and albums.
         #
-        # TODO(dseomn): Add a trigger to delete an entity when it has no
-        # filename and no children?
+        # Entities with no filename and no children are deleted by the same
+        # transaction that removes their last child, see
+        # Database._delete_childless_parents().
         #
         # Columns:
+        #   entity_id: Row ID of the entity, which other tables use to refer to
+        #       it instead of its much longer token.
         #   token: Opaque token identifying the entity.
         #   type  Type of the entity, see _EntityType above. (The colon after
         #       'type' in this comment is intentionally missing to prevent
@@ -74,241 +287,2020 @@ _SCHEMA = sqlite3_db.Schema(
         #       comment.)
         #   filename: File the entity came from, or NULL if the entity doesn't
         #       correspond directly to a single file.
-        #   parent_token: Token of the entity that contains this entity, or NULL
-        #       if this is a top-level entity.
+        #   parent_id: ID of the entity that contains this entity, or NULL if
+        #       this is a top-level entity.
         #   sort_key: Natural sort order of this entity, compared to other
         #       entities that share a common ancestor (i.e., are on the same
         #       album).
+        #   browse_key: Order of this entity in the whole library, see
+        #       _browse_key().
+        #   tags: Copy of all the entity's tags in the Tag table below, see
+        #       _encode_tags(), or NULL if the entity's tags haven't been set
+        #       yet. This is for loading entities with a single read, while the
+        #       Tag table is for querying by tag.
         sqlite3_db.SchemaItem("""
             CREATE TABLE Entity (
+                entity_id INTEGER PRIMARY KEY,
                 token TEXT NOT NULL,
                 type TEXT NOT NULL,
                 filename TEXT REFERENCES File (filename) ON DELETE CASCADE,
-                parent_token TEXT REFERENCES Entity (token) ON DELETE CASCADE,
+                parent_id INTEGER
+                    REFERENCES Entity (entity_id) ON DELETE CASCADE,
                 sort_key BLOB NOT NULL,
-                PRIMARY KEY (token),
+                browse_key BLOB NOT NULL,
+                tags BLOB,
+                UNIQUE (token),
                 UNIQUE (filename)
             )
         """),
         sqlite3_db.SchemaItem("""
             CREATE INDEX Entity_ParentIndex
-            ON Entity (parent_token, sort_key)
+            ON Entity (parent_id, sort_key)
         """),
+        sqlite3_db.SchemaItem(
+            'CREATE UNIQUE INDEX Entity_BrowseIndex ON Entity (browse_key)'),
 
         # Tags for entities in the library.
         #
+        # Rows are only ever inserted and deleted, never updated, which keeps
+        # TagSearch below simple.
+        #
         # Columns:
-        #   token: Token of the entity with tags.
+        #   tag_id: Stable row ID, for TagSearch.
+        #   entity_id: ID of the entity with tags.
         #   tag_name: Name of the tag, e.g., 'artist'. Each value may appear
         #       multiple times for the same token.
         #   tag_value_order: Order of the value within the name.
         #   tag_value: A single value for the tag.
         sqlite3_db.SchemaItem("""
             CREATE TABLE Tag (
-                token TEXT NOT NULL REFERENCES Entity (token) ON DELETE CASCADE,
+                tag_id INTEGER PRIMARY KEY,
+                entity_id INTEGER NOT NULL
+                    REFERENCES Entity (entity_id) ON DELETE CASCADE,
                 tag_name TEXT NOT NULL,
                 tag_value_order INTEGER NOT NULL,
                 tag_value TEXT NOT NULL,
-                PRIMARY KEY (token, tag_name, tag_value_order)
+                UNIQUE (entity_id, tag_name, tag_value_order)
             )
         """),
         sqlite3_db.SchemaItem(
             'CREATE INDEX Tag_TagIndex ON Tag (tag_name, tag_value)'),
+
+        # Sort keys of entities, derived from their tags.
+        #
+        # Columns:
+        #   entity_id: ID of the entity.
+        #   sort_field: Name of the collation.SortField.
+        #   sort_key: See collation.sort_key().
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE SortKey (
+                entity_id INTEGER NOT NULL
+                    REFERENCES Entity (entity_id) ON DELETE CASCADE,
+                sort_field TEXT NOT NULL,
+                sort_key BLOB NOT NULL,
+                PRIMARY KEY (entity_id, sort_field)
+            )
+        """),
+        sqlite3_db.SchemaItem("""
+            CREATE INDEX SortKey_SortIndex
+            ON SortKey (sort_field, sort_key, entity_id)
+        """),
+
+        # Full-text index of the values in Tag, excluding pseudo-tags. This
+        # stores only the index, not the values themselves, and its rowid is
+        # Tag.tag_id. The tokenizer normalizes case and removes diacritics, and
+        # the prefix indexes make short prefix queries fast.
+        sqlite3_db.SchemaItem("""
+            CREATE VIRTUAL TABLE TagSearch USING fts5 (
+                tag_value,
+                content = 'Tag',
+                content_rowid = 'tag_id',
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '1 2 3'
+            )
+        """),
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Tag_InsertSearch
+            AFTER INSERT ON Tag
+            WHEN NEW.tag_name NOT LIKE '{tag.PseudoTag.PREFIX}%'
+            BEGIN
+                INSERT INTO TagSearch (rowid, tag_value)
+                VALUES (NEW.tag_id, NEW.tag_value);
+            END
+        """),
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Tag_DeleteSearch
+            AFTER DELETE ON Tag
+            WHEN OLD.tag_name NOT LIKE '{tag.PseudoTag.PREFIX}%'
+            BEGIN
+                INSERT INTO TagSearch (TagSearch, rowid, tag_value)
+                VALUES ('delete', OLD.tag_id, OLD.tag_value);
+            END
+        """),
+
+        # Entities changed by the current transaction, see
+        # Database._write_transaction(). This is empty outside of transactions.
+        # An entity is changed when it's inserted, deleted, or its tags are
+        # modified, and that also modifies its ancestors, since entity objects
+        # include their descendants. (Entities are at most two levels below
+        # their root, so the triggers only look up to the grandparent.)
+        # Cascading deletes fire the triggers too, so every path that changes an
+        # entity is covered.
+        #
+        # Columns:
+        #   change_id: Order of the change within the transaction.
+        #   token: Token of a changed entity. The same token can appear multiple
+        #       times.
+        #   type  Type of the entity, see _EntityType above.
+        #   change: What happened to the entity, see _ChangeType above.
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE EntityChange (
+                change_id INTEGER PRIMARY KEY,
+                token TEXT NOT NULL,
+                type TEXT NOT NULL,
+                change TEXT NOT NULL
+            )
+        """),
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Entity_InsertChange
+            AFTER INSERT ON Entity
+            BEGIN
+                INSERT INTO EntityChange (token, type, change)
+                VALUES (NEW.token, NEW.type, '{_ChangeType.ADDED.value}');
+                INSERT INTO EntityChange (token, type, change)
+                SELECT token, type, '{_ChangeType.MODIFIED.value}' FROM Entity
+                WHERE entity_id IN (
+                    NEW.parent_id,
+                    (SELECT parent_id FROM Entity
+                     WHERE entity_id = NEW.parent_id)
+                );
+            END
+        """),
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Entity_UpdateChange
+            AFTER UPDATE OF tags ON Entity
+            WHEN OLD.tags IS NOT NEW.tags
+            BEGIN
+                INSERT INTO EntityChange (token, type, change)
+                SELECT token, type, '{_ChangeType.MODIFIED.value}' FROM Entity
+                WHERE entity_id IN (
+                    NEW.entity_id,
+                    NEW.parent_id,
+                    (SELECT parent_id FROM Entity
+                     WHERE entity_id = NEW.parent_id)
+                );
+            END
+        """),
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Entity_DeleteChange
+            AFTER DELETE ON Entity
+            BEGIN
+                INSERT INTO EntityChange (token, type, change)
+                VALUES (OLD.token, OLD.type, '{_ChangeType.REMOVED.value}');
+                INSERT INTO EntityChange (token, type, change)
+                SELECT token, type, '{_ChangeType.MODIFIED.value}' FROM Entity
+                WHERE entity_id IN (
+                    OLD.parent_id,
+                    (SELECT parent_id FROM Entity
+                     WHERE entity_id = OLD.parent_id)
+                );
+            END
+        """),
+
+        # Entities' tags are deleted before the entities, instead of by the
+        # cascade afterwards, so that the triggers on Tag can still look up the
+        # entity's type.
+        sqlite3_db.SchemaItem("""
+            CREATE TRIGGER Entity_DeleteTags
+            BEFORE DELETE ON Entity
+            BEGIN
+                DELETE FROM Tag WHERE entity_id = OLD.entity_id;
+            END
+        """),
+
+        # Number of times each tag value appears on entities of each type, for
+        # browsing by facet, see Database.facet(). An entity with the same value
+        # more than once counts once for each. This excludes _UNFACETED_TAGS.
+        #
+        # Columns:
+        #   type  Type of the entities, see _EntityType above.
+        #   tag_name: Name of the tag.
+        #   tag_value: Value of the tag.
+        #   entity_count: Number of Tag rows with the name and value, for
+        #       entities of the type. This is always positive, since rows are
+        #       deleted when it reaches zero.
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE FacetCount (
+                type TEXT NOT NULL,
+                tag_name TEXT NOT NULL,
+                tag_value TEXT NOT NULL,
+                entity_count INTEGER NOT NULL,
+                PRIMARY KEY (type, tag_name, tag_value)
+            ) WITHOUT ROWID
+        """),
+        sqlite3_db.SchemaItem("""
+            CREATE INDEX FacetCount_CountIndex
+            ON FacetCount (type, tag_name, entity_count DESC, tag_value)
+        """),
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Tag_InsertFacet
+            AFTER INSERT ON Tag
+            WHEN NEW.tag_name NOT IN {_sql_list(_UNFACETED_TAGS)}
+            BEGIN
+                INSERT INTO FacetCount (type, tag_name, tag_value, entity_count)
+                SELECT type, NEW.tag_name, NEW.tag_value, 1
+                FROM Entity
+                WHERE entity_id = NEW.entity_id
+                ON CONFLICT (type, tag_name, tag_value)
+                DO UPDATE SET entity_count = entity_count + 1;
+            END
+        """),
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Tag_DeleteFacet
+            AFTER DELETE ON Tag
+            WHEN OLD.tag_name NOT IN {_sql_list(_UNFACETED_TAGS)}
+            BEGIN
+                UPDATE FacetCount SET entity_count = entity_count - 1
+                WHERE type = (
+                    SELECT type FROM Entity WHERE entity_id = OLD.entity_id
+                )
+                AND tag_name = OLD.tag_name AND tag_value = OLD.tag_value;
+                DELETE FROM FacetCount
+                WHERE type = (
+                    SELECT type FROM Entity WHERE entity_id = OLD.entity_id
+                )
+                AND tag_name = OLD.tag_name AND tag_value = OLD.tag_value
+                AND entity_count <= 0;
+            END
+        """),
+
+        # Number of times each pair of values of _FACET_FILTER_TAGS appears on
+        # entities of each type, counted like FacetCount, for facets filtered
+        # by another facet. Each value is also paired with itself. There are few
+        # enough rows for each filter that they're sorted by count on read,
+        # instead of maintaining an index for that.
+        #
+        # Columns:
+        #   type  Type of the entities, see _EntityType above.
+        #   filter_name, filter_value: Tag value to filter by.
+        #   tag_name, tag_value: Tag value to count.
+        #   entity_count: Number of pairs of Tag rows with the filter and tag
+        #       values, for entities of the type. Rows with zero are deleted at
+        #       the end of the trigger that decrements them.
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE FacetPairCount (
+                type TEXT NOT NULL,
+                filter_name TEXT NOT NULL,
+                filter_value TEXT NOT NULL,
+                tag_name TEXT NOT NULL,
+                tag_value TEXT NOT NULL,
+                entity_count INTEGER NOT NULL,
+                PRIMARY KEY (
+                    type, filter_name, filter_value, tag_name, tag_value
+                )
+            ) WITHOUT ROWID
+        """),
+        sqlite3_db.SchemaItem("""
+            CREATE INDEX FacetPairCount_EmptyIndex
+            ON FacetPairCount (entity_count)
+            WHERE entity_count <= 0
+        """),
+        # The WHERE clauses before ON CONFLICT avoid a parsing ambiguity, see
+        # https://www.sqlite.org/lang_upsert.html
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Tag_InsertFacetPair
+            AFTER INSERT ON Tag
+            WHEN NEW.tag_name IN {_sql_list(_FACET_FILTER_TAGS)}
+            BEGIN
+                INSERT INTO FacetPairCount {_FACET_PAIR_COLUMNS}
+                SELECT *, 1 FROM (
+                    {_facet_pairs_sql('NEW', row_deleted=False)}
+                )
+                WHERE true
+                ON CONFLICT (
+                    type, filter_name, filter_value, tag_name, tag_value
+                )
+                DO UPDATE SET entity_count = entity_count + 1;
+            END
+        """),
+        sqlite3_db.SchemaItem(f"""
+            CREATE TRIGGER Tag_DeleteFacetPair
+            AFTER DELETE ON Tag
+            WHEN OLD.tag_name IN {_sql_list(_FACET_FILTER_TAGS)}
+            BEGIN
+                INSERT INTO FacetPairCount {_FACET_PAIR_COLUMNS}
+                SELECT *, -1 FROM (
+                    {_facet_pairs_sql('OLD', row_deleted=True)}
+                )
+                WHERE true
+                ON CONFLICT (
+                    type, filter_name, filter_value, tag_name, tag_value
+                )
+                DO UPDATE SET entity_count = entity_count - 1;
+                DELETE FROM FacetPairCount WHERE entity_count <= 0;
+            END
+        """),
     ),
+    migrations=(
+        # The files' fingerprints are unknown after this, so the next rescan
+        # reads all the files again, but the library is usable until then.
+        sqlite3_db.Migration(
+            from_version='v1alpha',
+            to_version='v1alpha2',
+            steps=(
+                'DROP INDEX Entity_ParentIndex',
+                'DROP INDEX Tag_TagIndex',
+                'ALTER TABLE File RENAME TO V1AlphaFile',
+                'ALTER TABLE Entity RENAME TO V1AlphaEntity',
+                'ALTER TABLE Tag RENAME TO V1AlphaTag',
+                _create_schema_items,
+                'INSERT INTO File (filename) SELECT filename FROM V1AlphaFile',
+                _migrate_v1alpha_entities,
+                'DROP TABLE V1AlphaTag',
+                'DROP TABLE V1AlphaEntity',
+                'DROP TABLE V1AlphaFile',
+                'DELETE FROM EntityChange',
+            ),
+        ),),
+)
+
+
+def _filename_range(dirname: str) -> Tuple[str, str]:
+    """Returns the range of filenames within a directory, recursively.
+
+    Args:
+        dirname: Absolute name of the directory.
+
+    Returns:
+        (start, stop) such that start <= filename < stop for every filename
+        within dirname.
+    """
+    start = os.path.join(dirname, '')
+    return start, start[:-1] + chr(ord(start[-1]) + 1)
+
+
+# Max number of parameters to use in a single IN (...) list. SQLite's limit on
+# the total number of parameters in a statement can be as low as 999.
+_MAX_IN_PARAMETERS = 500
+
+# Default max number of files for update_files() to write in each transaction.
+_UPDATE_BATCH_SIZE = 1000
+
+# Default max time for update_files() to wait for a batch of files to fill up,
+# before writing what it has so far.
+_UPDATE_BATCH_SECONDS = 1.0
+
+# Max number of scanned files waiting to be written by update_files().
+_UPDATE_QUEUE_SIZE = 2 * _UPDATE_BATCH_SIZE
+
+# Default max number of entities in Database's cache.
+_CACHE_SIZE = 10000
+
+# Max number of random IDs that random_sample() tries per entity in the sample,
+# before falling back to scanning the table.
+_RANDOM_SAMPLE_MAX_DRAWS = 100
+
+_T = TypeVar('_T')
+_AnyEntity = TypeVar('_AnyEntity', entity.Track, entity.Medium, entity.Album)
+
+
+def _chunks(items: Iterable[_T]) -> Generator[Sequence[_T], None, None]:
+    """Yields chunks of items that are small enough for an IN (...) list."""
+    iterator = iter(items)
+    while True:
+        chunk = tuple(itertools.islice(iterator, _MAX_IN_PARAMETERS))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _in_list(values: Sequence[str]) -> str:
+    """Returns SQL for an IN (...) list of parameters, for the given values."""
+    return '(' + ', '.join('?' * len(values)) + ')'
+
+
+def _in_query(sql: str, values: Sequence[str]) -> Tuple[str, Sequence[str]]:
+    """Returns a query and its parameters, for an IN (...) list.
+
+    Args:
+        sql: Query with a single 'IN ?' in it, and no other parameters.
+        values: Values for the IN list.
+    """
+    before, after = sql.split('IN ?')
+    builder = sqlite3_db.QueryBuilder()
+    builder.append(before)
+    builder.append('IN ' + _in_list(values), values)
+    builder.append(after)
+    return builder.build()
+
+
+class _EndOfItems(enum.Enum):
+    """Placeholder for the end of the items in a queue from _produce()."""
+    END = enum.auto()
+
+
+_END_OF_ITEMS = _EndOfItems.END
+
+
+@dataclasses.dataclass(frozen=True)
+class _ProducerError:
+    """Placeholder for an exception raised by _produce()'s items."""
+    error: BaseException
+
+
+# Something in a queue from _produce().
+_QueueEntry = Union[_T, _EndOfItems, _ProducerError]
+
+
+def _produce(
+        items: Iterable[_T],
+        item_queue: 'queue.Queue[_QueueEntry[_T]]',
+        cancelled: threading.Event,
+) -> None:
+    """Puts items in a queue, in a background thread for _batches()."""
+    try:
+        for item in items:
+            if cancelled.is_set():
+                return
+            item_queue.put(item)
+    except BaseException as error:  # pylint: disable=broad-except
+        item_queue.put(_ProducerError(error))
+    else:
+        item_queue.put(_END_OF_ITEMS)
+
+
+def _batches(
+        items: Iterable[_T],
+        *,
+        batch_size: int,
+        batch_seconds: float,
+) -> Generator[Sequence[_T], None, None]:
+    """Yields batches of items, while getting more items in the background.
+
+    Args:
+        items: Items to batch. This is iterated over in a background thread,
+            with a bounded number of items waiting in a queue.
+        batch_size: Max number of items in a batch.
+        batch_seconds: Max time to wait for a batch to fill up after its first
+            item, before yielding it anyway.
+
+    Raises:
+        Anything that iterating over items raises.
+    """
+    item_queue: 'queue.Queue[_QueueEntry[_T]]' = queue.Queue(
+        maxsize=_UPDATE_QUEUE_SIZE)
+    cancelled = threading.Event()
+    producer = threading.Thread(
+        target=_produce,
+        args=(items, item_queue, cancelled),
+        daemon=True,
+    )
+    producer.start()
+    try:
+        batch: List[_T] = []
+        deadline: Optional[float] = None
+        while True:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                entry = item_queue.get(timeout=timeout)
+            except queue.Empty:
+                yield batch
+                batch = []
+                deadline = None
+                continue
+            if entry is _END_OF_ITEMS:
+                break
+            elif isinstance(entry, _ProducerError):
+                raise entry.error
+            if not batch:
+                deadline = time.monotonic() + batch_seconds
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+                deadline = None
+        if batch:
+            yield batch
+    finally:
+        # Unblock the producer if it's waiting for space in the queue, so that
+        # it can see that it was cancelled.
+        cancelled.set()
+        while producer.is_alive():
+            try:
+                item_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _browse_key(parent_browse_key: bytes, sort_key: bytes,
+                entity_id: int) -> bytes:
+    """Returns a key for sorting entities by their ancestry.
+
+    Args:
+        parent_browse_key: Browse key of the entity's parent, or b'' if the
+            entity has no parent.
+        sort_key: Sort key of the entity within its parent.
+        entity_id: ID of the entity.
+
+    Returns:
+        Key that compares as bytes the same way the tuple of (sort_key,
+        entity_id) of the entity and all its ancestors does, so that each entity
+        sorts right before its descendants.
+    """
+    key = bytearray(parent_browse_key)
+    for component in (sort_key, entity_id.to_bytes(8, 'big')):
+        # Escaping NUL and terminating each component with a sequence that
+        # sorts lower than any escaped byte keeps shorter prefixes first.
+        key += component.replace(b'\x00', b'\x00\xff')
+        key += b'\x00\x01'
+    return bytes(key)
+
+
+def _encode_tags(tags: tag.Tags) -> bytes:
+    """Returns tags serialized for Entity.tags."""
+    return json.dumps(
+        {name: tags[name] for name in sorted(tags)},
+        ensure_ascii=False,
+        separators=(',', ':'),
+    ).encode('utf-8')
+
+
+def _decode_tags(tags_blob: Optional[bytes]) -> tag.Tags:
+    """Returns tags from Entity.tags."""
+    if tags_blob is None:
+        return tag.Tags({})
+    return tag.Tags(json.loads(tags_blob))
+
+
+def _write_entity_tags(
+        transaction: sqlite3_db.Transaction,
+        entity_id: int,
+        tags: tag.Tags,
+) -> None:
+    """Sets Tags and the sort keys derived from them for the given entity."""
+    transaction.execute(
+        'UPDATE Entity SET tags = ? WHERE entity_id = ?',
+        (_encode_tags(tags), entity_id),
+    )
+    transaction.execute('DELETE FROM Tag WHERE entity_id = ?', (entity_id,))
+    transaction.executemany(
+        """
+        INSERT INTO Tag (entity_id, tag_name, tag_value_order, tag_value)
+        VALUES (?, ?, ?, ?)
+        """,
+        ((entity_id, name, order, value)
+         for name, values in tags.items()
+         for order, value in enumerate(values)),
+    )
+    transaction.executemany(
+        """
+        INSERT OR REPLACE INTO SortKey (entity_id, sort_field, sort_key)
+        VALUES (?, ?, ?)
+        """,
+        ((entity_id, field.name, collation.sort_key(field, tags))
+         for field in collation.SortField),
+    )
+
+
+def _page_token_json_default(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return {'bytes': value.hex()}
+    raise TypeError(f'Unexpected value in page token: {value!r}')
+
+
+def _page_token_json_object_hook(value: Dict[str, Any]) -> Any:
+    if value.keys() == {'bytes'}:
+        return bytes.fromhex(value['bytes'])
+    return value
+
+
+def _encode_page_token(request: Sequence[Any], after: Sequence[Any]) -> str:
+    """Returns an opaque page token.
+
+    Args:
+        request: Parameters of the search that the page token is for.
+        after: Sort key of the last result on the previous page.
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(
+            (tuple(request), tuple(after)),
+            default=_page_token_json_default,
+        ).encode('utf-8')).decode('ascii')
+
+
+def _decode_page_token(page_token: str,
+                       request: Sequence[Any]) -> Sequence[Any]:
+    """Returns the sort key in a page token.
+
+    Args:
+        page_token: Page token from _encode_page_token().
+        request: Parameters of the search that the page token must be for.
+
+    Raises:
+        ValueError: The page token is invalid, or not for request.
+    """
+    try:
+        token_request, after = json.loads(
+            base64.urlsafe_b64decode(page_token),
+            object_hook=_page_token_json_object_hook,
+        )
+    except (TypeError, ValueError) as error:
+        raise ValueError(f'Invalid page token: {page_token!r}') from error
+    if token_request != list(request):
+        raise ValueError(
+            f'Page token {page_token!r} is not for query {request!r}')
+    return after
+
+
+# Term in a search query, e.g., 'foo', 'artist:foo', or 'artist:"foo bar"'.
+_SEARCH_TERM_REGEX = re.compile(
+    r"""
+    (?:(?P<tag_name>[^\W\d]\w*):)?
+    (?:"(?P<quoted>[^"]*)"?|(?P<unquoted>\S+))
+    """,
+    re.VERBOSE,
 )
 
 
-class Database:
-    """Database for a library."""
+@dataclasses.dataclass(frozen=True)
+class _SearchTerm:
+    """Term in a search query.
+
+    Attributes:
+        tag_name: Tag to restrict the term to, or None to match any tag.
+        match: FTS5 query for the term's text, matching tag values that
+            contain the text as a phrase, with the last word as a prefix.
+    """
+    tag_name: Optional[str]
+    match: str
+
+
+def _search_terms(query: str) -> List[_SearchTerm]:
+    """Parses a search query.
+
+    Args:
+        query: Whitespace-separated terms, each of which must match a value of
+            any tag, or of the specific tag in a term like 'artist:foo'.
+            Double quotes group words into a single phrase, e.g.,
+            'artist:"foo bar"'.
+
+    Returns:
+        Terms in the query, skipping any without words.
+    """
+    terms = []
+    for match in _SEARCH_TERM_REGEX.finditer(query):
+        text = match.group('quoted') or match.group('unquoted') or ''
+        if re.search(r'\w', text) is None:
+            # Without any words, the term would match nothing.
+            continue
+        tag_name = match.group('tag_name')
+        terms.append(
+            _SearchTerm(
+                tag_name=None if tag_name is None else tag_name.lower(),
+                match='"' + text.replace('"', '""') + '" *',
+            ))
+    return terms
+
+
+@dataclasses.dataclass(frozen=True)
+class UpdateProgress(pubsub.Message):
+    """Progress of updating the library to match a directory.
+
+    Attributes:
+        root_dirname: Directory that the library is being updated to match.
+        files_processed: Number of files from the directory that have been
+            committed to the database so far.
+        done: Whether the update is complete.
+    """
+    root_dirname: str
+    files_processed: int
+    done: bool
+
+
+@dataclasses.dataclass(frozen=True)
+class MigrationProgress(pubsub.Message):
+    """Progress of migrating the library from an older version of the schema.
+
+    Attributes:
+        progress: Progress of the migration.
+    """
+    progress: sqlite3_db.MigrationProgress
+
+
+@dataclasses.dataclass(frozen=True)
+class TokenChanges:
+    """Changes to entities of a single type.
+
+    Attributes:
+        added: Tokens of entities that were added.
+        removed: Tokens of entities that were removed.
+        modified: Tokens of entities that exist both before and after the
+            change, but with different data. This includes entities whose
+            descendants were added, removed, or modified.
+    """
+    added: FrozenSet[token.LibraryToken] = frozenset()
+    removed: FrozenSet[token.LibraryToken] = frozenset()
+    modified: FrozenSet[token.LibraryToken] = frozenset()
+
+
+@dataclasses.dataclass(frozen=True)
+class EntitiesChanged(pubsub.Message):
+    """Entities that were changed by a committed write to the library.
+
+    Attributes:
+        tracks: Changes to tracks.
+        mediums: Changes to mediums.
+        albums: Changes to albums.
+    """
+    tracks: TokenChanges = TokenChanges()
+    mediums: TokenChanges = TokenChanges()
+    albums: TokenChanges = TokenChanges()
+
+
+def _entities_changed(
+        changes: Iterable[Tuple[str, str, str]]) -> Optional[EntitiesChanged]:
+    """Returns the net effect of changes from the EntityChange table.
+
+    Args:
+        changes: (token, type, change) rows from EntityChange, in order.
+
+    Returns:
+        The changes, or None if there are no net changes.
+    """
+    first_change = {}
+    last_change = {}
+    for token_str, type_name, change in changes:
+        token_ = _TYPE_NAME_TO_TOKEN_TYPE[type_name](token_str)
+        first_change.setdefault(token_, _ChangeType(change))
+        last_change[token_] = _ChangeType(change)
+    changed_by_type = {
+        token_type: collections.defaultdict(set)
+        for token_type in _TYPE_NAME_TO_TOKEN_TYPE.values()
+    }
+    for token_, first in first_change.items():
+        existed_before = first is not _ChangeType.ADDED
+        exists_after = last_change[token_] is not _ChangeType.REMOVED
+        if existed_before and exists_after:
+            net_change = _ChangeType.MODIFIED
+        elif exists_after:
+            net_change = _ChangeType.ADDED
+        elif existed_before:
+            net_change = _ChangeType.REMOVED
+        else:
+            continue
+        changed_by_type[type(token_)][net_change].add(token_)
+    if not any(changed_by_type.values()):
+        return None
+    token_changes = {
+        token_type: TokenChanges(
+            added=frozenset(changed[_ChangeType.ADDED]),
+            removed=frozenset(changed[_ChangeType.REMOVED]),
+            modified=frozenset(changed[_ChangeType.MODIFIED]),
+        ) for token_type, changed in changed_by_type.items()
+    }
+    return EntitiesChanged(
+        tracks=token_changes[token.Track],
+        mediums=token_changes[token.Medium],
+        albums=token_changes[token.Album],
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class SearchPage:
+    """Page of search results.
+
+    Attributes:
+        tokens: Tokens for entities on this page, in order.
+        next_page_token: Token to get the next page with, or None if this is the
+            last page.
+    """
+    tokens: Sequence[token.LibraryToken]
+    next_page_token: Optional[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class FacetValue:
+    """Value of a tag, with the number of times it appears.
+
+    Attributes:
+        value: Value of the tag.
+        count: Number of times the value appears in the tags of the counted
+            entities. This is usually the number of entities with the value,
+            but an entity with the same value more than once, e.g., a track
+            with a duplicated artist, counts once for each.
+    """
+    value: str
+    count: int
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheInfo:
+    """Statistics about the cache of entities.
+
+    Attributes:
+        hits: Number of entities that were returned from the cache.
+        misses: Number of entities that were loaded from the database.
+        entries: Number of entities currently in the cache.
+        max_entries: Max number of entities in the cache.
+    """
+    hits: int
+    misses: int
+    entries: int
+    max_entries: int
+
+
+@dataclasses.dataclass(frozen=True)
+class _EntityTree:
+    """Entities loaded from the database, for building entity objects.
+
+    Attributes:
+        root_ids: Map from token to ID, for the entities at the roots of the
+            tree.
+        child_ids: Map from ID to the IDs of its children, in order.
+        tags: Map from ID to its tags.
+    """
+    root_ids: Mapping[str, int]
+    child_ids: Mapping[int, Sequence[int]]
+    tags: Mapping[int, tag.Tags]
+
+    def _tags(self, entity_id: int) -> tag.Tags:
+        return self.tags.get(entity_id, tag.Tags({}))
+
+    def track(self, entity_id: int) -> entity.Track:
+        return entity.Track(tags=self._tags(entity_id))
+
+    def medium(self, entity_id: int) -> entity.Medium:
+        return entity.Medium(
+            tags=self._tags(entity_id),
+            tracks=tuple(
+                self.track(track_id)
+                for track_id in self.child_ids.get(entity_id, ())),
+        )
+
+    def album(self, entity_id: int) -> entity.Album:
+        return entity.Album(
+            tags=self._tags(entity_id),
+            mediums=tuple(
+                self.medium(medium_id)
+                for medium_id in self.child_ids.get(entity_id, ())),
+        )
+
+
+class _EntityCache:
+    """Thread-safe LRU cache of entity objects, keyed by token.
+
+    Loading an entity from the database and putting it in the cache can race
+    with a write that changes the entity. To avoid caching stale entities, the
+    generation is read before loading, and put() ignores entities that were
+    loaded before the latest invalidation.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: 'collections.OrderedDict[str, Any]' = (
+            collections.OrderedDict())
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def get(self, token_: str) -> Optional[Any]:
+        """Returns the cached entity, or None."""
+        with self._lock:
+            value = self._entries.get(token_)
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(token_)
+            return value
+
+    def put(self, token_: str, value: Any, generation: int) -> None:
+        """Caches an entity that was loaded at the given generation."""
+        with self._lock:
+            if generation != self._generation or self._max_entries <= 0:
+                return
+            self._entries[token_] = value
+            self._entries.move_to_end(token_)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tokens: Collection[str]) -> None:
+        """Removes entities from the cache."""
+        if not tokens:
+            return
+        with self._lock:
+            self._generation += 1
+            for token_ in tokens:
+                self._entries.pop(token_, None)
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(
+                hits=self._hits,
+                misses=self._misses,
+                entries=len(self._entries),
+                max_entries=self._max_entries,
+            )
+
+
+class Database:
+    """Database for a library.
+
+    After each committed transaction that changes any entities, EntitiesChanged
+    is published.
+    """
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def __init__(
+            self,
+            *,
+            database_dir: str,
+            pubsub_bus: Optional[pubsub.PubSub] = None,
+            cache_size: int = _CACHE_SIZE,
+            profile: sqlite3_db.Profile = sqlite3_db.INTERACTIVE,
+            ingest_profile: Optional[sqlite3_db.Profile] = (
+                sqlite3_db.BULK_INGEST),
+            instrumentation: Optional[sqlite3_db.Instrumentation] = None,
+            reverse_unordered_selects: bool = False,
+    ) -> None:  # yapf: disable
+        """Initializer.
+
+        Args:
+            database_dir: Directory containing databases.
+            pubsub_bus: PubSub bus to publish progress and changes to, or
+                None. This includes MigrationProgress while initializing, if
+                the library is migrated from an older version of the schema.
+            cache_size: Max number of tracks, mediums, and albums to keep in
+                memory, or 0 to disable the cache.
+            profile: Performance settings for the database, see
+                sqlite3_db.Database.
+            ingest_profile: Performance settings for transactions in
+                insert_files() and update_files(), or None to use profile.
+                Everything they write can be written again by rescanning the
+                library, so they don't need to be as durable.
+            instrumentation: See sqlite3_db.Database.
+            reverse_unordered_selects: For tests only, see sqlite3_db.Database.
+        """
+        self._pubsub_bus = pubsub_bus
+        self._cache = _EntityCache(cache_size)
+        self._ingest_profile = ingest_profile
+        self._db = sqlite3_db.Database(
+            _SCHEMA,
+            database_dir=database_dir,
+            profile=profile,
+            instrumentation=instrumentation,
+            migration_callback=(
+                lambda progress: self._publish(MigrationProgress(progress))),
+            reverse_unordered_selects=reverse_unordered_selects,
+        )
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    @contextlib.contextmanager
+    def _write_transaction(
+            self,
+            *,
+            profile: Optional[sqlite3_db.Profile] = None,
+    ) -> Generator[sqlite3_db.Transaction, None, None]:  # yapf: disable
+        """Returns a context manager around a transaction that changes entities.
+
+        After the transaction commits, entities that it changed are removed
+        from the cache, then EntitiesChanged is published.
+
+        Args:
+            profile: See sqlite3_db.Database.transaction().
+        """
+        with self._db.transaction(profile=profile) as transaction:
+            yield transaction
+            changes = transaction.execute("""
+                SELECT token, type, change
+                FROM EntityChange
+                ORDER BY change_id
+            """).fetchall()
+            transaction.execute('DELETE FROM EntityChange')
+        self._cache.invalidate(frozenset(token_ for token_, _, _ in changes))
+        entities_changed = _entities_changed(changes)
+        if entities_changed is not None:
+            self._publish(entities_changed)
+
+    def cache_info(self) -> CacheInfo:
+        """Returns statistics about the cache of entities."""
+        return self._cache.info()
+
+    def _get_tags(
+            self,
+            snapshot: sqlite3_db.AbstractSnapshot,
+            entity_id: int,
+    ) -> tag.Tags:
+        """Returns Tags for the given entity."""
+        (tags_blob,) = snapshot.execute(
+            'SELECT tags FROM Entity WHERE entity_id = ?',
+            (entity_id,),
+        ).fetchone()
+        return _decode_tags(tags_blob)
+
+    def _get_tags_by_id(
+            self,
+            snapshot: sqlite3_db.AbstractSnapshot,
+            entity_ids: Iterable[int],
+    ) -> Dict[int, tag.Tags]:
+        """Returns Tags for many entities, with a query per chunk of entities.
+
+        Args:
+            snapshot: Snapshot to use.
+            entity_ids: Entities to get tags for.
+
+        Returns:
+            Map from entity ID to Tags. Entities without any tags are omitted.
+        """
+        tags_by_id = {}
+        for chunk in _chunks(entity_ids):
+            for entity_id, tags_blob in snapshot.execute(*_in_query(
+                    """
+                    SELECT entity_id, tags
+                    FROM Entity
+                    WHERE entity_id IN ? AND tags IS NOT NULL
+                    """,
+                    chunk,
+            )):
+                tags_by_id[entity_id] = _decode_tags(tags_blob)
+        return tags_by_id
+
+    def _set_tags(
+            self,
+            transaction: sqlite3_db.Transaction,
+            entity_id: int,
+            tags: tag.Tags,
+    ) -> None:
+        """Sets tags of the given entity, see _write_entity_tags()."""
+        _write_entity_tags(transaction, entity_id, tags)
+
+    def _insert_entity(
+            self,
+            transaction: sqlite3_db.Transaction,
+            *,
+            token_: token.LibraryToken,
+            entity_type: _EntityType,
+            filename: Optional[str],
+            parent: Optional[Tuple[int, bytes]],
+            sort_key: bytes,
+    ) -> Tuple[int, bytes]:
+        """Inserts an entity, unless it's already in the database.
+
+        Args:
+            transaction: Transaction to use.
+            token_: Token of the entity.
+            entity_type: Type of the entity.
+            filename: File the entity comes from, or None.
+            parent: (ID, browse key) of the entity's parent, or None.
+            sort_key: Sort key of the entity within its parent.
+
+        Returns:
+            (ID, browse key) of the entity.
+        """
+        row = transaction.execute(
+            'SELECT entity_id, browse_key FROM Entity WHERE token = ?',
+            (str(token_),),
+        ).fetchone()
+        if row is not None:
+            return row
+        # The ID is chosen up front, instead of letting SQLite choose the same
+        # one, because the browse key depends on it.
+        (entity_id,) = transaction.execute(
+            'SELECT coalesce(max(entity_id), 0) + 1 FROM Entity').fetchone()
+        parent_id, parent_browse_key = (None, b'') if parent is None else parent
+        browse_key = _browse_key(parent_browse_key, sort_key, entity_id)
+        transaction.execute(
+            """
+            INSERT INTO Entity (
+                entity_id, token, type, filename, parent_id, sort_key,
+                browse_key
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                entity_id,
+                str(token_),
+                entity_type.value,
+                filename,
+                parent_id,
+                sort_key,
+                browse_key,
+            ),
+        )
+        return entity_id, browse_key
+
+    def _insert_audio_file(
+            self,
+            transaction: sqlite3_db.Transaction,
+            file_info: scan.AudioFile,
+            dirty_parents: Set[int],
+    ) -> None:
+        """Inserts information about the given audio file.
+
+        Args:
+            transaction: Transaction to use.
+            file_info: File to insert.
+            dirty_parents: Set to add the file's medium and album IDs to.
+        """
+        album = self._insert_entity(
+            transaction,
+            token_=file_info.track.album_token,
+            entity_type=_EntityType.ALBUM,
+            filename=None,
+            parent=None,
+            sort_key=b'',
+        )
+        medium = self._insert_entity(
+            transaction,
+            token_=file_info.track.medium_token,
+            entity_type=_EntityType.MEDIUM,
+            filename=None,
+            parent=album,
+            sort_key=file_info.track.medium_sort_key,
+        )
+        track_id, _ = self._insert_entity(
+            transaction,
+            token_=file_info.track.token,
+            entity_type=_EntityType.TRACK,
+            filename=file_info.filename,
+            parent=medium,
+            sort_key=file_info.track.sort_key,
+        )
+        self._set_tags(transaction, track_id, file_info.track.tags)
+        dirty_parents.update((medium[0], album[0]))
+
+    def _compose_tags(
+            self,
+            transaction: sqlite3_db.Transaction,
+            dirty_parents: Collection[int],
+    ) -> None:
+        """Updates tags of parent entities based on their children's tags.
+
+        Args:
+            transaction: Transaction to use.
+            dirty_parents: IDs of mediums and albums that might have different
+                children than when their tags were last updated. Albums of the
+                given mediums are updated too. IDs that aren't in the database
+                are ignored.
+        """
+        medium_ids = set()
+        album_ids = set()
+        for chunk in _chunks(dirty_parents):
+            # TODO(https://github.com/google/yapf/issues/792): Remove yapf
+            # disable.
+            for parent_id, parent_type, grandparent_id in (
+                    transaction.execute(*_in_query(
+                        """
+                        SELECT entity_id, type, parent_id
+                        FROM Entity
+                        WHERE entity_id IN ?
+                        """,
+                        chunk,
+                    ))):  # yapf: disable
+                if parent_type == _EntityType.MEDIUM.value:
+                    medium_ids.add(parent_id)
+                    album_ids.add(grandparent_id)
+                elif parent_type == _EntityType.ALBUM.value:
+                    album_ids.add(parent_id)
+        # Mediums are updated first, since albums' tags come from them.
+        self._compose_tags_of(transaction, medium_ids)
+        self._compose_tags_of(transaction, album_ids)
+
+    def _compose_tags_of(
+            self,
+            transaction: sqlite3_db.Transaction,
+            parent_ids: Collection[int],
+    ) -> None:
+        """Updates tags of the given parents, see _compose_tags().
+
+        Args:
+            transaction: Transaction to use.
+            parent_ids: IDs of parents to update. Tags of each parent are only
+                written if they changed.
+        """
+        for chunk in _chunks(sorted(parent_ids)):
+            child_ids_by_parent = collections.defaultdict(list)
+            for child_id, parent_id in transaction.execute(*_in_query(
+                    """
+                    SELECT entity_id, parent_id
+                    FROM Entity
+                    WHERE parent_id IN ?
+                    """,
+                    chunk,
+            )):
+                child_ids_by_parent[parent_id].append(child_id)
+            child_tags = self._get_tags_by_id(
+                transaction,
+                itertools.chain.from_iterable(child_ids_by_parent.values()),
+            )
+            old_tags = self._get_tags_by_id(transaction, chunk)
+            for parent_id, child_ids in child_ids_by_parent.items():
+                new_tags = tag.compose(
+                    tuple(
+                        child_tags.get(child_id, tag.Tags({}))
+                        for child_id in child_ids))
+                if new_tags != old_tags.get(parent_id, tag.Tags({})):
+                    self._set_tags(transaction, parent_id, new_tags)
+
+    def _insert_file(
+            self,
+            transaction: sqlite3_db.Transaction,
+            file_info: scan.File,
+            dirty_parents: Set[int],
+    ) -> None:
+        """Inserts information about the given file.
+
+        Args:
+            transaction: Transaction to use.
+            file_info: File to insert.
+            dirty_parents: Set to add the IDs of any parents of the file's
+                entities to.
+
+        Raises:
+            sqlite3.IntegrityError: The file is already in the database.
+        """
+        fingerprint = file_info.fingerprint
+        transaction.execute(
+            """
+            INSERT INTO File
+                (filename, size, mtime_ns, inode, device, partial_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                file_info.filename,
+                None if fingerprint is None else fingerprint.size,
+                None if fingerprint is None else fingerprint.mtime_ns,
+                None if fingerprint is None else fingerprint.inode,
+                None if fingerprint is None else fingerprint.device,
+                (file_info.partial_hash
+                 if isinstance(file_info, scan.AudioFile) else None),
+            ),
+        )
+        if isinstance(file_info, scan.AudioFile):
+            self._insert_audio_file(transaction, file_info, dirty_parents)
+
+    def _delete_files(
+            self,
+            transaction: sqlite3_db.Transaction,
+            filenames: Collection[str],
+            dirty_parents: Set[int],
+    ) -> None:
+        """Deletes files, along with the entities that come from them.
+
+        This uses a constant number of statements per chunk of files.
+
+        Args:
+            transaction: Transaction to use.
+            filenames: Files to delete. Files that aren't in the database are
+                ignored.
+            dirty_parents: Set to add the IDs of any parents of the files'
+                entities to.
+        """
+        for chunk in _chunks(filenames):
+            for medium_id, album_id in transaction.execute(*_in_query(
+                    """
+                    SELECT Medium.entity_id, Medium.parent_id
+                    FROM Entity AS Track
+                    JOIN Entity AS Medium ON Medium.entity_id = Track.parent_id
+                    WHERE Track.filename IN ?
+                    """,
+                    chunk,
+            )).fetchall():
+                dirty_parents.update((medium_id, album_id))
+            transaction.execute(
+                *_in_query('DELETE FROM File WHERE filename IN ?', chunk))
+
+    def _moved_audio_file(
+            self,
+            transaction: sqlite3_db.Transaction,
+            file_info: scan.MovedFile,
+    ) -> Optional[scan.AudioFile]:
+        """Returns an audio file based on the known source of a moved file.
+
+        Args:
+            transaction: Transaction to use.
+            file_info: Moved file.
+
+        Returns:
+            The moved file, with the source's tags except for the tags that come
+            from the filename, or None if the source is not in the database
+            with the expected fingerprint.
+        """
+        fingerprint = file_info.source_fingerprint
+        row = transaction.execute(
+            """
+            SELECT Entity.entity_id, File.partial_hash
+            FROM File JOIN Entity ON Entity.filename = File.filename
+            WHERE File.filename = ?
+                AND File.size = ?
+                AND File.mtime_ns = ?
+                AND File.inode = ?
+                AND File.device = ?
+                AND Entity.type = ?
+            """,
+            (
+                file_info.source_filename,
+                fingerprint.size,
+                fingerprint.mtime_ns,
+                fingerprint.inode,
+                fingerprint.device,
+                _EntityType.TRACK.value,
+            ),
+        ).fetchone()
+        if row is None:
+            return None
+        source_id, partial_hash = row
+        return scan.AudioFile(
+            filename=file_info.filename,
+            dirname=file_info.dirname,
+            basename=file_info.basename,
+            fingerprint=file_info.fingerprint,
+            track=entity.Track(tags=tag.Tags({
+                **self._get_tags(transaction, source_id),
+                tag.BASENAME: (file_info.basename,),
+                tag.DIRNAME: (file_info.dirname,),
+                tag.FILENAME: (file_info.filename,),
+            }).derive()),
+            partial_hash=partial_hash,
+        )
+
+    def _delete_childless_parents(
+            self,
+            transaction: sqlite3_db.Transaction,
+            dirty_parents: Collection[int],
+    ) -> None:
+        """Deletes mediums and albums that no longer have any children.
+
+        This uses a single statement per level of the tree and chunk of IDs.
+        Afterwards, _compose_tags() with the same IDs updates only the parents
+        that are left.
+
+        Args:
+            transaction: Transaction to use.
+            dirty_parents: IDs of mediums and albums to consider deleting.
+                Albums must be included even if they only contain dirty mediums.
+        """
+        # Mediums are deleted first, since that can leave their albums empty.
+        for parent_type in (_EntityType.MEDIUM, _EntityType.ALBUM):
+            for chunk in _chunks(dirty_parents):
+                builder = sqlite3_db.QueryBuilder()
+                builder.append(
+                    """
+                    DELETE FROM Entity
+                    WHERE type = ? AND filename IS NULL AND NOT EXISTS (
+                        SELECT 1
+                        FROM Entity AS Child
+                        WHERE Child.parent_id = Entity.entity_id
+                    )
+                    AND entity_id IN
+                    """,
+                    (parent_type.value,),
+                )
+                builder.append(_in_list(chunk), chunk)
+                transaction.execute(*builder.build())
+
+    def insert_files(self, files: Iterable[scan.File]) -> None:
+        """Inserts information about the given files.
+
+        Args:
+            files: Files to insert into the database.
+
+        This uses a single transaction, see update_files() for updating the
+        library in smaller transactions.
+
+        Raises:
+            sqlite3.IntegrityError: One or more files are already in the
+                database.
+        """
+        with self._write_transaction(
+                profile=self._ingest_profile) as transaction:
+            dirty_parents = set()
+            for file_info in files:
+                self._insert_file(transaction, file_info, dirty_parents)
+            self._compose_tags(transaction, dirty_parents)
+
+    def remove_files(self, filenames: Iterable[str]) -> None:
+        """Removes files, along with the entities that come from them.
+
+        Mediums and albums that are left without any tracks are removed too,
+        and the tags of the ones that are left are updated. This uses a single
+        transaction.
+
+        Args:
+            filenames: Absolute names of files to remove. Files that aren't in
+                the database are ignored. Files that still exist are added back
+                by the next update_files() or rescan() that includes them.
+        """
+        with self._write_transaction() as transaction:
+            dirty_parents = set()
+            self._delete_files(transaction, frozenset(filenames), dirty_parents)
+            self._delete_childless_parents(transaction, dirty_parents)
+            self._compose_tags(transaction, dirty_parents)
+
+    def delete_orphans(self) -> None:
+        """Deletes mediums and albums without any tracks from the whole library.
+
+        Writes normally delete these as they go, so this is only needed to clean
+        up after something that bypassed them, e.g., manual edits to the
+        database. Albums that are left after their empty mediums are deleted
+        get their tags updated.
+        """
+        with self._write_transaction() as transaction:
+            dirty_parents = set()
+            for entity_id, parent_id in transaction.execute("""
+                    SELECT entity_id, parent_id
+                    FROM Entity
+                    WHERE filename IS NULL AND NOT EXISTS (
+                        SELECT 1
+                        FROM Entity AS Child
+                        WHERE Child.parent_id = Entity.entity_id
+                    )
+            """).fetchall():
+                dirty_parents.add(entity_id)
+                if parent_id is not None:
+                    dirty_parents.add(parent_id)
+            self._delete_childless_parents(transaction, dirty_parents)
+            self._compose_tags(transaction, dirty_parents)
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def file_fingerprints(
+            self,
+            root_dirname: str,
+            *,
+            snapshot: Optional[sqlite3_db.AbstractSnapshot] = None,
+    ) -> Mapping[str, scan.Fingerprint]:  # yapf: disable
+        """Returns the fingerprints of known files within a directory.
+
+        Args:
+            root_dirname: Absolute name of the directory, which is searched
+                recursively.
+            snapshot: Snapshot to reuse instead of starting a new one.
+
+        Returns:
+            Map from filename to fingerprint, for every file with a known
+            fingerprint.
+        """
+        with self._db.snapshot(snapshot) as snapshot_:
+            return {
+                filename: scan.Fingerprint(
+                    size=size,
+                    mtime_ns=mtime_ns,
+                    inode=inode,
+                    device=device,
+                ) for filename, size, mtime_ns, inode, device in
+                snapshot_.execute(
+                    """
+                    SELECT filename, size, mtime_ns, inode, device
+                    FROM File
+                    WHERE filename >= ? AND filename < ?
+                        AND size IS NOT NULL
+                    """,
+                    _filename_range(root_dirname),
+                )
+            }
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def file_partial_hashes(
+            self,
+            root_dirname: str,
+            *,
+            snapshot: Optional[sqlite3_db.AbstractSnapshot] = None,
+    ) -> Mapping[str, bytes]:  # yapf: disable
+        """Returns the partial hashes of known files within a directory.
+
+        Args:
+            root_dirname: Absolute name of the directory, which is searched
+                recursively.
+            snapshot: Snapshot to reuse instead of starting a new one.
+
+        Returns:
+            Map from filename to partial hash, for every file with a known
+            partial hash.
+        """
+        with self._db.snapshot(snapshot) as snapshot_:
+            return dict(
+                snapshot_.execute(
+                    """
+                    SELECT filename, partial_hash
+                    FROM File
+                    WHERE filename >= ? AND filename < ?
+                        AND partial_hash IS NOT NULL
+                    """,
+                    _filename_range(root_dirname),
+                ))
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def directories(
+            self,
+            root_dirname: str,
+            *,
+            snapshot: Optional[sqlite3_db.AbstractSnapshot] = None,
+    ) -> Mapping[str, scan.Directory]:  # yapf: disable
+        """Returns known directories.
+
+        Args:
+            root_dirname: Absolute name of the top-level directory to return,
+                along with all of its known subdirectories, recursively.
+            snapshot: Snapshot to reuse instead of starting a new one.
 
-    # TODO(dseomn): Add support for incremental updates instead of resetting and
-    # re-adding everything each time. As part of incremental updates, it might
-    # make sense to add a pubsub-like system so the database can publish tokens
-    # that have been added/deleted or that have modified data. Subscribers could
-    # then react accordingly without needing to poll the database.
+        Returns:
+            Map from dirname to directory.
+        """
+        with self._db.snapshot(snapshot) as snapshot_:
+            return {
+                dirname: scan.Directory(
+                    dirname=dirname,
+                    mtime_ns=mtime_ns,
+                    entry_count=entry_count,
+                ) for dirname, mtime_ns, entry_count in snapshot_.execute(
+                    """
+                    SELECT dirname, mtime_ns, entry_count
+                    FROM Directory
+                    WHERE dirname = ? OR (dirname >= ? AND dirname < ?)
+                    """,
+                    (root_dirname, *_filename_range(root_dirname)),
+                )
+            }
 
-    def __init__(
+    def _update_file(
             self,
+            transaction: sqlite3_db.Transaction,
+            file_info: Union[scan.File, scan.Directory],
             *,
-            database_dir: str,
-            reverse_unordered_selects: bool = False,
+            stale_filenames: Set[str],
+            stale_dirnames: Set[str],
+            dirty_parents: Set[int],
     ) -> None:
-        """Initializer.
+        """Updates a single file or directory, see update_files().
 
         Args:
-            database_dir: Directory containing databases.
-            reverse_unordered_selects: For tests only, see sqlite3_db.Database.
+            transaction: Transaction to use.
+            file_info: File or directory to update.
+            stale_filenames: Files that haven't been updated yet. This is
+                updated to remove file_info.
+            stale_dirnames: Directories that haven't been updated yet. This is
+                updated to remove file_info.
+            dirty_parents: See _insert_file().
         """
-        self._db = sqlite3_db.Database(
-            _SCHEMA,
-            database_dir=database_dir,
-            reverse_unordered_selects=reverse_unordered_selects,
-        )
-
-    def _get_tags(
-            self,
-            snapshot: sqlite3_db.AbstractSnapshot,
-            token_: str,
-    ) -> tag.Tags:
-        """Returns Tags for the given token."""
-        tags = collections.defaultdict(list)
-        # TODO(https://github.com/google/yapf/issues/792): Remove yapf disable.
-        for name, value in snapshot.execute(
+        if isinstance(file_info, scan.Directory):
+            stale_dirnames.discard(file_info.dirname)
+            transaction.execute(
                 """
-                SELECT tag_name, tag_value
-                FROM Tag
-                WHERE token = ?
-                ORDER BY tag_name, tag_value_order
+                INSERT OR REPLACE INTO Directory
+                    (dirname, mtime_ns, entry_count)
+                VALUES (?, ?, ?)
                 """,
-                (token_,)):  # yapf: disable
-            tags[name].append(value)
-        return tag.Tags(tags)
+                (
+                    file_info.dirname,
+                    file_info.mtime_ns,
+                    file_info.entry_count,
+                ),
+            )
+            return
+        if file_info.filename in stale_filenames:
+            stale_filenames.remove(file_info.filename)
+            if isinstance(file_info, scan.UnchangedFile):
+                return
+            self._delete_files(transaction, (file_info.filename,),
+                               dirty_parents)
+        elif isinstance(file_info, scan.UnchangedFile):
+            # The file is gone from the database, so it needs to be re-read on
+            # the next scan.
+            return
+        if isinstance(file_info, scan.MovedFile):
+            moved_file = self._moved_audio_file(transaction, file_info)
+            if moved_file is not None:
+                file_info = moved_file
+            else:
+                # The source is gone or changed, so its tags can't be reused.
+                try:
+                    file_info = scan.read_file(file_info)
+                except FileNotFoundError:
+                    return
+        self._insert_file(transaction, file_info, dirty_parents)
 
-    def _set_tags(
+    def inconsistent_tags(self) -> List[token.LibraryToken]:
+        """Returns entities whose serialized tags don't match the Tag table.
+
+        Both copies of an entity's tags are written in the same transaction, so
+        this should always be empty. It's for tests, and for checking databases
+        that might have been modified outside of this class.
+        """
+        inconsistent = []
+        with self._db.snapshot() as snapshot:
+            tag_groups = itertools.groupby(
+                snapshot.execute("""
+                    SELECT entity_id, tag_name, tag_value
+                    FROM Tag
+                    ORDER BY entity_id, tag_name, tag_value_order
+                """),
+                lambda row: row[0],
+            )
+            next_group = next(tag_groups, None)
+            for entity_id, token_str, token_type, tags_blob in snapshot.execute(
+                    'SELECT entity_id, token, type, tags FROM Entity '
+                    'ORDER BY entity_id'):
+                table_tags = collections.defaultdict(list)
+                if next_group is not None and next_group[0] == entity_id:
+                    for _, name, value in next_group[1]:
+                        table_tags[name].append(value)
+                    next_group = next(tag_groups, None)
+                if _decode_tags(tags_blob) != tag.Tags(table_tags):
+                    inconsistent.append(
+                        _TYPE_NAME_TO_TOKEN_TYPE[token_type](token_str))
+        return inconsistent
+
+    def _publish(self, message: pubsub.Message) -> None:
+        if self._pubsub_bus is not None:
+            self._pubsub_bus.publish(message)
+
+    def update_files(
             self,
-            transaction: sqlite3_db.Transaction,
-            token_: str,
-            tags: tag.Tags,
+            root_dirname: str,
+            files: Iterable[Union[scan.File, scan.Directory]],
+            *,
+            batch_size: int = _UPDATE_BATCH_SIZE,
+            batch_seconds: float = _UPDATE_BATCH_SECONDS,
     ) -> None:
-        """Sets Tags for the given token."""
-        transaction.execute('DELETE FROM Tag WHERE token = ?', (token_,))
-        for name, values in tags.items():
+        """Updates the library to match the files within a directory.
+
+        Files are read from the iterable in a background thread while they're
+        written to the database, in batches with a transaction for each batch.
+        After each transaction, UpdateProgress is published. If this fails
+        partway through, the batches that were already committed stay in the
+        database.
+
+        Args:
+            root_dirname: Absolute name of the directory that files came from,
+                e.g., by scanning it recursively. Any files or directories in
+                the database within this directory that are not in files are
+                deleted.
+            files: All files within root_dirname, and optionally directories
+                too. Files that are already in the database are replaced, except
+                that scan.UnchangedFile leaves the existing file as it is.
+                Tags for scan.MovedFile are copied from its source if it's still
+                in the database when the moved file is processed, or read from
+                the file otherwise.
+            batch_size: Max number of files and directories per transaction.
+            batch_seconds: Max time to wait for more files before committing a
+                batch.
+        """
+        with self._db.snapshot() as snapshot:
+            stale_filenames = {
+                filename for filename, in snapshot.execute(
+                    """
+                    SELECT filename
+                    FROM File
+                    WHERE filename >= ? AND filename < ?
+                    """,
+                    _filename_range(root_dirname),
+                )
+            }
+            stale_dirnames = set(
+                self.directories(root_dirname, snapshot=snapshot))
+        files_processed = 0
+        for batch in _batches(files,
+                              batch_size=batch_size,
+                              batch_seconds=batch_seconds):
+            with self._write_transaction(
+                    profile=self._ingest_profile) as transaction:
+                dirty_parents = set()
+                for file_info in batch:
+                    self._update_file(
+                        transaction,
+                        file_info,
+                        stale_filenames=stale_filenames,
+                        stale_dirnames=stale_dirnames,
+                        dirty_parents=dirty_parents,
+                    )
+                self._delete_childless_parents(transaction, dirty_parents)
+                self._compose_tags(transaction, dirty_parents)
+            files_processed += sum(
+                isinstance(file_info, scan.File) for file_info in batch)
+            self._publish(
+                UpdateProgress(
+                    root_dirname=root_dirname,
+                    files_processed=files_processed,
+                    done=False,
+                ))
+        with self._write_transaction(
+                profile=self._ingest_profile) as transaction:
             transaction.executemany(
-                """
-                INSERT INTO Tag (token, tag_name, tag_value_order, tag_value)
-                VALUES (?, ?, ?, ?)
-                """,
-                ((token_, name, order, value)
-                 for order, value in enumerate(values)),
+                'DELETE FROM Directory WHERE dirname = ?',
+                ((dirname,) for dirname in stale_dirnames),
             )
+            dirty_parents = set()
+            self._delete_files(transaction, stale_filenames, dirty_parents)
+            self._delete_childless_parents(transaction, dirty_parents)
+            self._compose_tags(transaction, dirty_parents)
+        self._publish(
+            UpdateProgress(
+                root_dirname=root_dirname,
+                files_processed=files_processed,
+                done=True,
+            ))
 
-    def _insert_audio_file(
+    def rescan(
             self,
-            transaction: sqlite3_db.Transaction,
-            file_info: scan.AudioFile,
+            root_dirname: str,
+            *,
+            workers: int = 1,
+            skip_unchanged_directories: bool = False,
+            changed_dirnames: Collection[str] = (),
     ) -> None:
-        """Inserts information about the given audio file.
+        """Scans a directory, and updates the library to match it.
+
+        Only files that are new or changed since the last scan are read. Files
+        that were moved or renamed within root_dirname keep their tags from
+        before the move, except for tags based on the filename.
 
         Args:
-            transaction: Transaction to use.
-            file_info: File to insert.
+            root_dirname: Directory to scan, recursively.
+            workers: See scan.scan().
+            skip_unchanged_directories: Whether to skip listing subdirectories
+                that are unchanged since the last scan, see known_directories in
+                scan.scan(). This avoids checking every file's fingerprint, but
+                it also misses files that were modified in place.
+            changed_dirnames: See scan.scan(). This is for finding files that
+                were modified in place, when skip_unchanged_directories is True.
+        """
+        root_dirname = os.path.abspath(root_dirname)
+        with self._db.snapshot() as snapshot:
+            known_fingerprints = self.file_fingerprints(root_dirname,
+                                                        snapshot=snapshot)
+            known_partial_hashes = self.file_partial_hashes(root_dirname,
+                                                            snapshot=snapshot)
+            if skip_unchanged_directories:
+                known_directories = self.directories(root_dirname,
+                                                     snapshot=snapshot)
+            else:
+                known_directories = frozendict.frozendict()
+        self.update_files(
+            root_dirname,
+            scan.scan(
+                root_dirname,
+                workers=workers,
+                known_fingerprints=known_fingerprints,
+                known_directories=known_directories,
+                known_partial_hashes=known_partial_hashes,
+                changed_dirnames=changed_dirnames,
+            ),
+        )
+
+    def _search_query(
+            self,
+            terms: Sequence[_SearchTerm],
+            *,
+            sort_by: Optional[collation.SortField],
+            after: Optional[Sequence[Any]],
+            limit: int,
+    ) -> Tuple[str, Sequence[Any]]:
+        """Returns the query and parameters for search_page() with terms.
+
+        Each row of the query's results is (token, type, *sort_key), where
+        sort_key is the value to use for after on the next page. See
+        search_page() for the other arguments.
         """
-        track_token = str(file_info.track.token)
-        medium_token = str(file_info.track.medium_token)
-        album_token = str(file_info.track.album_token)
-        transaction.executemany(
+        builder = sqlite3_db.QueryBuilder()
+        builder.append('WITH ')
+        for index, term in enumerate(terms):
+            # Each entity's score for a term is that of its best matching tag
+            # value. Lower is better.
+            builder.append(
+                f"""
+                {'' if index == 0 else ','} Term{index} (entity_id, score) AS (
+                    SELECT Tag.entity_id, min(TagSearch.rank)
+                    FROM TagSearch JOIN Tag ON Tag.tag_id = TagSearch.rowid
+                    WHERE TagSearch MATCH ?
+                """,
+                (term.match,),
+            )
+            if term.tag_name is not None:
+                builder.append('AND Tag.tag_name = ?', (term.tag_name,))
+            builder.append('GROUP BY Tag.entity_id)')
+        builder.append(f"""
+            , Result (entity_id, token, type, score, album_id) AS (
+                SELECT
+                    Entity.entity_id,
+                    Entity.token,
+                    Entity.type,
+                    {' + '.join(f'Term{index}.score'
+                                for index in range(len(terms)))},
+                    CASE Entity.type
+                        WHEN 'album' THEN Entity.entity_id
+                        WHEN 'medium' THEN Entity.parent_id
+                        ELSE Parent.parent_id
+                    END
+                FROM Term0
+                {' '.join(f'JOIN Term{index} USING (entity_id)'
+                          for index in range(1, len(terms)))}
+                JOIN Entity ON Entity.entity_id = Term0.entity_id
+                LEFT JOIN Entity AS Parent
+                    ON Parent.entity_id = Entity.parent_id
+            )
+        """)
+        if sort_by is not None:
+            self._append_sorted_query(builder,
+                                      'Result',
+                                      sort_by=sort_by,
+                                      after=after,
+                                      limit=limit)
+            return builder.build()
+        # Results are grouped by album, with each group ranked by its best
+        # result, and the album itself first within its group. That way, an
+        # album always outranks its own tracks.
+        builder.append("""
+            , Ranked (
+                entity_id, token, type, album_score, album_id, type_order, score
+            ) AS (
+                SELECT
+                    entity_id,
+                    token,
+                    type,
+                    min(score) OVER (PARTITION BY album_id),
+                    album_id,
+                    CASE type WHEN 'album' THEN 0 WHEN 'medium' THEN 1 ELSE 2
+                    END,
+                    score
+                FROM Result
+            )
+            SELECT
+                token, type, album_score, album_id, type_order, score, entity_id
+            FROM Ranked
+        """)
+        if after is not None:
+            builder.append(
+                """
+                WHERE (album_score, album_id, type_order, score, entity_id)
+                    > (?, ?, ?, ?, ?)
+                """,
+                after,
+            )
+        builder.append(
             """
-            INSERT OR IGNORE INTO Entity
-                (token, type, filename, parent_token, sort_key)
-            VALUES (:token, :type, :filename, :parent_token, :sort_key)
+            ORDER BY album_score, album_id, type_order, score, entity_id
+            LIMIT ?
             """,
-            (
-                {
-                    'token': album_token,
-                    'type': _EntityType.ALBUM.value,
-                    'filename': None,
-                    'parent_token': None,
-                    'sort_key': b'',
-                },
-                {
-                    'token': medium_token,
-                    'type': _EntityType.MEDIUM.value,
-                    'filename': None,
-                    'parent_token': album_token,
-                    'sort_key': file_info.track.medium_sort_key,
-                },
-                {
-                    'token': track_token,
-                    'type': _EntityType.TRACK.value,
-                    'filename': file_info.filename,
-                    'parent_token': medium_token,
-                    'sort_key': file_info.track.sort_key,
-                },
-            ),
+            (limit,),
         )
-        self._set_tags(transaction, track_token, file_info.track.tags)
+        return builder.build()
 
-    def _compose_tags(
+    def _append_sorted_query(
             self,
-            transaction: sqlite3_db.Transaction,
+            builder: sqlite3_db.QueryBuilder,
+            table: str,
             *,
-            child_type: _EntityType,
+            sort_by: collation.SortField,
+            after: Optional[Sequence[Any]],
+            limit: int,
     ) -> None:
-        """Updates tags of parent entities based on their children's tags.
+        """Appends a query for results sorted by a field.
 
         Args:
-            transaction: Transaction to use.
-            child_type: Which type of entity to update the parent's tags of.
+            builder: Builder to append to.
+            table: Table or common table expression with entity_id, token, and
+                type columns for the results.
+            sort_by: Field to sort by.
+            after: See search_page().
+            limit: Max number of results.
         """
-        for parent_token, rows in itertools.groupby(
-                transaction.execute(
-                    """
-                    SELECT parent_token, token
-                    FROM Entity
-                    WHERE type = ?
-                    ORDER BY parent_token
-                    """,
-                    (child_type.value,),
-                ),
-                lambda row: row[0],
-        ):
-            self._set_tags(
-                transaction,
-                parent_token,
-                tag.compose(
-                    tuple(
-                        self._get_tags(transaction, child_token)
-                        for _, child_token in rows)),
-            )
+        builder.append(
+            f"""
+            SELECT
+                {table}.token, {table}.type, SortKey.sort_key, SortKey.entity_id
+            FROM SortKey JOIN {table} ON {table}.entity_id = SortKey.entity_id
+            WHERE SortKey.sort_field = ?
+            """,
+            (sort_by.name,),
+        )
+        if after is not None:
+            builder.append('AND (SortKey.sort_key, SortKey.entity_id) > (?, ?)',
+                           after)
+        builder.append('ORDER BY SortKey.sort_key, SortKey.entity_id LIMIT ?',
+                       (limit,))
 
-    def insert_files(self, files: Iterable[scan.File]) -> None:
-        """Inserts information about the given files.
+    def _browse_query(
+            self,
+            *,
+            sort_by: Optional[collation.SortField],
+            after: Optional[Sequence[Any]],
+            limit: int,
+    ) -> Tuple[str, Sequence[Any]]:
+        """Returns the query and parameters for search_page() without terms.
+
+        See _search_query() for the format of the query's results.
+        """
+        builder = sqlite3_db.QueryBuilder()
+        if sort_by is not None:
+            self._append_sorted_query(builder,
+                                      'Entity',
+                                      sort_by=sort_by,
+                                      after=after,
+                                      limit=limit)
+            return builder.build()
+        builder.append('SELECT token, type, browse_key FROM Entity')
+        if after is not None:
+            builder.append('WHERE browse_key > ?', after)
+        builder.append('ORDER BY browse_key LIMIT ?', (limit,))
+        return builder.build()
+
+    def search_page(
+            self,
+            query: str = '',
+            *,
+            sort_by: Optional[collation.SortField] = None,
+            page_size: int = 100,
+            page_token: Optional[str] = None,
+    ) -> SearchPage:
+        """Searches for music in the library, one page at a time.
+
+        Pages are based on the sort order of the results instead of an offset,
+        so getting any page costs about the same as getting the first one. With
+        sort_by or without terms, changes to the library between pages don't
+        cause results to be skipped or repeated. When results are ordered by
+        relevance, changes can still shift that order between pages, since
+        relevance depends on the rest of the library.
+
+        TODO(dseomn): If an entity's ancestor is included in the search results,
+        don't include the descendant entity's token in the results.
 
         Args:
-            files: Files to insert into the database.
+            query: Whitespace-separated search terms, which must all match.
+                Each term matches any tag value that contains its words, with
+                the last word matching as a prefix. A term like 'artist:foo'
+                only matches values of the artist tag, and double quotes group
+                multiple words into one term, e.g., 'artist:"foo bar"'. Case
+                and diacritics are ignored. If there are no terms, everything
+                matches.
+            sort_by: Field to sort the results by, see collation.sort_key(),
+                or None for the default order.
+            page_size: Max number of results to return.
+            page_token: next_page_token from the previous page of the same
+                query and sort_by, or None for the first page.
+
+        Returns:
+            Page of tokens for entities that match the search terms. By default,
+            the most relevant results are first if there are terms. Without
+            terms, albums are in the order they were added to the library, and
+            each album is followed by its mediums and tracks in their natural
+            order.
 
         Raises:
-            sqlite3.IntegrityError: One or more files are already in the
-                database.
+            ValueError: The page token is invalid, or for a different query.
         """
-        # TODO(dseomn): Break this up into many smaller transactions, so that
-        # the user gets more feedback when (re)scanning the library.
-        with self._db.transaction() as transaction:
-            for file_info in files:
-                transaction.execute('INSERT INTO File (filename) VALUES (?)',
-                                    (file_info.filename,))
-                if isinstance(file_info, scan.AudioFile):
-                    self._insert_audio_file(transaction, file_info)
-            self._compose_tags(transaction, child_type=_EntityType.TRACK)
-            self._compose_tags(transaction, child_type=_EntityType.MEDIUM)
+        request = (query, None if sort_by is None else sort_by.name)
+        after = (None if page_token is None else _decode_page_token(
+            page_token, request))
+        terms = _search_terms(query)
+        # One extra result is requested to tell if there's a next page.
+        if terms:
+            sql, parameters = self._search_query(terms,
+                                                 sort_by=sort_by,
+                                                 after=after,
+                                                 limit=page_size + 1)
+        else:
+            sql, parameters = self._browse_query(sort_by=sort_by,
+                                                 after=after,
+                                                 limit=page_size + 1)
+        with self._db.snapshot() as snapshot:
+            rows = snapshot.execute(sql, parameters).fetchall()
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_page_token = _encode_page_token(request, rows[-1][2:])
+        else:
+            next_page_token = None
+        return SearchPage(
+            tokens=tuple(_TYPE_NAME_TO_TOKEN_TYPE[token_type](token_str)
+                         for token_str, token_type, *_ in rows),
+            next_page_token=next_page_token,
+        )
 
     def search(
             self,
+            query: str = '',
             *,
+            sort_by: Optional[collation.SortField] = None,
             limit: int = 100,
     ) -> Iterable[token.LibraryToken]:
         """Searches for music in the library.
 
-        TODO(dseomn): Add more function arguments to make this actually search
-        instead of returning everything.
-
-        TODO(dseomn): Make sorting more sensible than always using a random
-        order. Possibly default to sorting by entity ancestry, e.g., (album
-        token, medium order in album, medium token, track order in medium, track
-        token).
-
-        TODO(dseomn): Consider expanding the limit parameter into true
-        pagination. Figure out if (limit, offset) style or (page_token,
-        page_size) style makes more sense.
-
-        TODO(dseomn): If an entity's ancestor is included in the search results,
-        don't include the descendant entity's token in the results.
-
         Args:
+            query: See search_page().
+            sort_by: See search_page().
             limit: Max number of results to return.
 
         Returns:
-            Tokens for entities that match the search terms.
+            Tokens for entities that match the search terms, in the same order
+            as search_page().
         """
         # This returns a list instead of a generator to avoid bugs with nested
         # transactions, which sqlite3 doesn't support. With a generator, a loop
@@ -318,55 +2310,448 @@ class Database:
         #   for result in db.search()
         #       if isinstance(result, token.Track):
         #           db.track(result)
-        results = []
+        return list(
+            self.search_page(query, sort_by=sort_by, page_size=limit).tokens)
+
+    def _random_sample_by_id(
+            self,
+            snapshot: sqlite3_db.AbstractSnapshot,
+            count: int,
+            type_name: Optional[str],
+            rng: random.Random,
+    ) -> Optional[List[token.LibraryToken]]:
+        """Samples entities by looking up random IDs, see random_sample().
+
+        IDs are drawn uniformly from the range of IDs in the table, and draws
+        that miss (deleted IDs, other types, or entities already in the sample)
+        are rejected, so every entity is equally likely. This uses a statement
+        per batch of draws, and the batches grow with the miss rate.
+
+        Returns:
+            The sample, or None if too many draws missed.
+        """
+        # Separate subqueries let SQLite look up each end of the range, instead
+        # of scanning the whole table for both at once.
+        min_id, max_id = snapshot.execute("""
+            SELECT
+                (SELECT min(entity_id) FROM Entity),
+                (SELECT max(entity_id) FROM Entity)
+        """).fetchone()
+        if min_id is None:
+            return []
+        sample = {}
+        drawn = 0
+        while len(sample) < count:
+            if drawn >= _RANDOM_SAMPLE_MAX_DRAWS * count:
+                return None
+            needed = count - len(sample)
+            batch_size = min(
+                _MAX_IN_PARAMETERS,
+                -(-needed * (drawn + 1) // (len(sample) + 1)),
+            )
+            candidates = tuple(
+                rng.randint(min_id, max_id) for _ in range(batch_size))
+            drawn += batch_size
+            builder = sqlite3_db.QueryBuilder()
+            builder.append('SELECT entity_id, token, type FROM Entity WHERE')
+            if type_name is not None:
+                builder.append('type = ? AND', (type_name,))
+            builder.append('entity_id IN ' + _in_list(candidates), candidates)
+            found = {
+                entity_id: (token_str, entity_type)
+                for entity_id, token_str, entity_type in snapshot.execute(
+                    *builder.build())
+            }
+            for candidate in candidates:
+                if len(sample) == count:
+                    break
+                if candidate in found and candidate not in sample:
+                    sample[candidate] = found[candidate]
+        return [
+            _TYPE_NAME_TO_TOKEN_TYPE[entity_type](token_str)
+            for token_str, entity_type in sample.values()
+        ]
+
+    def _random_sample_by_scan(
+            self,
+            snapshot: sqlite3_db.AbstractSnapshot,
+            count: int,
+            type_name: Optional[str],
+            rng: random.Random,
+    ) -> List[token.LibraryToken]:
+        """Samples entities with a reservoir sample of the whole table."""
+        builder = sqlite3_db.QueryBuilder()
+        builder.append('SELECT token, type FROM Entity')
+        if type_name is not None:
+            builder.append('WHERE type = ?', (type_name,))
+        builder.append('ORDER BY entity_id')
+        sample = []
+        for index, row in enumerate(snapshot.execute(*builder.build())):
+            if index < count:
+                sample.append(row)
+            else:
+                replace_index = rng.randrange(index + 1)
+                if replace_index < count:
+                    sample[replace_index] = row
+        rng.shuffle(sample)
+        return [
+            _TYPE_NAME_TO_TOKEN_TYPE[entity_type](token_str)
+            for token_str, entity_type in sample
+        ]
+
+    def random_sample(
+            self,
+            count: int,
+            *,
+            token_type: Optional[Type[token.LibraryToken]] = None,
+            seed: Optional[int] = None,
+    ) -> List[token.LibraryToken]:
+        """Returns a random sample of entities, without replacement.
+
+        Every entity of the requested type is equally likely to be in the
+        sample. The work is proportional to count, not the size of the library,
+        except when count is close to the number of entities of the type, or the
+        type is very rare. Then this falls back to scanning the library.
+
+        Args:
+            count: Max number of entities to return. Fewer are returned if the
+                library doesn't have enough.
+            token_type: Type of entities to sample, e.g., token.Album, or None
+                for any type.
+            seed: Seed for the random number generator, for a deterministic
+                sample of the same library, or None for a random seed.
+
+        Returns:
+            Tokens of the sampled entities, in random order.
+        """
+        type_name = (None if token_type is None else
+                     _TOKEN_TYPE_TO_TYPE_NAME[token_type])
+        rng = random.Random(seed)
+        if count <= 0:
+            return []
         with self._db.snapshot() as snapshot:
-            # TODO(https://github.com/google/yapf/issues/792): Remove yapf
-            # disable.
-            for token_str, token_type in snapshot.execute(
+            sample = self._random_sample_by_id(snapshot, count, type_name, rng)
+            if sample is None:
+                sample = self._random_sample_by_scan(snapshot, count, type_name,
+                                                     rng)
+        return sample
+
+    def facet(
+            self,
+            tag_: tag.ArbitraryTag,
+            *,
+            token_type: Type[token.LibraryToken] = token.Track,
+            filter_by: Optional[Tuple[tag.ArbitraryTag, str]] = None,
+            limit: int = 100,
+    ) -> List[FacetValue]:
+        """Returns the most common values of a tag, with their counts.
+
+        Counts are maintained as the library changes, so this doesn't need to
+        read every entity with the tag. Filters by albumartist, artist, genre,
+        media, or the year derived from date, on facets of one of those same
+        tags, are counted in advance too. Other filters read the tags of every
+        entity that matches the filter.
+
+        Args:
+            tag_: Tag to return values of. Pseudo-tags that are specific to each
+                file, e.g., tag.FILENAME, are not supported.
+            token_type: Type of entities to count.
+            filter_by: (tag, value) to only count entities that have that value
+                of that tag, or None to count all entities.
+            limit: Max number of values to return.
+
+        Returns:
+            Values with the highest count first, ties broken by value. See
+            FacetValue.count for how values are counted.
+
+        Raises:
+            ValueError: The tag is not supported.
+        """
+        tag_name = tag_.name if isinstance(tag_, tag.Tag) else tag_
+        if tag_name in _UNFACETED_TAGS:
+            raise ValueError(f'Tag {tag_name!r} does not have facets.')
+        type_name = _TOKEN_TYPE_TO_TYPE_NAME[token_type]
+        if filter_by is None:
+            query = (
+                """
+                SELECT tag_value, entity_count
+                FROM FacetCount
+                WHERE type = ? AND tag_name = ?
+                ORDER BY entity_count DESC, tag_value
+                LIMIT ?
+                """,
+                (type_name, tag_name, limit),
+            )
+        else:
+            filter_tag, filter_value = filter_by
+            filter_name = (filter_tag.name
+                           if isinstance(filter_tag, tag.Tag) else filter_tag)
+            if (filter_name in _FACET_FILTER_TAGS and
+                    tag_name in _FACET_FILTER_TAGS):
+                query = (
+                    """
+                    SELECT tag_value, entity_count
+                    FROM FacetPairCount
+                    WHERE type = ? AND filter_name = ? AND filter_value = ?
+                        AND tag_name = ?
+                    ORDER BY entity_count DESC, tag_value
+                    LIMIT ?
+                    """,
+                    (type_name, filter_name, filter_value, tag_name, limit),
+                )
+            else:
+                # CROSS JOIN keeps SQLite from starting with every row of the
+                # faceted tag, which avoids sorting for GROUP BY but reads far
+                # more rows than the filter matches.
+                query = (
                     """
-                    SELECT token, type
+                    SELECT Value.tag_value, count(*) AS entity_count
+                    FROM Tag AS Filter
+                    CROSS JOIN Entity ON Entity.entity_id = Filter.entity_id
+                    CROSS JOIN Tag AS Value
+                        ON Value.entity_id = Filter.entity_id
+                    WHERE Filter.tag_name = ? AND Filter.tag_value = ?
+                        AND Entity.type = ? AND Value.tag_name = ?
+                    GROUP BY Value.tag_value
+                    ORDER BY entity_count DESC, Value.tag_value
+                    LIMIT ?
+                    """,
+                    (filter_name, filter_value, type_name, tag_name, limit),
+                )
+        with self._db.snapshot() as snapshot:
+            return [
+                FacetValue(value=value, count=count)
+                for value, count in snapshot.execute(*query)
+            ]
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def _filter_selectivity(
+            self,
+            snapshot: sqlite3_db.AbstractSnapshot,
+    ) -> Callable[[query_lib.Node], float]:  # yapf: disable
+        """Returns a function to estimate the selectivity of query nodes.
+
+        Exact values of faceted tags are estimated from FacetCount, and other
+        nodes use query_lib.default_selectivity().
+        """
+        min_id, max_id = snapshot.execute("""
+            SELECT
+                (SELECT min(entity_id) FROM Entity),
+                (SELECT max(entity_id) FROM Entity)
+        """).fetchone()
+        entity_count = 1 if min_id is None else max_id - min_id + 1
+
+        def estimate(node: query_lib.Node) -> float:
+            if (not isinstance(node, query_lib.Compare) or
+                    node.operator is not query_lib.Operator.EQ or
+                    node.tag_name in _UNFACETED_TAGS):
+                return query_lib.default_selectivity(node)
+            (count,) = snapshot.execute(
+                f"""
+                SELECT total(entity_count)
+                FROM FacetCount
+                WHERE type IN {_sql_list(_TYPE_NAME_TO_TOKEN_TYPE)}
+                    AND tag_name = ? AND tag_value = ?
+                """,
+                (node.tag_name, node.value),
+            ).fetchone()
+            return min(1.0, count / entity_count)
+
+        return estimate
+
+    def filter(
+            self,
+            query_: str,
+            *,
+            token_type: Optional[Type[token.LibraryToken]] = None,
+            sort_by: Optional[collation.SortField] = None,
+            limit: int = 100,
+    ) -> List[token.LibraryToken]:
+        """Returns entities that match a query on their tags.
+
+        Unlike search(), the query can compare values, e.g., for smart
+        playlists. It's compiled into a single SQL statement, with the terms
+        that are expected to match the fewest entities evaluated first.
+
+        Args:
+            query_: Query, see the query module for the syntax.
+            token_type: Type of entities to return, e.g., token.Track, or None
+                for any type.
+            sort_by: Field to sort the results by, see collation.sort_key(), or
+                None to sort them like search() without any terms.
+            limit: Max number of results to return.
+
+        Returns:
+            Tokens for entities that match the query.
+
+        Raises:
+            ValueError: The query is invalid.
+        """
+        parsed = query_lib.parse(query_)
+        with self._db.snapshot() as snapshot:
+            condition = query_lib.compile_condition(
+                query_lib.optimize(parsed, self._filter_selectivity(snapshot)))
+            builder = sqlite3_db.QueryBuilder()
+            builder.append("""
+                WITH Result (entity_id, token, type, browse_key) AS (
+                    SELECT entity_id, token, type, browse_key
                     FROM Entity
-                    ORDER BY random()
+                    WHERE
+            """)
+            builder.append(*condition)
+            if token_type is not None:
+                builder.append('AND type = ?',
+                               (_TOKEN_TYPE_TO_TYPE_NAME[token_type],))
+            builder.append(')')
+            if sort_by is None:
+                builder.append(
+                    """
+                    SELECT token, type FROM Result
+                    ORDER BY browse_key
                     LIMIT ?
                     """,
                     (limit,),
-            ):  # yapf: disable
-                results.append(_TYPE_NAME_TO_TOKEN_TYPE[token_type](token_str))
-        return results
+                )
+            else:
+                self._append_sorted_query(builder,
+                                          'Result',
+                                          sort_by=sort_by,
+                                          after=None,
+                                          limit=limit)
+            rows = snapshot.execute(*builder.build()).fetchall()
+        return [
+            _TYPE_NAME_TO_TOKEN_TYPE[token_type_name](token_str)
+            for token_str, token_type_name, *_ in rows
+        ]
 
-    def _require_token_exists(
+    def _entity_tree(
             self,
             snapshot: sqlite3_db.AbstractSnapshot,
-            token_: str,
+            tokens: Sequence[str],
             token_type: _EntityType,
-    ) -> None:
-        """Raises KeyError if the specified token does not exist."""
-        # TODO(dseomn): Optimize callers of this function to avoid calling it
-        # when they got the token from the database in the same transaction.
-        if snapshot.execute('SELECT 1 FROM Entity WHERE token = ? AND type = ?',
-                            (token_, token_type.value)).fetchone() is None:
-            raise KeyError(token_)
+    ) -> _EntityTree:
+        """Loads entities and all of their descendants.
+
+        This uses a single query per chunk of tokens, regardless of how many
+        descendants there are.
+
+        Args:
+            snapshot: Snapshot to use.
+            tokens: Tokens of the entities at the roots of the tree.
+            token_type: Type of the entities at the roots of the tree.
+
+        Raises:
+            KeyError: Any of the specified entities do not exist.
+        """
+        root_tokens = frozenset(tokens)
+        root_ids = {}
+        child_ids = collections.defaultdict(list)
+        tags = {}
+        for chunk in _chunks(root_tokens):
+            builder = sqlite3_db.QueryBuilder()
+            builder.append(
+                """
+                WITH RECURSIVE Tree (entity_id) AS (
+                    SELECT entity_id FROM Entity WHERE type = ? AND token IN
+                """,
+                (token_type.value,),
+            )
+            builder.append(_in_list(chunk), chunk)
+            # CROSS JOIN keeps the (small) tree as the outer loop. Otherwise,
+            # SQLite can choose to scan the whole table in index order to avoid
+            # sorting the results.
+            builder.append("""
+                    UNION ALL
+                    SELECT Entity.entity_id
+                    FROM Tree JOIN Entity ON Entity.parent_id = Tree.entity_id
+                )
+                SELECT
+                    Entity.entity_id, Entity.token, Entity.parent_id,
+                    Entity.tags
+                FROM Tree CROSS JOIN Entity ON Entity.entity_id = Tree.entity_id
+                ORDER BY Entity.sort_key, Entity.token
+            """)
+            for entity_id, entity_token, parent_id, tags_blob in (
+                    snapshot.execute(*builder.build())):
+                if entity_token in root_tokens:
+                    root_ids[entity_token] = entity_id
+                else:
+                    child_ids[parent_id].append(entity_id)
+                tags[entity_id] = _decode_tags(tags_blob)
+        for token_ in tokens:
+            if token_ not in root_ids:
+                raise KeyError(token_)
+        return _EntityTree(root_ids=root_ids, child_ids=child_ids, tags=tags)
 
     # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
-    def _children(
+    def _entities(
             self,
-            snapshot: sqlite3_db.AbstractSnapshot,
-            token_: str,
+            tokens: Iterable[token.AnyLibraryToken],
+            token_type: _EntityType,
+            build: Callable[[_EntityTree, int], _AnyEntity],
+            snapshot: Optional[sqlite3_db.AbstractSnapshot],
+    ) -> Mapping[token.AnyLibraryToken, _AnyEntity]:  # yapf: disable
+        """Returns entities, from the cache where possible.
+
+        Args:
+            tokens: Which entities to return.
+            token_type: Type of the entities.
+            build: Function to build an entity object from the tree and ID.
+            snapshot: Snapshot to reuse, or None. The cache is bypassed when
+                this is not None, since the snapshot might not match the latest
+                committed data.
+
+        Raises:
+            KeyError: Any of the specified entities do not exist.
+        """
+        tokens = tuple(tokens)
+        if snapshot is not None:
+            tree = self._entity_tree(snapshot, tuple(map(str, tokens)),
+                                     token_type)
+            return {
+                token_: build(tree, tree.root_ids[str(token_)])
+                for token_ in tokens
+            }
+        entities = {}
+        missing = []
+        for token_ in tokens:
+            cached = self._cache.get(str(token_))
+            if cached is None:
+                missing.append(token_)
+            else:
+                entities[token_] = cached
+        if missing:
+            generation = self._cache.generation
+            with self._db.snapshot() as snapshot_:
+                tree = self._entity_tree(snapshot_, tuple(map(str, missing)),
+                                         token_type)
+            # TODO(dseomn): Do something if the returned token is different?
+            for token_ in missing:
+                entities[token_] = build(tree, tree.root_ids[str(token_)])
+                self._cache.put(str(token_), entities[token_], generation)
+        return {token_: entities[token_] for token_ in tokens}
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def tracks(
+            self,
+            tokens: Iterable[token.Track],
             *,
-            child_type: _EntityType,
-    ) -> Generator[token.LibraryToken, None, None]:  # yapf: disable
-        """Yields the given token's child tokens, in order."""
-        # TODO(https://github.com/google/yapf/issues/792): Remove yapf disable.
-        for (child_token,) in snapshot.execute(
-                """
-                SELECT token
-                FROM Entity
-                WHERE parent_token = ? AND type = ?
-                ORDER BY sort_key, token
-                """,
-                (token_, child_type.value),
-        ):  # yapf: disable
-            yield _TYPE_NAME_TO_TOKEN_TYPE[child_type.value](child_token)
+            snapshot: Optional[sqlite3_db.AbstractSnapshot] = None,
+    ) -> Mapping[token.Track, entity.Track]:  # yapf: disable
+        """Returns the specified tracks.
+
+        Args:
+            tokens: Which tracks to return.
+            snapshot: Snapshot to reuse instead of starting a new one.
+
+        Returns:
+            Map from each of the tokens to its track.
+
+        Raises:
+            KeyError: There's no track with one of the given tokens.
+        """
+        return self._entities(tokens, _EntityType.TRACK, _EntityTree.track,
+                              snapshot)
 
     # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
     def track(
@@ -384,11 +2769,29 @@ class Database:
         Raises:
             KeyError: There's no track with the given token.
         """
-        with self._db.snapshot(snapshot) as snapshot_:
-            self._require_token_exists(snapshot_, str(token_),
-                                       _EntityType.TRACK)
-            # TODO(dseomn): Do something if the returned token is different?
-            return entity.Track(tags=self._get_tags(snapshot_, str(token_)))
+        return self.tracks((token_,), snapshot=snapshot)[token_]
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def mediums(
+            self,
+            tokens: Iterable[token.Medium],
+            *,
+            snapshot: Optional[sqlite3_db.AbstractSnapshot] = None,
+    ) -> Mapping[token.Medium, entity.Medium]:  # yapf: disable
+        """Returns the specified mediums.
+
+        Args:
+            tokens: Which mediums to return.
+            snapshot: Snapshot to reuse instead of starting a new one.
+
+        Returns:
+            Map from each of the tokens to its medium.
+
+        Raises:
+            KeyError: There's no medium with one of the given tokens.
+        """
+        return self._entities(tokens, _EntityType.MEDIUM, _EntityTree.medium,
+                              snapshot)
 
     # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
     def medium(
@@ -406,19 +2809,29 @@ class Database:
         Raises:
             KeyError: There's no medium with the given token.
         """
-        with self._db.snapshot(snapshot) as snapshot_:
-            self._require_token_exists(snapshot_, str(token_),
-                                       _EntityType.MEDIUM)
-            track_token_generator = self._children(snapshot_,
-                                                   str(token_),
-                                                   child_type=_EntityType.TRACK)
-            # TODO(dseomn): Do something if the returned token is different?
-            return entity.Medium(
-                tags=self._get_tags(snapshot_, str(token_)),
-                tracks=tuple(
-                    self.track(track_token, snapshot=snapshot_)
-                    for track_token in track_token_generator),
-            )
+        return self.mediums((token_,), snapshot=snapshot)[token_]
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def albums(
+            self,
+            tokens: Iterable[token.Album],
+            *,
+            snapshot: Optional[sqlite3_db.AbstractSnapshot] = None,
+    ) -> Mapping[token.Album, entity.Album]:  # yapf: disable
+        """Returns the specified albums.
+
+        Args:
+            tokens: Which albums to return.
+            snapshot: Snapshot to reuse instead of starting a new one.
+
+        Returns:
+            Map from each of the tokens to its album.
+
+        Raises:
+            KeyError: There's no album with one of the given tokens.
+        """
+        return self._entities(tokens, _EntityType.ALBUM, _EntityTree.album,
+                              snapshot)
 
     # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
     def album(
@@ -436,15 +2849,4 @@ class Database:
         Raises:
             KeyError: There's no album with the given token.
         """
-        with self._db.snapshot(snapshot) as snapshot_:
-            self._require_token_exists(snapshot_, str(token_),
-                                       _EntityType.ALBUM)
-            medium_token_generator = self._children(
-                snapshot_, str(token_), child_type=_EntityType.MEDIUM)
-            # TODO(dseomn): Do something if the returned token is different?
-            return entity.Album(
-                tags=self._get_tags(snapshot_, str(token_)),
-                mediums=tuple(
-                    self.medium(medium_token, snapshot=snapshot_)
-                    for medium_token in medium_token_generator),
-            )
+        return self.albums((token_,), snapshot=snapshot)[token_]
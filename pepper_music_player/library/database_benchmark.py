@@ -0,0 +1,702 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for pepper_music_player.library.database.
+
+Run with:
+    python -m pepper_music_player.library.database_benchmark
+"""
+
+import collections
+import contextlib
+import dataclasses
+import itertools
+import os
+import tempfile
+import time
+from typing import Generator, Iterable, Optional
+
+from pepper_music_player.library import database
+from pepper_music_player.library import query
+from pepper_music_player.library import scan
+from pepper_music_player.metadata import collation
+from pepper_music_player.metadata import entity
+from pepper_music_player.metadata import tag
+from pepper_music_player.metadata import token
+from pepper_music_player import sqlite3_db
+from pepper_music_player import sqlite3_db_testlib
+
+_ALBUM_COUNT = 2000
+_TRACKS_PER_ALBUM = 10
+
+# Number of albums in the library for benchmark_search().
+_SEARCH_ALBUM_COUNT = 20000
+
+
+def _audio_files(
+        album_index: int,
+        *,
+        album_title: str = 'Album',
+) -> Iterable[scan.AudioFile]:
+    """Yields the audio files for one synthetic album."""
+    dirname = f'/library/album{album_index}'
+    for track_index in range(_TRACKS_PER_ALBUM):
+        basename = f'{track_index}.flac'
+        filename = f'{dirname}/{basename}'
+        yield scan.AudioFile(
+            filename=filename,
+            dirname=dirname,
+            basename=basename,
+            fingerprint=None,
+            track=entity.Track(tags=tag.Tags({
+                tag.ALBUM: (f'{album_title} {album_index}',),
+                tag.ARTIST: (f'Artist {album_index}',),
+                tag.DATE: (str(1950 + album_index % 70),),
+                tag.GENRE: (f'Genre {album_index % 20}',),
+                tag.TITLE: (f'Track {track_index}',),
+                tag.TRACKNUMBER: (str(track_index + 1),),
+                tag.DURATION_SECONDS: ('180.0',),
+                tag.BASENAME: (basename,),
+                tag.DIRNAME: (dirname,),
+                tag.FILENAME: (filename,),
+            }).derive()),
+        )
+
+
+@contextlib.contextmanager
+def _timer(description: str) -> Generator[None, None, None]:
+    start = time.perf_counter()
+    yield
+    print(f'{description}: {time.perf_counter() - start:.3f}s')
+
+
+def _legacy_compose_tags(
+        library_db: database.Database,
+        transaction,
+        child_type: database._EntityType,
+) -> None:
+    """Composes tags of all parents the way Database used to."""
+    for parent_id, rows in itertools.groupby(
+            transaction.execute(
+                """
+                SELECT parent_id, entity_id
+                FROM Entity
+                WHERE type = ?
+                ORDER BY parent_id
+                """,
+                (child_type.value,),
+            ),
+            lambda row: row[0],
+    ):
+        library_db._set_tags(  # pylint: disable=protected-access
+            transaction,
+            parent_id,
+            tag.compose(
+                tuple(
+                    library_db._get_tags(transaction, child_id)  # pylint: disable=protected-access
+                    for _, child_id in rows)),
+        )
+
+
+def benchmark_compose() -> None:
+    """Prints the time to compose parent tags in various ways."""
+    print(f'{_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        library_db = database.Database(database_dir=database_dir)
+        with _timer('insert_files'):
+            library_db.insert_files(
+                itertools.chain.from_iterable(
+                    _audio_files(album_index)
+                    for album_index in range(_ALBUM_COUNT)))
+        with library_db._db.snapshot() as snapshot:  # pylint: disable=protected-access
+            parent_ids = tuple(entity_id for entity_id, in snapshot.execute(
+                "SELECT entity_id FROM Entity WHERE type != 'track'"))
+        with _timer('legacy compose of all parents, as every update used to'):
+            with library_db._write_transaction() as transaction:  # pylint: disable=protected-access
+                _legacy_compose_tags(library_db, transaction,
+                                     database._EntityType.TRACK)  # pylint: disable=protected-access
+                _legacy_compose_tags(library_db, transaction,
+                                     database._EntityType.MEDIUM)  # pylint: disable=protected-access
+        with _timer('set-based compose of all parents, all unchanged'):
+            with library_db._write_transaction() as transaction:  # pylint: disable=protected-access
+                library_db._compose_tags(transaction, parent_ids)  # pylint: disable=protected-access
+        with _timer('update_files of one changed album'):
+            library_db.update_files(
+                '/library/album0',
+                _audio_files(0, album_title='Changed'),
+            )
+
+
+def benchmark_album() -> None:
+    """Prints the latency of loading an album, with and without the cache."""
+    for cache_size in (0, database._CACHE_SIZE):  # pylint: disable=protected-access
+        with tempfile.TemporaryDirectory() as database_dir:
+            library_db = database.Database(database_dir=database_dir,
+                                           cache_size=cache_size)
+            album_files = tuple(_audio_files(0))
+            library_db.insert_files(album_files)
+            album_token = album_files[0].track.album_token
+            iterations = 1000
+            start = time.perf_counter()
+            for _ in range(iterations):
+                library_db.album(album_token)
+            elapsed = time.perf_counter() - start
+            print(f'album() with {_TRACKS_PER_ALBUM} tracks, '
+                  f'cache_size={cache_size}: '
+                  f'{elapsed / iterations * 1000:.3f}ms, '
+                  f'{library_db.cache_info()}')
+
+
+def _track_from_tag_rows(snapshot, track_token: str) -> entity.Track:
+    """Loads a track from the Tag table, the way Database used to."""
+    tags = collections.defaultdict(list)
+    # TODO(https://github.com/google/yapf/issues/792): Remove yapf disable.
+    for name, value in snapshot.execute(
+            """
+            SELECT tag_name, tag_value
+            FROM Entity JOIN Tag USING (entity_id)
+            WHERE Entity.token = ?
+            ORDER BY tag_name, tag_value_order
+            """,
+            (track_token,),
+    ):  # yapf: disable
+        tags[name].append(value)
+    return entity.Track(tags=tag.Tags(tags))
+
+
+def _track_from_serialized_tags(snapshot, track_token: str) -> entity.Track:
+    """Loads a track from Entity.tags, with the same query shape as above."""
+    (tags_blob,) = snapshot.execute(
+        'SELECT tags FROM Entity WHERE token = ?',
+        (track_token,),
+    ).fetchone()
+    return entity.Track(tags=database._decode_tags(tags_blob))  # pylint: disable=protected-access
+
+
+def benchmark_track_load() -> None:
+    """Prints the latency of loading tracks, compared to using Tag rows."""
+    with tempfile.TemporaryDirectory() as database_dir:
+        library_db = database.Database(database_dir=database_dir, cache_size=0)
+        files = tuple(
+            itertools.chain.from_iterable(
+                _audio_files(album_index) for album_index in range(100)))
+        library_db.insert_files(files)
+        track_tokens = tuple(file_info.track.token for file_info in files)
+        for load_track in (_track_from_tag_rows, _track_from_serialized_tags):
+            start = time.perf_counter()
+            for track_token in track_tokens:
+                with library_db._db.snapshot() as snapshot:  # pylint: disable=protected-access
+                    load_track(snapshot, str(track_token))
+            elapsed = time.perf_counter() - start
+            print(f'{load_track.__name__}: '
+                  f'{elapsed / len(track_tokens) * 1000:.3f}ms')
+        start = time.perf_counter()
+        for track_token in track_tokens:
+            library_db.track(track_token)
+        elapsed = time.perf_counter() - start
+        print(f'track(): {elapsed / len(track_tokens) * 1000:.3f}ms')
+        with _timer(f'tracks() of {len(track_tokens)} tracks'):
+            library_db.tracks(track_tokens)
+
+
+def benchmark_profiles() -> None:
+    """Prints the effect of sqlite3_db profiles on ingest and lookup."""
+    print(f'{_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    for description, profile, ingest_profile in (
+        ('SQLite defaults', sqlite3_db.Profile(), None),
+        ('interactive', sqlite3_db.INTERACTIVE, None),
+        ('interactive with bulk ingest', sqlite3_db.INTERACTIVE,
+         sqlite3_db.BULK_INGEST),
+        ('bulk ingest', sqlite3_db.BULK_INGEST, None),
+    ):
+        with tempfile.TemporaryDirectory() as database_dir:
+            library_db = database.Database(
+                database_dir=database_dir,
+                cache_size=0,
+                profile=profile,
+                ingest_profile=ingest_profile,
+            )
+            files = tuple(
+                itertools.chain.from_iterable(
+                    _audio_files(album_index)
+                    for album_index in range(_ALBUM_COUNT)))
+            # Small batches, like a scan that finds files slowly, show the cost
+            # of committing each transaction.
+            with _timer(f'{description}: update_files'):
+                library_db.update_files('/library', files, batch_size=100)
+            track_tokens = tuple(
+                file_info.track.token for file_info in files[::97])
+            start = time.perf_counter()
+            for track_token in track_tokens:
+                library_db.track(track_token)
+            elapsed = time.perf_counter() - start
+            print(f'{description}: track(): '
+                  f'{elapsed / len(track_tokens) * 1000:.3f}ms')
+            with _timer(f'{description}: search()'):
+                library_db.search('Album 123')
+
+
+def _print_page_latencies(
+        library_db: database.Database,
+        sort_by: Optional[collation.SortField] = None,
+) -> None:
+    """Prints the latency of the first and last pages of the whole library."""
+    page_latencies = []
+    page_token = None
+    while True:
+        start = time.perf_counter()
+        page = library_db.search_page(sort_by=sort_by, page_token=page_token)
+        page_latencies.append(time.perf_counter() - start)
+        page_token = page.next_page_token
+        if page_token is None:
+            break
+    print(f'search_page(sort_by={sort_by}) first of {len(page_latencies)} '
+          f'pages: {page_latencies[0] * 1000:.3f}ms, last page: '
+          f'{page_latencies[-1] * 1000:.3f}ms')
+
+
+def benchmark_search() -> None:
+    """Prints the latency of searching, compared to a LIKE scan, and paging."""
+    print(f'{_SEARCH_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        library_db = database.Database(database_dir=database_dir)
+        with _timer('insert_files'):
+            library_db.insert_files(
+                itertools.chain.from_iterable(
+                    _audio_files(album_index)
+                    for album_index in range(_SEARCH_ALBUM_COUNT)))
+        for query_str, like_pattern in (
+            ('Album 12345', '%Album 12345%'),
+            ('artist:"Artist 123"', '%Artist 123%'),
+            ('album 1 track 9', '%Album 1%'),
+        ):
+            with _timer(f'LIKE {like_pattern!r}'):
+                with library_db._db.snapshot() as snapshot:  # pylint: disable=protected-access
+                    snapshot.execute(
+                        'SELECT DISTINCT entity_id FROM Tag '
+                        'WHERE tag_value LIKE ?',
+                        (like_pattern,),
+                    ).fetchall()
+            with _timer(f'search({query_str!r})'):
+                library_db.search(query_str)
+        _print_page_latencies(library_db)
+        for sort_by in collation.SortField:
+            _print_page_latencies(library_db, sort_by=sort_by)
+
+
+def benchmark_filter() -> None:
+    """Prints the latency of filter(), with and without optimizing queries."""
+    print(f'{_SEARCH_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        library_db = database.Database(database_dir=database_dir)
+        library_db.insert_files(
+            itertools.chain.from_iterable(
+                _audio_files(album_index)
+                for album_index in range(_SEARCH_ALBUM_COUNT)))
+        # Enough for every entity to match, so no query is cut short.
+        limit = _SEARCH_ALBUM_COUNT * _TRACKS_PER_ALBUM * 2
+        for query_str in (
+                'has:genre artist="Artist 123"',
+                'NOT genre="Genre 3" ~parsed_year=1990..1995',
+                'genre="Genre 1" album:"Album 10"',
+                '~parsed_tracknumber<3 (genre="Genre 1" OR genre="Genre 2")',
+        ):
+            condition = query.compile_condition(query.parse(query_str))
+            with _timer(f'unoptimized {query_str!r}'):
+                with library_db._db.snapshot() as snapshot:  # pylint: disable=protected-access
+                    snapshot.execute(
+                        f'SELECT token FROM Entity WHERE {condition[0]}',
+                        condition[1],
+                    ).fetchall()
+            with _timer(f'filter({query_str!r})'):
+                library_db.filter(query_str, limit=limit)
+
+
+def benchmark_statements() -> None:
+    """Prints the latency and query plan problems of read statements."""
+    print(f'{_SEARCH_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        database.Database(database_dir=database_dir).insert_files(
+            itertools.chain.from_iterable(
+                _audio_files(album_index)
+                for album_index in range(_SEARCH_ALBUM_COUNT)))
+        with sqlite3_db_testlib.record_statements() as statements:
+            library_db = database.Database(database_dir=database_dir,
+                                           cache_size=0)
+            track = next(_audio_files(0)).track
+            library_db.track(track.token)
+            library_db.medium(track.medium_token)
+            library_db.album(track.album_token)
+            library_db.search('Album 12345')
+            page = library_db.search_page()
+            library_db.search_page(page_token=page.next_page_token)
+            library_db.search_page(sort_by=collation.SortField.ALBUM)
+            library_db.facet(tag.ARTIST)
+            library_db.facet(tag.ARTIST, filter_by=(tag.GENRE, 'Genre 1'))
+            library_db.facet(tag.ARTIST, filter_by=(tag.ALBUM, 'Album 1'))
+            library_db.filter('genre="Genre 1" ~parsed_year=1990..1995')
+            library_db.random_sample(100)
+        for statement, latency in sqlite3_db_testlib.statement_latencies(
+                statements):
+            problems = sqlite3_db_testlib.plan_problems(
+                sqlite3_db_testlib.query_plan(statement))
+            print(f'{latency:.6f}s: {statement.normalized_sql[:100]}')
+            if problems:
+                print(f'    {problems}')
+
+
+def benchmark_instrumentation() -> None:
+    """Prints the overhead of sqlite3_db.Instrumentation and what it records."""
+    print(f'{_SEARCH_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        database.Database(database_dir=database_dir).insert_files(
+            itertools.chain.from_iterable(
+                _audio_files(album_index)
+                for album_index in range(_SEARCH_ALBUM_COUNT)))
+        track_tokens = tuple(
+            next(_audio_files(album_index)).track.token
+            for album_index in range(0, _SEARCH_ALBUM_COUNT, 97))
+        instrumentation = sqlite3_db.Instrumentation(
+            slow_statement_seconds=None,
+            slow_transaction_seconds=None,
+        )
+        for description, instrumentation_ in (
+            ('uninstrumented', None),
+            ('instrumented', instrumentation),
+        ):
+            library_db = database.Database(
+                database_dir=database_dir,
+                cache_size=0,
+                instrumentation=instrumentation_,
+            )
+            start = time.perf_counter()
+            for track_token in track_tokens:
+                library_db.track(track_token)
+            elapsed = time.perf_counter() - start
+            print(f'{description}: track(): '
+                  f'{elapsed / len(track_tokens) * 1000:.3f}ms')
+            with _timer(f'{description}: search_page()'):
+                library_db.search_page(page_size=1000)
+        for stats in instrumentation.statements()[:10]:
+            print(f'{stats.latency.total_seconds:.6f}s total, '
+                  f'{stats.latency.count} runs, '
+                  f'p99 {stats.latency.p99_seconds:.6f}s, {stats.rows} rows: '
+                  f'{stats.sql[:100]}')
+
+
+def benchmark_migration() -> None:
+    """Prints the time to migrate the library, compared to inserting it."""
+    print(f'{_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        # This doesn't include reading audio files, so a rescan is even slower.
+        with _timer('insert_files()'):
+            database.Database(database_dir=database_dir).insert_files(
+                itertools.chain.from_iterable(
+                    _audio_files(album_index)
+                    for album_index in range(_ALBUM_COUNT)))
+        schema = database._SCHEMA  # pylint: disable=protected-access
+        progress = []
+        with _timer('migration'):
+            sqlite3_db.Database(
+                dataclasses.replace(
+                    schema,
+                    version='vbenchmark',
+                    migrations=(sqlite3_db.Migration(
+                        from_version=schema.version,
+                        to_version='vbenchmark',
+                        steps=(
+                            'ALTER TABLE Tag ADD COLUMN folded_value TEXT',
+                            'UPDATE Tag SET folded_value = lower(tag_value)',
+                            'CREATE INDEX Tag_FoldedIndex '
+                            'ON Tag (tag_name, folded_value)',
+                            "INSERT INTO TagSearch (TagSearch) "
+                            "VALUES ('rebuild')",
+                        ),
+                    ),),
+                ),
+                database_dir=database_dir,
+                migration_callback=lambda item: progress.append(
+                    (item, time.perf_counter())),
+            )
+        steps = zip(progress, progress[1:])
+        for (_, previous_time), (item, item_time) in steps:
+            print(f'step {item.steps_done}/{item.steps_total} '
+                  f'done={item.done}: {item_time - previous_time:.3f}s')
+
+
+def benchmark_random_sample() -> None:
+    """Prints the latency of random_sample(), compared to ORDER BY random()."""
+    print(f'{_SEARCH_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        library_db = database.Database(database_dir=database_dir)
+        library_db.insert_files(
+            itertools.chain.from_iterable(
+                _audio_files(album_index)
+                for album_index in range(_SEARCH_ALBUM_COUNT)))
+        for type_name, token_type in (
+            (None, None),
+            (database._EntityType.ALBUM.value, token.Album),  # pylint: disable=protected-access
+        ):
+            with _timer(f'ORDER BY random() LIMIT 100, type={type_name}'):
+                with library_db._db.snapshot() as snapshot:  # pylint: disable=protected-access
+                    snapshot.execute(
+                        """
+                        SELECT token FROM Entity
+                        WHERE ? IS NULL OR type = ?
+                        ORDER BY random()
+                        LIMIT 100
+                        """,
+                        (type_name, type_name),
+                    ).fetchall()
+            type_label = None if token_type is None else token_type.__name__
+            with _timer(f'random_sample(100, token_type={type_label})'):
+                library_db.random_sample(100, token_type=token_type)
+
+
+def benchmark_facets() -> None:
+    """Prints the latency of facets, compared to GROUP BY, and ingest cost."""
+    print(f'{_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    for facet_triggers in (False, True):
+        with tempfile.TemporaryDirectory() as database_dir:
+            library_db = database.Database(database_dir=database_dir)
+            if not facet_triggers:
+                with library_db._db.transaction() as transaction:  # pylint: disable=protected-access
+                    for trigger in ('Tag_InsertFacet', 'Tag_DeleteFacet',
+                                    'Tag_InsertFacetPair',
+                                    'Tag_DeleteFacetPair'):
+                        transaction.execute(f'DROP TRIGGER {trigger}')
+            with _timer(f'insert_files, facet_triggers={facet_triggers}'):
+                library_db.insert_files(
+                    itertools.chain.from_iterable(
+                        _audio_files(album_index)
+                        for album_index in range(_ALBUM_COUNT)))
+    print(f'{_SEARCH_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        library_db = database.Database(database_dir=database_dir)
+        library_db.insert_files(
+            itertools.chain.from_iterable(
+                _audio_files(album_index)
+                for album_index in range(_SEARCH_ALBUM_COUNT)))
+        with _timer('GROUP BY genre'):
+            with library_db._db.snapshot() as snapshot:  # pylint: disable=protected-access
+                snapshot.execute("""
+                    SELECT tag_value, count(*) AS entity_count
+                    FROM Tag JOIN Entity USING (entity_id)
+                    WHERE tag_name = 'genre' AND type = 'track'
+                    GROUP BY tag_value
+                    ORDER BY entity_count DESC, tag_value
+                    LIMIT 100
+                """).fetchall()
+        with _timer('facet(GENRE)'):
+            library_db.facet(tag.GENRE)
+        with _timer('facet(ARTIST)'):
+            library_db.facet(tag.ARTIST)
+        for filter_tag in (tag.GENRE, tag.ALBUM):
+            filter_value = ('Genre 1' if filter_tag == tag.GENRE else 'Album 1')
+            with _timer(f'facet(ARTIST, filter_by=({filter_tag.name!r}, '
+                        f'{filter_value!r}))'):
+                library_db.facet(tag.ARTIST,
+                                 filter_by=(filter_tag, filter_value))
+
+
+# Entity and Tag tables keyed by token, the way Database used to key them.
+_TEXT_KEYED_SCHEMA = sqlite3_db.Schema(
+    name='text_keyed',
+    version='v0',
+    items=(
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE Entity (
+                token TEXT NOT NULL,
+                type TEXT NOT NULL,
+                filename TEXT,
+                parent_token TEXT REFERENCES Entity (token) ON DELETE CASCADE,
+                sort_key BLOB NOT NULL,
+                PRIMARY KEY (token),
+                UNIQUE (filename)
+            )
+        """),
+        sqlite3_db.SchemaItem(
+            'CREATE INDEX Entity_ParentIndex ON Entity (parent_token, sort_key)'
+        ),
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE Tag (
+                token TEXT NOT NULL REFERENCES Entity (token) ON DELETE CASCADE,
+                tag_name TEXT NOT NULL,
+                tag_value_order INTEGER NOT NULL,
+                tag_value TEXT NOT NULL,
+                PRIMARY KEY (token, tag_name, tag_value_order)
+            )
+        """),
+        sqlite3_db.SchemaItem(
+            'CREATE INDEX Tag_TagIndex ON Tag (tag_name, tag_value)'),
+    ),
+)
+
+# The same tables as _TEXT_KEYED_SCHEMA, keyed by integer IDs like Database.
+_INTEGER_KEYED_SCHEMA = sqlite3_db.Schema(
+    name='integer_keyed',
+    version='v0',
+    items=(
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE Entity (
+                entity_id INTEGER PRIMARY KEY,
+                token TEXT NOT NULL,
+                type TEXT NOT NULL,
+                filename TEXT,
+                parent_id INTEGER
+                    REFERENCES Entity (entity_id) ON DELETE CASCADE,
+                sort_key BLOB NOT NULL,
+                UNIQUE (token),
+                UNIQUE (filename)
+            )
+        """),
+        sqlite3_db.SchemaItem(
+            'CREATE INDEX Entity_ParentIndex ON Entity (parent_id, sort_key)'),
+        sqlite3_db.SchemaItem("""
+            CREATE TABLE Tag (
+                tag_id INTEGER PRIMARY KEY,
+                entity_id INTEGER NOT NULL
+                    REFERENCES Entity (entity_id) ON DELETE CASCADE,
+                tag_name TEXT NOT NULL,
+                tag_value_order INTEGER NOT NULL,
+                tag_value TEXT NOT NULL,
+                UNIQUE (entity_id, tag_name, tag_value_order)
+            )
+        """),
+        sqlite3_db.SchemaItem(
+            'CREATE INDEX Tag_TagIndex ON Tag (tag_name, tag_value)'),
+    ),
+)
+
+# Statements to fill and query each schema above. Each one takes the same
+# parameters for both schemas, so they can be compared directly.
+_SCHEMA_STATEMENTS = {
+    _TEXT_KEYED_SCHEMA: {
+        'insert_entity':
+            """
+            INSERT INTO Entity (token, type, filename, parent_token, sort_key)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+        'insert_tag':
+            """
+            INSERT INTO Tag (token, tag_name, tag_value_order, tag_value)
+            VALUES (?, ?, ?, ?)
+        """,
+        'album_tags':
+            """
+            WITH RECURSIVE Tree (token) AS (
+                SELECT token FROM Entity WHERE token = ?
+                UNION ALL
+                SELECT Entity.token
+                FROM Tree JOIN Entity ON Entity.parent_token = Tree.token
+            )
+            SELECT Tag.token, Tag.tag_name, Tag.tag_value
+            FROM Tree CROSS JOIN Tag ON Tag.token = Tree.token
+            ORDER BY Tag.token, Tag.tag_name, Tag.tag_value_order
+        """,
+    },
+    _INTEGER_KEYED_SCHEMA: {
+        'insert_entity':
+            """
+            INSERT INTO Entity (token, type, filename, parent_id, sort_key)
+            VALUES (?, ?, ?, (SELECT entity_id FROM Entity WHERE token = ?), ?)
+        """,
+        'insert_tag':
+            """
+            INSERT INTO Tag (entity_id, tag_name, tag_value_order, tag_value)
+            VALUES ((SELECT entity_id FROM Entity WHERE token = ?), ?, ?, ?)
+        """,
+        'album_tags':
+            """
+            WITH RECURSIVE Tree (entity_id) AS (
+                SELECT entity_id FROM Entity WHERE token = ?
+                UNION ALL
+                SELECT Entity.entity_id
+                FROM Tree JOIN Entity ON Entity.parent_id = Tree.entity_id
+            )
+            SELECT Tag.entity_id, Tag.tag_name, Tag.tag_value
+            FROM Tree CROSS JOIN Tag ON Tag.entity_id = Tree.entity_id
+            ORDER BY Tag.entity_id, Tag.tag_name, Tag.tag_value_order
+        """,
+    },
+}
+
+
+def benchmark_schema_keys() -> None:
+    """Prints size and speed of the Entity and Tag tables, by type of key."""
+    print(f'{_SEARCH_ALBUM_COUNT} albums, {_TRACKS_PER_ALBUM} tracks per album')
+    with tempfile.TemporaryDirectory() as database_dir:
+        library_db = database.Database(database_dir=database_dir)
+        library_db.insert_files(
+            itertools.chain.from_iterable(
+                _audio_files(album_index)
+                for album_index in range(_SEARCH_ALBUM_COUNT)))
+        with library_db._db.snapshot() as snapshot:  # pylint: disable=protected-access
+            entity_rows = snapshot.execute("""
+                SELECT
+                    Entity.token,
+                    Entity.type,
+                    Entity.filename,
+                    Parent.token,
+                    Entity.sort_key
+                FROM Entity
+                LEFT JOIN Entity AS Parent
+                    ON Parent.entity_id = Entity.parent_id
+                ORDER BY Entity.entity_id
+            """).fetchall()
+            tag_rows = snapshot.execute("""
+                SELECT Entity.token, tag_name, tag_value_order, tag_value
+                FROM Tag JOIN Entity USING (entity_id)
+            """).fetchall()
+        album_tokens = tuple(row[0] for row in entity_rows if row[1] == 'album')
+        for schema, statements in _SCHEMA_STATEMENTS.items():
+            db = sqlite3_db.Database(schema, database_dir=database_dir)
+            start = time.perf_counter()
+            with db.transaction() as transaction:
+                transaction.executemany(statements['insert_entity'],
+                                        entity_rows)
+                transaction.executemany(statements['insert_tag'], tag_rows)
+            ingest_seconds = time.perf_counter() - start
+            with db.snapshot() as snapshot:
+                snapshot.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            iterations = 1000
+            start = time.perf_counter()
+            for album_token in itertools.islice(itertools.cycle(album_tokens),
+                                                iterations):
+                with db.snapshot() as snapshot:
+                    snapshot.execute(statements['album_tags'],
+                                     (album_token,)).fetchall()
+            lookup_seconds = (time.perf_counter() - start) / iterations
+            print(f'{schema.name}: '  # pylint: disable=protected-access
+                  f'{os.path.getsize(db._filename) / 2**20:.1f}MiB, '
+                  f'ingest {ingest_seconds:.3f}s, '
+                  f'album lookup {lookup_seconds * 1000:.3f}ms')
+
+
+def main() -> None:
+    benchmark_schema_keys()
+    benchmark_album()
+    benchmark_track_load()
+    benchmark_profiles()
+    benchmark_search()
+    benchmark_filter()
+    benchmark_statements()
+    benchmark_instrumentation()
+    benchmark_migration()
+    benchmark_random_sample()
+    benchmark_facets()
+    benchmark_compose()
+
+
+if __name__ == '__main__':
+    main()
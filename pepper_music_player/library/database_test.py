@@ -13,15 +13,56 @@
 # limitations under the License.
 """Tests for pepper_music_player.library.database."""
 
+import collections
+import dataclasses
+import hashlib
+import itertools
+import os
+import pathlib
 import sqlite3
 import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 from pepper_music_player.library import database
 from pepper_music_player.library import scan
+from pepper_music_player.library import scan_testlib
+from pepper_music_player.metadata import collation
 from pepper_music_player.metadata import entity
 from pepper_music_player.metadata import tag
 from pepper_music_player.metadata import token
+from pepper_music_player import pubsub
+from pepper_music_player import sqlite3_db
+from pepper_music_player import sqlite3_db_testlib
+
+
+def _audio_file(filename, tags=None, *, fingerprint=None):
+    """Returns an AudioFile with a track that has the given tags."""
+    dirname, basename = os.path.split(filename)
+    return scan.AudioFile(
+        filename=filename,
+        dirname=dirname,
+        basename=basename,
+        fingerprint=fingerprint,
+        track=entity.Track(tags=tag.Tags({
+            **(tags or {}),
+            tag.FILENAME: (filename,),
+            tag.DIRNAME: (dirname,),
+            tag.BASENAME: (basename,),
+        }).derive()),
+    )
+
+
+def _unchanged_file(file_info):
+    """Returns an UnchangedFile for the given file."""
+    return scan.UnchangedFile(
+        filename=file_info.filename,
+        dirname=file_info.dirname,
+        basename=file_info.basename,
+        fingerprint=file_info.fingerprint,
+    )
 
 
 class DatabaseTest(unittest.TestCase):
@@ -31,14 +72,17 @@ class DatabaseTest(unittest.TestCase):
         super().setUp()
         tempdir = tempfile.TemporaryDirectory()
         self.addCleanup(tempdir.cleanup)
+        self._pubsub = pubsub.PubSub()
         self._database = database.Database(
             database_dir=tempdir.name,
+            pubsub_bus=self._pubsub,
             reverse_unordered_selects=self.REVERSE_UNORDERED_SELECTS)
 
     def test_insert_files_generic(self):
         self._database.insert_files((scan.File(filename='/a/b',
                                                dirname='/a',
-                                               basename='b'),))
+                                               basename='b',
+                                               fingerprint=None),))
         self.assertFalse(self._database.search())
 
     def test_insert_files_duplicate(self):
@@ -46,6 +90,7 @@ class DatabaseTest(unittest.TestCase):
             filename='/a/b',
             dirname='/a',
             basename='b',
+            fingerprint=None,
             track=entity.Track(tags=tag.Tags({tag.FILENAME: ('/a/b',)})))
         with self.assertRaises(sqlite3.IntegrityError):
             self._database.insert_files((file1, file1))
@@ -65,10 +110,12 @@ class DatabaseTest(unittest.TestCase):
             scan.AudioFile(filename='/a/b',
                            dirname='/a',
                            basename='b',
+                           fingerprint=None,
                            track=track1),
             scan.AudioFile(filename='/a/c',
                            dirname='/a',
                            basename='c',
+                           fingerprint=None,
                            track=track2),
         ))
         self.assertCountEqual((track1.token, track2.token),
@@ -94,10 +141,12 @@ class DatabaseTest(unittest.TestCase):
             scan.AudioFile(filename='/dir1/file1',
                            dirname='/dir1',
                            basename='file1',
+                           fingerprint=None,
                            track=track1),
             scan.AudioFile(filename='/dir1/file2',
                            dirname='/dir1',
                            basename='file2',
+                           fingerprint=None,
                            track=track2),
         ))
         self.assertCountEqual((track1.medium_token, track2.medium_token),
@@ -136,10 +185,12 @@ class DatabaseTest(unittest.TestCase):
             scan.AudioFile(filename='/dir1/file1',
                            dirname='/dir1',
                            basename='file1',
+                           fingerprint=None,
                            track=track1),
             scan.AudioFile(filename='/dir1/file2',
                            dirname='/dir1',
                            basename='file2',
+                           fingerprint=None,
                            track=track2),
         ))
         self.assertCountEqual((medium.token,),
@@ -151,6 +202,642 @@ class DatabaseTest(unittest.TestCase):
                                if isinstance(token_, token.Album)))
         self.assertEqual(album, self._database.album(album.token))
 
+    def test_file_fingerprints(self):
+        fingerprint = scan.Fingerprint(size=1, mtime_ns=2, inode=3, device=4)
+        self._database.insert_files((
+            _audio_file('/a/b', fingerprint=fingerprint),
+            _audio_file('/a/c/d', fingerprint=fingerprint),
+            _audio_file('/a/e'),
+            _audio_file('/ab', fingerprint=fingerprint),
+        ))
+        self.assertEqual(
+            {
+                '/a/b': fingerprint,
+                '/a/c/d': fingerprint,
+            },
+            self._database.file_fingerprints('/a'),
+        )
+
+    def test_update_files_keeps_unchanged_files(self):
+        fingerprint = scan.Fingerprint(size=1, mtime_ns=2, inode=3, device=4)
+        file1 = _audio_file('/a/b', {'album': ('album1',)},
+                            fingerprint=fingerprint)
+        self._database.insert_files((file1,))
+        self._database.update_files('/a', (_unchanged_file(file1),))
+        self.assertEqual(file1.track, self._database.track(file1.track.token))
+        self.assertEqual({'/a/b': fingerprint},
+                         self._database.file_fingerprints('/a'))
+
+    def test_update_files_replaces_changed_files(self):
+        old_file = _audio_file(
+            '/a/b',
+            {'album': ('old',)},
+            fingerprint=scan.Fingerprint(size=1, mtime_ns=2, inode=3, device=4),
+        )
+        new_file = _audio_file(
+            '/a/b',
+            {'album': ('new',)},
+            fingerprint=scan.Fingerprint(size=5, mtime_ns=6, inode=3, device=4),
+        )
+        self._database.insert_files((old_file,))
+        self._database.update_files('/a', (new_file,))
+        self.assertEqual(new_file.track,
+                         self._database.track(new_file.track.token))
+        self.assertEqual(
+            new_file.track.tags,
+            self._database.album(new_file.track.album_token).tags,
+        )
+        with self.assertRaises(KeyError):
+            self._database.album(old_file.track.album_token)
+        self.assertEqual({'/a/b': new_file.fingerprint},
+                         self._database.file_fingerprints('/a'))
+
+    def test_update_files_adds_new_files(self):
+        file1 = _audio_file('/a/b', {'album': ('album1',)})
+        file2 = _audio_file('/a/c', {'album': ('album1',)})
+        self._database.insert_files((file1,))
+        self._database.update_files('/a', (_unchanged_file(file1), file2))
+        self.assertEqual(
+            (file1.track, file2.track),
+            tuple(
+                itertools.chain.from_iterable(
+                    medium.tracks for medium in self._database.album(
+                        file1.track.album_token).mediums)),
+        )
+
+    def test_update_files_deletes_missing_files(self):
+        deleted = _audio_file('/a/b', {'album': ('deleted',)})
+        kept = _audio_file('/a/c', {'album': ('kept',)})
+        outside_root = _audio_file('/ab', {'album': ('outside root',)})
+        self._database.insert_files((deleted, kept, outside_root))
+        self._database.update_files('/a', (_unchanged_file(kept),))
+        with self.assertRaises(KeyError):
+            self._database.track(deleted.track.token)
+        with self.assertRaises(KeyError):
+            self._database.medium(deleted.track.medium_token)
+        with self.assertRaises(KeyError):
+            self._database.album(deleted.track.album_token)
+        self.assertEqual(kept.track, self._database.track(kept.track.token))
+        self.assertEqual(outside_root.track,
+                         self._database.track(outside_root.track.token))
+
+    def test_update_files_recomposes_parents_of_deleted_files(self):
+        kept = _audio_file('/a/b', {'album': ('album1',), 'foo': ('kept',)})
+        deleted = _audio_file('/a/c', {
+            'album': ('album1',),
+            'foo': ('deleted',),
+        })
+        self._database.insert_files((kept, deleted))
+        self.assertNotIn(
+            'foo',
+            self._database.album(kept.track.album_token).tags,
+        )
+        self._database.update_files('/a', (_unchanged_file(kept),))
+        self.assertEqual(
+            ('kept',),
+            self._database.album(kept.track.album_token).tags['foo'],
+        )
+
+    def test_remove_files(self):
+        removed = _audio_file('/a/b', {'album': ('removed',)})
+        kept = _audio_file('/a/c', {'album': ('kept',)})
+        self._database.insert_files((removed, kept))
+        self._database.remove_files(('/a/b', '/a/does-not-exist'))
+        with self.assertRaises(KeyError):
+            self._database.track(removed.track.token)
+        with self.assertRaises(KeyError):
+            self._database.medium(removed.track.medium_token)
+        with self.assertRaises(KeyError):
+            self._database.album(removed.track.album_token)
+        self.assertEqual(kept.track, self._database.track(kept.track.token))
+        with self._database._db.snapshot() as snapshot:  # pylint: disable=protected-access
+            self.assertEqual(
+                [('/a/c',)],
+                snapshot.execute('SELECT filename FROM File').fetchall())
+        self.assertFalse(self._database.inconsistent_tags())
+
+    def test_remove_files_recomposes_parents(self):
+        kept = _audio_file('/a/b', {'album': ('album1',), 'foo': ('kept',)})
+        removed = _audio_file('/a/c', {
+            'album': ('album1',),
+            'discnumber': ('2',),
+            'foo': ('removed',),
+        })
+        self._database.insert_files((kept, removed))
+        self._database.remove_files(('/a/c',))
+        album = self._database.album(kept.track.album_token)
+        self.assertEqual(('kept',), album.tags['foo'])
+        self.assertEqual((kept.track.medium_token,),
+                         tuple(medium.token for medium in album.mediums))
+        with self.assertRaises(KeyError):
+            self._database.medium(removed.track.medium_token)
+
+    def test_remove_files_many(self):
+        files = tuple(
+            _audio_file(f'/a/{i}', {'album': (str(i % 3),)})
+            for i in range(2 * database._MAX_IN_PARAMETERS + 1))  # pylint: disable=protected-access
+        self._database.insert_files(files)
+        self._database.remove_files(file_info.filename for file_info in files)
+        self.assertFalse(self._database.search())
+
+    def test_delete_orphans(self):
+        orphaned = _audio_file('/a/b', {'album': ('orphaned',)})
+        kept = _audio_file('/a/c', {'album': ('kept',), 'foo': ('kept',)})
+        orphaned_medium = _audio_file('/a/d', {
+            'album': ('kept',),
+            'discnumber': ('2',),
+            'foo': ('orphaned',),
+        })
+        self._database.insert_files((orphaned, kept, orphaned_medium))
+        with self._database._db.transaction() as transaction:  # pylint: disable=protected-access
+            transaction.execute(
+                "DELETE FROM Entity WHERE type = 'track' AND filename IN "
+                "('/a/b', '/a/d')")
+        self._database.delete_orphans()
+        with self.assertRaises(KeyError):
+            self._database.album(orphaned.track.album_token)
+        with self.assertRaises(KeyError):
+            self._database.medium(orphaned_medium.track.medium_token)
+        album = self._database.album(kept.track.album_token)
+        self.assertEqual(('kept',), album.tags['foo'])
+        self.assertEqual(1, len(album.mediums))
+        self.assertFalse(self._database.inconsistent_tags())
+
+    def test_update_files_does_not_rewrite_unchanged_parent_tags(self):
+        unchanged = _audio_file('/a/b', {'album': ('album1',)})
+        changed = _audio_file('/a/c', {'album': ('album1',)})
+        self._database.insert_files((unchanged, changed))
+        changed = _audio_file('/a/c', {'album': ('album1',), 'foo': ('bar',)})
+        with mock.patch.object(
+                self._database,
+                '_set_tags',
+                wraps=self._database._set_tags,  # pylint: disable=protected-access
+        ) as set_tags:
+            self._database.update_files('/a',
+                                        (_unchanged_file(unchanged), changed))
+        self.assertCountEqual(
+            (changed.track.tags,),
+            (call.args[2] for call in set_tags.mock_calls),
+        )
+
+    def test_serialized_tags_match_tag_table(self):
+        kept = _audio_file('/a/1', {'album': ('foo',), 'artist': ('a', 'b')})
+        changed = _audio_file('/a/2', {'album': ('foo',)})
+        self._database.insert_files((kept, changed, _audio_file('/b/1')))
+        self._database.update_files('/a', (
+            _unchanged_file(kept),
+            _audio_file('/a/2', {
+                'album': ('foo',),
+                'title': ('Jóga',)
+            }),
+        ))
+        self._database.update_files('/b', ())
+        self.assertFalse(self._database.inconsistent_tags())
+
+    def test_inconsistent_tags(self):
+        file_info = _audio_file('/a/1', {'title': ('foo',)})
+        self._database.insert_files((file_info,))
+        with self._database._db.transaction() as transaction:  # pylint: disable=protected-access
+            transaction.execute(
+                "UPDATE Tag SET tag_value = 'bar' WHERE tag_name = 'title'")
+        self.assertCountEqual(
+            (
+                file_info.track.token,
+                file_info.track.medium_token,
+                file_info.track.album_token,
+            ),
+            self._database.inconsistent_tags(),
+        )
+
+    def test_update_files_publishes_progress(self):
+        progress_callback = mock.Mock(spec=())
+        self._pubsub.subscribe(database.UpdateProgress, progress_callback)
+        self._database.update_files(
+            '/a',
+            (_audio_file('/a/b'), _audio_file('/a/c'), _audio_file('/a/d')),
+            batch_size=2,
+        )
+        self._pubsub.join()
+        self.assertSequenceEqual(
+            (
+                mock.call(
+                    database.UpdateProgress(
+                        root_dirname='/a', files_processed=2, done=False)),
+                mock.call(
+                    database.UpdateProgress(
+                        root_dirname='/a', files_processed=3, done=False)),
+                mock.call(
+                    database.UpdateProgress(
+                        root_dirname='/a', files_processed=3, done=True)),
+            ),
+            progress_callback.mock_calls,
+        )
+
+    def test_migration_keeps_library_and_publishes_progress(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        file_info = _audio_file('/a/b', {'title': ('foo',)})
+        database.Database(database_dir=tempdir.name).insert_files((file_info,))
+        progress_callback = mock.Mock(spec=())
+        self._pubsub.subscribe(database.MigrationProgress, progress_callback)
+        schema = database._SCHEMA  # pylint: disable=protected-access
+        with mock.patch.object(
+                database, '_SCHEMA',
+                dataclasses.replace(
+                    schema,
+                    version='vtest',
+                    migrations=(sqlite3_db.Migration(
+                        from_version=schema.version,
+                        to_version='vtest',
+                        steps=('ANALYZE',),
+                    ),),
+                )):
+            migrated = database.Database(database_dir=tempdir.name,
+                                         pubsub_bus=self._pubsub)
+        self._pubsub.join()
+        self.assertEqual(file_info.track, migrated.track(file_info.track.token))
+        self.assertSequenceEqual(
+            [
+                mock.call(
+                    database.MigrationProgress(
+                        sqlite3_db.MigrationProgress(
+                            from_version=schema.version,
+                            to_version='vtest',
+                            steps_done=steps_done,
+                            steps_total=1,
+                            done=done,
+                        ))) for steps_done, done in (
+                            (0, False),
+                            (1, False),
+                            (1, True),
+                        )
+            ],
+            progress_callback.mock_calls,
+        )
+
+    def test_migrates_v1alpha_library(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        files = (
+            _audio_file(
+                '/a/1', {
+                    'album': ('foo',),
+                    'date': ('2019-12-31',),
+                    'tracknumber': ('2',),
+                    'artist': ('bar',),
+                }),
+            _audio_file(
+                '/a/2', {
+                    'album': ('foo',),
+                    'date': ('2019-12-31',),
+                    'tracknumber': ('1',),
+                    'artist': ('baz',),
+                }),
+        )
+        # The v1alpha schema and the rows it had for files, before the year
+        # was derived from dates.
+        connection = sqlite3.connect(
+            os.path.join(tempdir.name, 'library.v1alpha.sqlite3'))
+        connection.executescript("""
+            CREATE TABLE File (
+                filename TEXT NOT NULL,
+                PRIMARY KEY (filename)
+            );
+            CREATE TABLE Entity (
+                token TEXT NOT NULL,
+                type TEXT NOT NULL,
+                filename TEXT REFERENCES File (filename) ON DELETE CASCADE,
+                parent_token TEXT REFERENCES Entity (token) ON DELETE CASCADE,
+                sort_key BLOB NOT NULL,
+                PRIMARY KEY (token),
+                UNIQUE (filename)
+            );
+            CREATE INDEX Entity_ParentIndex
+            ON Entity (parent_token, sort_key);
+            CREATE TABLE Tag (
+                token TEXT NOT NULL REFERENCES Entity (token) ON DELETE CASCADE,
+                tag_name TEXT NOT NULL,
+                tag_value_order INTEGER NOT NULL,
+                tag_value TEXT NOT NULL,
+                PRIMARY KEY (token, tag_name, tag_value_order)
+            );
+            CREATE INDEX Tag_TagIndex ON Tag (tag_name, tag_value);
+        """)
+        for file_info in files:
+            track = file_info.track
+            connection.execute('INSERT INTO File (filename) VALUES (?)',
+                               (file_info.filename,))
+            connection.executemany(
+                """
+                INSERT OR IGNORE INTO Entity
+                    (token, type, filename, parent_token, sort_key)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (
+                    (str(track.album_token), 'album', None, None, b''),
+                    (str(track.medium_token), 'medium', None,
+                     str(track.album_token), track.medium_sort_key),
+                    (str(track.token), 'track', file_info.filename,
+                     str(track.medium_token), track.sort_key),
+                ),
+            )
+            connection.executemany(
+                'INSERT INTO Tag VALUES (?, ?, ?, ?)',
+                ((str(track.token), name, order, value)
+                 for name, values in track.tags.items()
+                 if name != tag.PARSED_YEAR.name
+                 for order, value in enumerate(values)),
+            )
+        connection.commit()
+        connection.close()
+        os.mkdir(os.path.join(tempdir.name, 'expected'))
+        expected = database.Database(
+            database_dir=os.path.join(tempdir.name, 'expected'))
+        expected.insert_files(files)
+
+        migrated = database.Database(database_dir=tempdir.name)
+
+        self.assertFalse(
+            os.path.exists(os.path.join(tempdir.name,
+                                        'library.v1alpha.sqlite3')))
+        album_token = files[0].track.album_token
+        self.assertEqual(expected.album(album_token),
+                         migrated.album(album_token))
+        self.assertSequenceEqual(expected.search(), migrated.search())
+        self.assertSequenceEqual(expected.search('baz'), migrated.search('baz'))
+        self.assertTrue(migrated.facet(tag.PARSED_YEAR))
+        self.assertSequenceEqual(expected.facet(tag.PARSED_YEAR),
+                                 migrated.facet(tag.PARSED_YEAR))
+        self.assertSequenceEqual(
+            expected.facet(tag.ARTIST, filter_by=(tag.PARSED_YEAR, '2019')),
+            migrated.facet(tag.ARTIST, filter_by=(tag.PARSED_YEAR, '2019')),
+        )
+        self.assertFalse(migrated.file_fingerprints('/a'))
+        new_file = _audio_file('/b/1', {'album': ('qux',)})
+        migrated.insert_files((new_file,))
+        self.assertEqual(new_file.track, migrated.track(new_file.track.token))
+
+    def _entities_changed_callback(self):
+        callback = mock.Mock(spec=())
+        self._pubsub.subscribe(database.EntitiesChanged, callback)
+        return callback
+
+    def test_insert_files_publishes_added_entities(self):
+        callback = self._entities_changed_callback()
+        file_info = _audio_file('/a/b')
+        self._database.insert_files((file_info,))
+        self._pubsub.join()
+        callback.assert_called_once_with(
+            database.EntitiesChanged(
+                tracks=database.TokenChanges(
+                    added=frozenset((file_info.track.token,))),
+                mediums=database.TokenChanges(
+                    added=frozenset((file_info.track.medium_token,))),
+                albums=database.TokenChanges(
+                    added=frozenset((file_info.track.album_token,))),
+            ))
+
+    def test_update_files_publishes_changes_per_transaction(self):
+        changed = _audio_file('/a/1', {'album': ('foo',), 'title': ('one',)})
+        unchanged = _audio_file('/a/2', {'album': ('foo',)})
+        removed = _audio_file('/b/1', {'album': ('bar',)})
+        self._database.insert_files((changed, unchanged, removed))
+        callback = self._entities_changed_callback()
+        changed_after = _audio_file('/a/1', {
+            'album': ('foo',),
+            'title': ('two',),
+        })
+        self._database.update_files('/',
+                                    (changed_after, _unchanged_file(unchanged)))
+        self._pubsub.join()
+        self.assertSequenceEqual(
+            (
+                mock.call(
+                    database.EntitiesChanged(
+                        tracks=database.TokenChanges(
+                            modified=frozenset((changed.track.token,))),
+                        mediums=database.TokenChanges(
+                            modified=frozenset((changed.track.medium_token,))),
+                        albums=database.TokenChanges(
+                            modified=frozenset((changed.track.album_token,))),
+                    )),
+                mock.call(
+                    database.EntitiesChanged(
+                        tracks=database.TokenChanges(
+                            removed=frozenset((removed.track.token,))),
+                        mediums=database.TokenChanges(
+                            removed=frozenset((removed.track.medium_token,))),
+                        albums=database.TokenChanges(
+                            removed=frozenset((removed.track.album_token,))),
+                    )),
+            ),
+            callback.mock_calls,
+        )
+
+    def test_update_files_does_not_publish_without_changes(self):
+        file_info = _audio_file('/a/1')
+        self._database.insert_files((file_info,))
+        callback = self._entities_changed_callback()
+        self._database.update_files('/a', (_unchanged_file(file_info),))
+        self._pubsub.join()
+        callback.assert_not_called()
+
+    def test_update_files_publishes_parents_of_removed_track(self):
+        track1 = _audio_file('/a/1', {'album': ('foo',)})
+        track2 = _audio_file('/a/2', {'album': ('foo',)})
+        self._database.insert_files((track1, track2))
+        callback = self._entities_changed_callback()
+        self._database.update_files('/a', (_unchanged_file(track1),))
+        self._pubsub.join()
+        callback.assert_called_once_with(
+            database.EntitiesChanged(
+                tracks=database.TokenChanges(
+                    removed=frozenset((track2.track.token,))),
+                mediums=database.TokenChanges(
+                    modified=frozenset((track1.track.medium_token,))),
+                albums=database.TokenChanges(
+                    modified=frozenset((track1.track.album_token,))),
+            ))
+
+    def test_update_files_commits_batch_after_timeout(self):
+        first = _audio_file('/a/b', {'album': ('first',)})
+
+        def files():
+            yield first
+            # This would time out if the first file weren't committed until
+            # after the second file.
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                if self._database.search():
+                    break
+                time.sleep(0.01)
+            else:
+                raise AssertionError('First batch was not committed.')
+            yield _audio_file('/a/c')
+
+        self._database.update_files('/a',
+                                    files(),
+                                    batch_size=100,
+                                    batch_seconds=0.01)
+        self.assertEqual(first.track, self._database.track(first.track.token))
+
+    def test_update_files_error_keeps_stale_files(self):
+        stale = _audio_file('/a/b')
+        self._database.insert_files((stale,))
+
+        def files():
+            yield _audio_file('/a/c')
+            raise ValueError('foo')
+
+        with self.assertRaisesRegex(ValueError, 'foo'):
+            self._database.update_files('/a', files())
+        self.assertEqual(stale.track, self._database.track(stale.track.token))
+
+    def test_rescan(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        root_dirpath = pathlib.Path(tempdir.name)
+        foo = root_dirpath.joinpath('foo.flac')
+        foo.write_bytes(scan_testlib.flac_with_tags({'title': ('Foo',)}))
+        bar = root_dirpath.joinpath('bar.flac')
+        bar.write_bytes(scan_testlib.FLAC)
+
+        self._database.rescan(str(root_dirpath))
+        foo_token = entity.Track(tags=tag.Tags({
+            tag.FILENAME: (str(foo),),
+        })).token
+        bar_token = entity.Track(tags=tag.Tags({
+            tag.FILENAME: (str(bar),),
+        })).token
+        self.assertEqual(('Foo',),
+                         self._database.track(foo_token).tags[tag.TITLE])
+        self.assertTrue(self._database.track(bar_token))
+
+        old_mtime_ns = foo.stat().st_mtime_ns
+        foo.write_bytes(scan_testlib.flac_with_tags({'title': ('Foo 2',)}))
+        # Make sure the change is visible even with coarse timestamps.
+        os.utime(foo, ns=(old_mtime_ns + 1, old_mtime_ns + 1))
+        bar.unlink()
+        self._database.rescan(str(root_dirpath))
+        self.assertEqual(('Foo 2',),
+                         self._database.track(foo_token).tags[tag.TITLE])
+        with self.assertRaises(KeyError):
+            self._database.track(bar_token)
+
+    def test_rescan_moved_file_keeps_tags(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        root_dirpath = pathlib.Path(tempdir.name)
+        foo = root_dirpath.joinpath('foo.flac')
+        foo.write_bytes(scan_testlib.flac_with_tags({'title': ('Foo',)}))
+        self._database.rescan(str(root_dirpath))
+        root_dirpath.joinpath('bar').mkdir()
+        bar = root_dirpath.joinpath('bar', 'bar.flac')
+        foo.rename(bar)
+
+        with mock.patch.object(scan.mutagen,
+                               'File',
+                               side_effect=AssertionError('Read a file.')):
+            self._database.rescan(str(root_dirpath))
+
+        with self.assertRaises(KeyError):
+            self._database.track(
+                entity.Track(tags=tag.Tags({
+                    tag.FILENAME: (str(foo),),
+                })).token)
+        bar_tags = self._database.track(
+            entity.Track(tags=tag.Tags({
+                tag.FILENAME: (str(bar),),
+            })).token).tags
+        self.assertEqual(('Foo',), bar_tags[tag.TITLE])
+        self.assertEqual(('bar.flac',), bar_tags[tag.BASENAME])
+        self.assertEqual((str(bar.parent),), bar_tags[tag.DIRNAME])
+        self.assertEqual((str(bar),), bar_tags[tag.FILENAME])
+        self.assertIn(tag.DURATION_HUMAN, bar_tags)
+
+    def test_update_files_deleted_moved_file_without_source(self):
+        fingerprint = scan.Fingerprint(size=0, mtime_ns=0, inode=0, device=0)
+        self._database.update_files('/a', (scan.MovedFile(
+            filename='/a/foo.flac',
+            dirname='/a',
+            basename='foo.flac',
+            fingerprint=fingerprint,
+            source_filename='/a/bar.flac',
+            source_fingerprint=fingerprint,
+        ),))
+        self.assertFalse(self._database.file_fingerprints('/a'))
+
+    def test_update_files_reads_moved_file_without_source(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        foo = pathlib.Path(tempdir.name).joinpath('foo.flac')
+        foo.write_bytes(scan_testlib.flac_with_tags({'title': ('Foo',)}))
+        fingerprint = scan.Fingerprint.from_stat(foo.stat())
+        self._database.update_files(tempdir.name, (scan.MovedFile(
+            filename=str(foo),
+            dirname=tempdir.name,
+            basename='foo.flac',
+            fingerprint=fingerprint,
+            source_filename=str(foo.with_name('bar.flac')),
+            source_fingerprint=fingerprint,
+        ),))
+        foo_tags = self._database.track(
+            entity.Track(tags=tag.Tags({
+                tag.FILENAME: (str(foo),),
+            })).token).tags
+        self.assertEqual(('Foo',), foo_tags[tag.TITLE])
+
+    def test_update_files_directories(self):
+        old = scan.Directory(dirname='/a/old', mtime_ns=1, entry_count=0)
+        updated_old = scan.Directory(dirname='/a/updated',
+                                     mtime_ns=1,
+                                     entry_count=0)
+        updated_new = scan.Directory(dirname='/a/updated',
+                                     mtime_ns=2,
+                                     entry_count=1)
+        root = scan.Directory(dirname='/a', mtime_ns=None, entry_count=1)
+        outside_root = scan.Directory(dirname='/ab', mtime_ns=1, entry_count=0)
+        self._database.update_files('/a', (old, updated_old))
+        self._database.update_files('/ab', (outside_root,))
+        self._database.update_files('/a', (updated_new, root))
+        self.assertEqual(
+            {
+                '/a': root,
+                '/a/updated': updated_new,
+            },
+            self._database.directories('/a'),
+        )
+        self.assertEqual({'/ab': outside_root},
+                         self._database.directories('/ab'))
+
+    def test_rescan_skip_unchanged_directories(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        root_dirpath = pathlib.Path(tempdir.name)
+        foo_dirpath = root_dirpath.joinpath('foo')
+        foo_dirpath.mkdir()
+        foo1 = foo_dirpath.joinpath('foo1.flac')
+        foo1.write_bytes(scan_testlib.FLAC)
+        # Make the directory old enough for its mtime to be trusted.
+        os.utime(foo_dirpath, ns=(10**18, 10**18))
+        self._database.rescan(str(root_dirpath),
+                              skip_unchanged_directories=True)
+        foo1_token = entity.Track(tags=tag.Tags({
+            tag.FILENAME: (str(foo1),),
+        })).token
+
+        # Invalid audio data, which would fail if it were read.
+        foo1.write_bytes(b'')
+        self._database.rescan(str(root_dirpath),
+                              skip_unchanged_directories=True)
+        self.assertTrue(self._database.track(foo1_token))
+
+        foo1.unlink()
+        self._database.rescan(str(root_dirpath),
+                              skip_unchanged_directories=True)
+        with self.assertRaises(KeyError):
+            self._database.track(foo1_token)
+
     def test_search_limit(self):
         track1 = entity.Track(tags=tag.Tags({
             tag.FILENAME: ('/dir1/file1',),
@@ -162,18 +849,626 @@ class DatabaseTest(unittest.TestCase):
             scan.AudioFile(filename='/dir1/file1',
                            dirname='/dir1',
                            basename='file1',
+                           fingerprint=None,
                            track=track1),
             scan.AudioFile(filename='/dir1/file2',
                            dirname='/dir1',
                            basename='file2',
+                           fingerprint=None,
                            track=track2),
         ))
         self.assertEqual(1, len(self._database.search(limit=1)))
 
+    def _assert_search_index_consistent(self):
+        with self._database._db.transaction() as transaction:  # pylint: disable=protected-access
+            transaction.execute(
+                "INSERT INTO TagSearch (TagSearch) VALUES ('integrity-check')")
+
+    def test_search_matches_words_and_prefixes(self):
+        come_together = _audio_file('/a/1', {'title': ('Come Together',)})
+        something = _audio_file('/a/2', {'title': ('Something',)})
+        self._database.insert_files((come_together, something))
+        self.assertEqual([come_together.track.token],
+                         self._database.search('together'))
+        self.assertEqual([come_together.track.token],
+                         self._database.search('tog'))
+        self.assertEqual([come_together.track.token],
+                         self._database.search('TOGETHER come'))
+        self.assertEqual([something.track.token], self._database.search('som'))
+        self.assertFalse(self._database.search('ether'))
+
+    def test_search_ignores_diacritics(self):
+        file_info = _audio_file('/a/1', {'title': ('Jóga',)})
+        self._database.insert_files((file_info,))
+        self.assertIn(file_info.track.token, self._database.search('joga'))
+        self.assertIn(file_info.track.token, self._database.search('JÓGA'))
+
+    def test_search_requires_all_terms(self):
+        file1 = _audio_file('/a/1', {'artist': ('foo',), 'title': ('bar',)})
+        file2 = _audio_file('/a/2', {'artist': ('foo',), 'title': ('baz',)})
+        self._database.insert_files((file1, file2))
+        self.assertEqual([file1.track.token], self._database.search('foo bar'))
+
+    def test_search_tag_filter(self):
+        file1 = _audio_file('/a/1', {'artist': ('foo',), 'title': ('bar',)})
+        file2 = _audio_file('/a/2', {'artist': ('bar',), 'title': ('foo',)})
+        self._database.insert_files((file1, file2))
+        self.assertEqual([file1.track.token],
+                         self._database.search('artist:foo'))
+        self.assertEqual([file1.track.token],
+                         self._database.search('ARTIST:fo title:b'))
+
+    def test_search_quoted_phrase(self):
+        file1 = _audio_file('/a/1', {'artist': ('foo bar',)})
+        file2 = _audio_file('/a/2', {'artist': ('bar foo',)})
+        self._database.insert_files((file1, file2))
+        self.assertEqual([file1.track.token],
+                         self._database.search('artist:"foo b"'))
+        self.assertCountEqual(
+            (file1.track.token, file2.track.token),
+            self._database.search('artist:foo artist:bar'),
+        )
+
+    def test_search_ignores_pseudo_tags(self):
+        self._database.insert_files((_audio_file('/foo/bar'),))
+        self.assertFalse(self._database.search('foo'))
+
+    def test_search_ignores_terms_without_words(self):
+        file_info = _audio_file('/a/1', {'title': ('foo',)})
+        self._database.insert_files((file_info,))
+        self.assertIn(file_info.track.token, self._database.search('- foo "'))
+
+    def test_search_ranks_album_above_its_tracks(self):
+        album_files = tuple(
+            _audio_file(f'/a/{index}', {
+                'album': ('foo',),
+                'title': (title,),
+                'tracknumber': (str(index),),
+            }) for index, title in enumerate(('foo', 'bar')))
+        other_file = _audio_file('/b/1', {'title': ('foo bar baz',)})
+        self._database.insert_files((*album_files, other_file))
+        self.assertEqual(
+            [
+                album_files[0].track.album_token,
+                album_files[0].track.medium_token,
+                album_files[0].track.token,
+                album_files[1].track.token,
+                other_file.track.album_token,
+                other_file.track.medium_token,
+                other_file.track.token,
+            ],
+            self._database.search('foo'),
+        )
+
+    def test_search_limit_with_query(self):
+        self._database.insert_files(
+            tuple(
+                _audio_file(f'/a/{i}', {'title': ('foo',)}) for i in range(3)))
+        self.assertEqual(2, len(self._database.search('foo', limit=2)))
+
+    def test_search_index_follows_changes(self):
+        file_info = _audio_file('/a/1', {'title': ('foo',)})
+        self._database.insert_files((file_info,))
+        self._database.update_files('/a',
+                                    (_audio_file('/a/1', {'title': ('bar',)}),))
+        self._assert_search_index_consistent()
+        self.assertFalse(self._database.search('foo'))
+        self.assertTrue(self._database.search('bar'))
+        self._database.update_files('/a', ())
+        self._assert_search_index_consistent()
+        self.assertFalse(self._database.search('bar'))
+
+    def test_search_without_query_sorts_by_ancestry(self):
+        files = (
+            _audio_file('/a/2', {
+                'discnumber': ('1',),
+                'tracknumber': ('2',)
+            }),
+            _audio_file('/a/3', {
+                'discnumber': ('2',),
+                'tracknumber': ('1',)
+            }),
+            _audio_file('/a/1', {
+                'discnumber': ('1',),
+                'tracknumber': ('1',)
+            }),
+            _audio_file('/b/1'),
+        )
+        self._database.insert_files(files)
+        a_results = [
+            files[0].track.album_token,
+            files[2].track.medium_token,
+            files[2].track.token,
+            files[0].track.token,
+            files[1].track.medium_token,
+            files[1].track.token,
+        ]
+        b_results = [
+            files[3].track.album_token,
+            files[3].track.medium_token,
+            files[3].track.token,
+        ]
+        self.assertIn(
+            self._database.search(),
+            (a_results + b_results, b_results + a_results),
+        )
+
+    def test_search_page_without_query(self):
+        self._database.insert_files(
+            tuple(_audio_file(f'/{i // 2}/{i}') for i in range(6)))
+        self._assert_pages_match_search('', page_size=4)
+
+    def test_search_page_with_query(self):
+        self._database.insert_files(
+            tuple(
+                _audio_file(f'/{i // 2}/{i}', {'title': ('foo ' * i,)})
+                for i in range(1, 7)))
+        self._assert_pages_match_search('foo', page_size=4)
+
+    def _assert_pages_match_search(self, query, *, sort_by=None, page_size):
+        """Asserts that all pages of a search match search() without pages."""
+        results = []
+        page_token = None
+        while True:
+            page = self._database.search_page(query,
+                                              sort_by=sort_by,
+                                              page_size=page_size,
+                                              page_token=page_token)
+            self.assertLessEqual(len(page.tokens), page_size)
+            results.extend(page.tokens)
+            if page.next_page_token is None:
+                break
+            page_token = page.next_page_token
+        self.assertGreater(len(results), page_size)
+        self.assertEqual(
+            self._database.search(query,
+                                  sort_by=sort_by,
+                                  limit=len(results) + 1),
+            results,
+        )
+
+    def test_search_page_exact_page_size(self):
+        self._database.insert_files((_audio_file('/a/1'),))
+        page = self._database.search_page(page_size=3)
+        self.assertEqual(3, len(page.tokens))
+        self.assertIsNone(page.next_page_token)
+
+    def test_search_page_token_survives_changes(self):
+        self._database.insert_files((_audio_file('/a/1'), _audio_file('/b/1')))
+        first_page = self._database.search_page(page_size=3)
+        self._database.insert_files((_audio_file('/c/1'),))
+        second_page = self._database.search_page(
+            page_token=first_page.next_page_token)
+        self.assertFalse(set(first_page.tokens) & set(second_page.tokens))
+        self.assertEqual(6, len(second_page.tokens))
+
+    def test_search_page_token_for_different_query(self):
+        self._database.insert_files(
+            tuple(
+                _audio_file(f'/a/{i}', {'title': ('foo',)}) for i in range(3)))
+        page = self._database.search_page('foo', page_size=1)
+        with self.assertRaisesRegex(ValueError, 'not for query'):
+            self._database.search_page('bar', page_token=page.next_page_token)
+
+    def test_search_page_token_invalid(self):
+        with self.assertRaisesRegex(ValueError, 'Invalid page token'):
+            self._database.search_page(page_token='foo')
+
+    def test_search_sort_by(self):
+        files = tuple(
+            _audio_file(f'/{album}/1', {'album': (album,)})
+            for album in ('The C', 'b', 'A'))
+        self._database.insert_files(files)
+        self.assertEqual(
+            [
+                files[2].track.album_token,
+                files[1].track.album_token,
+                files[0].track.album_token,
+            ],
+            [
+                token_ for token_ in self._database.search(
+                    sort_by=collation.SortField.ALBUM)
+                if isinstance(token_, token.Album)
+            ],
+        )
+
+    def test_search_sort_by_with_query(self):
+        files = (
+            _audio_file('/a/1', {'title': ('foo 10',)}),
+            _audio_file('/b/1', {'title': ('foo 9',)}),
+            _audio_file('/c/1', {'title': ('bar',)}),
+        )
+        self._database.insert_files(files)
+        self.assertEqual(
+            [file_info.track.token for file_info in files[1::-1]],
+            [
+                token_ for token_ in self._database.search(
+                    'foo', sort_by=collation.SortField.TITLE)
+                if isinstance(token_, token.Track)
+            ],
+        )
+
+    def test_search_sort_by_follows_changes(self):
+        self._database.insert_files((_audio_file('/a/1', {'title': ('foo',)}),))
+        new_file = _audio_file('/a/1', {'title': ('bar',)})
+        self._database.update_files('/a', (new_file,))
+        self.assertEqual(
+            [new_file.track.token],
+            [
+                token_ for token_ in self._database.search(
+                    'bar', sort_by=collation.SortField.TITLE)
+                if isinstance(token_, token.Track)
+            ],
+        )
+
+    def test_search_page_sort_by(self):
+        self._database.insert_files(
+            tuple(
+                _audio_file(f'/{i // 2}/{i}', {'artist': (f'artist {i % 3}',)})
+                for i in range(6)))
+        self._assert_pages_match_search('',
+                                        sort_by=collation.SortField.ARTIST,
+                                        page_size=4)
+        self._assert_pages_match_search('artist',
+                                        sort_by=collation.SortField.ARTIST,
+                                        page_size=4)
+
+    def test_search_page_token_for_different_sort_by(self):
+        self._database.insert_files(
+            tuple(_audio_file(f'/a/{i}') for i in range(3)))
+        page = self._database.search_page(page_size=1)
+        with self.assertRaisesRegex(ValueError, 'not for query'):
+            self._database.search_page(sort_by=collation.SortField.ALBUM,
+                                       page_token=page.next_page_token)
+
+    def test_random_sample_empty(self):
+        self.assertEqual([], self._database.random_sample(10))
+
+    def test_random_sample_zero(self):
+        self._database.insert_files((_audio_file('/a/1'),))
+        self.assertEqual([], self._database.random_sample(0))
+
+    def test_random_sample_token_type(self):
+        files = tuple(
+            _audio_file(f'/a/{i}', {'album': (str(i),)}) for i in range(20))
+        self._database.insert_files(files)
+        sample = self._database.random_sample(5, token_type=token.Album, seed=0)
+        self.assertEqual(5, len(sample))
+        self.assertEqual(5, len(set(sample)))
+        self.assertLessEqual(
+            set(sample),
+            {file_info.track.album_token for file_info in files},
+        )
+
+    def test_random_sample_deterministic_with_seed(self):
+        self._database.insert_files(
+            tuple(_audio_file(f'/a/{i}') for i in range(20)))
+        self.assertEqual(
+            self._database.random_sample(5, seed=1),
+            self._database.random_sample(5, seed=1),
+        )
+
+    def test_random_sample_whole_library(self):
+        files = tuple(
+            _audio_file(f'/a/{i}', {'album': (str(i),)}) for i in range(3))
+        self._database.insert_files(files)
+        self.assertCountEqual(
+            (file_info.track.token for file_info in files),
+            self._database.random_sample(10, token_type=token.Track, seed=0),
+        )
+        self.assertEqual(9, len(self._database.random_sample(10, seed=0)))
+
+    def test_random_sample_covers_every_entity(self):
+        files = tuple(
+            _audio_file(f'/a/{i}', {'album': (str(i),)}) for i in range(10))
+        self._database.insert_files(files)
+        self._database.remove_files(
+            file_info.filename for file_info in files[2:8])
+        kept_tokens = {
+            file_info.track.album_token for file_info in files[:2] + files[8:]
+        }
+        sampled_tokens = collections.Counter(
+            itertools.chain.from_iterable(
+                self._database.random_sample(
+                    1, token_type=token.Album, seed=seed)
+                for seed in range(200)))
+        self.assertEqual(kept_tokens, set(sampled_tokens))
+        self.assertGreater(min(sampled_tokens.values()), 20)
+
+    def _assert_facets_consistent(self):
+        """Asserts that the facet counts match counts of the Tag table."""
+        unfaceted_tags = database._sql_list(database._UNFACETED_TAGS)  # pylint: disable=protected-access
+        filter_tags = database._sql_list(database._FACET_FILTER_TAGS)  # pylint: disable=protected-access
+        with self._database._db.snapshot() as snapshot:  # pylint: disable=protected-access
+            self.assertCountEqual(
+                snapshot.execute(f"""
+                    SELECT type, tag_name, tag_value, count(*)
+                    FROM Tag JOIN Entity USING (entity_id)
+                    WHERE tag_name NOT IN {unfaceted_tags}
+                    GROUP BY type, tag_name, tag_value
+                """).fetchall(),
+                snapshot.execute('SELECT * FROM FacetCount').fetchall(),
+            )
+            self.assertCountEqual(
+                snapshot.execute(f"""
+                    SELECT
+                        type, Filter.tag_name, Filter.tag_value,
+                        Value.tag_name, Value.tag_value, count(*)
+                    FROM Tag AS Filter
+                    JOIN Tag AS Value USING (entity_id)
+                    JOIN Entity USING (entity_id)
+                    WHERE Filter.tag_name IN {filter_tags}
+                        AND Value.tag_name IN {filter_tags}
+                    GROUP BY
+                        type, Filter.tag_name, Filter.tag_value,
+                        Value.tag_name, Value.tag_value
+                """).fetchall(),
+                snapshot.execute('SELECT * FROM FacetPairCount').fetchall(),
+            )
+
+    def _insert_facet_files(self):
+        """Inserts and returns four files with tags to facet by."""
+        files = (
+            _audio_file(
+                '/a/1', {
+                    'album': ('a',),
+                    'artist': ('x',),
+                    'genre': ('rock',),
+                    'date': ('2000-01-02',),
+                }),
+            _audio_file(
+                '/a/2', {
+                    'album': ('a',),
+                    'artist': ('x', 'y'),
+                    'genre': ('rock',),
+                    'date': ('2000',),
+                }),
+            _audio_file('/b/1', {
+                'album': ('b',),
+                'artist': ('y',),
+                'genre': ('jazz',),
+            }),
+            _audio_file('/c/1', {
+                'album': ('c',),
+                'artist': ('z',),
+                'genre': ('jazz',),
+            }),
+        )
+        self._database.insert_files(files)
+        return files
+
+    def test_facet(self):
+        self._insert_facet_files()
+        self.assertEqual(
+            [
+                database.FacetValue(value='x', count=2),
+                database.FacetValue(value='y', count=2),
+                database.FacetValue(value='z', count=1),
+            ],
+            self._database.facet(tag.ARTIST),
+        )
+        self.assertEqual(
+            [database.FacetValue(value='2000', count=2)],
+            self._database.facet(tag.PARSED_YEAR),
+        )
+        self.assertEqual(
+            [
+                database.FacetValue(value='jazz', count=2),
+                database.FacetValue(value='rock', count=1),
+            ],
+            self._database.facet('genre', token_type=token.Album),
+        )
+        self._assert_facets_consistent()
+
+    def test_facet_limit(self):
+        self._insert_facet_files()
+        self.assertEqual(
+            [database.FacetValue(value='x', count=2)],
+            self._database.facet(tag.ARTIST, limit=1),
+        )
+
+    def test_facet_filtered_by_facet(self):
+        self._insert_facet_files()
+        self.assertEqual(
+            [
+                database.FacetValue(value='x', count=2),
+                database.FacetValue(value='y', count=1),
+            ],
+            self._database.facet(tag.ARTIST, filter_by=(tag.GENRE, 'rock')),
+        )
+        self.assertEqual(
+            [
+                database.FacetValue(value='jazz', count=1),
+                database.FacetValue(value='rock', count=1),
+            ],
+            self._database.facet(tag.GENRE, filter_by=(tag.ARTIST, 'y')),
+        )
+        self.assertEqual(
+            [
+                database.FacetValue(value='x', count=2),
+                database.FacetValue(value='y', count=1),
+            ],
+            self._database.facet(tag.ARTIST, filter_by=(tag.ARTIST, 'x')),
+        )
+
+    def test_facet_filtered_by_other_tag(self):
+        self._insert_facet_files()
+        self.assertEqual(
+            [
+                database.FacetValue(value='x', count=2),
+                database.FacetValue(value='y', count=1),
+            ],
+            self._database.facet(tag.ARTIST, filter_by=(tag.ALBUM, 'a')),
+        )
+
+    def test_facet_unsupported_tag(self):
+        with self.assertRaisesRegex(ValueError, 'does not have facets'):
+            self._database.facet(tag.FILENAME)
+
+    def test_facet_counts_duplicate_values_once_for_each(self):
+        self._database.insert_files(
+            (_audio_file('/a/1', {
+                'album': ('a',),
+                'artist': ('x', 'x'),
+                'genre': ('rock',),
+            }),))
+        self._assert_facets_consistent()
+        self.assertEqual(
+            [database.FacetValue(value='x', count=2)],
+            self._database.facet(tag.ARTIST),
+        )
+        self.assertEqual(
+            [database.FacetValue(value='x', count=2)],
+            self._database.facet(tag.ARTIST, filter_by=(tag.GENRE, 'rock')),
+        )
+        self.assertEqual(
+            [database.FacetValue(value='x', count=2)],
+            self._database.facet(tag.ARTIST, filter_by=(tag.ALBUM, 'a')),
+        )
+        self._database.remove_files(('/a/1',))
+        self._assert_facets_consistent()
+        self.assertEqual([], self._database.facet(tag.ARTIST))
+
+    def test_facet_follows_changes(self):
+        files = self._insert_facet_files()
+        self._database.update_files('/a', (
+            _audio_file('/a/1', {
+                'album': ('a',),
+                'artist': ('z',),
+                'genre': ('jazz',),
+            }),
+            _unchanged_file(files[1]),
+        ))
+        self._assert_facets_consistent()
+        self._database.remove_files(('/c/1',))
+        self._assert_facets_consistent()
+        self.assertEqual(
+            [
+                database.FacetValue(value='y', count=2),
+                database.FacetValue(value='x', count=1),
+                database.FacetValue(value='z', count=1),
+            ],
+            self._database.facet(tag.ARTIST),
+        )
+        self.assertEqual(
+            [
+                database.FacetValue(value='y', count=1),
+                database.FacetValue(value='z', count=1),
+            ],
+            self._database.facet(tag.ARTIST, filter_by=(tag.GENRE, 'jazz')),
+        )
+        self._database.update_files('/', ())
+        self._assert_facets_consistent()
+        self.assertEqual([], self._database.facet(tag.ARTIST))
+
+    def test_filter(self):
+        a1, a2, b1, c1 = self._insert_facet_files()
+        self.assertEqual(
+            [a1.track.token, a2.track.token],
+            self._database.filter('genre=rock', token_type=token.Track),
+        )
+        self.assertEqual(
+            [b1.track.album_token, c1.track.album_token],
+            self._database.filter('genre=jazz', token_type=token.Album),
+        )
+
+    def test_filter_match(self):
+        _, a2, _, _ = self._insert_facet_files()
+        self.assertEqual(
+            [a2.track.token],
+            self._database.filter('artist:Y genre:roc', token_type=token.Track),
+        )
+
+    def test_filter_numeric(self):
+        a1, a2, _, _ = self._insert_facet_files()
+        self.assertEqual(
+            [a1.track.token, a2.track.token],
+            self._database.filter('~parsed_year=1999..2000',
+                                  token_type=token.Track),
+        )
+        self.assertEqual(
+            [a1.track.token, a2.track.token],
+            self._database.filter('date>=2000 date<2000.5',
+                                  token_type=token.Track),
+        )
+        self.assertFalse(self._database.filter('~parsed_year>2000'))
+
+    def test_filter_boolean_operators(self):
+        a1, a2, b1, c1 = self._insert_facet_files()
+        self.assertEqual(
+            [a1.track.token, a2.track.token, b1.track.token],
+            self._database.filter(
+                '(genre=jazz OR artist=x) NOT artist=z',
+                token_type=token.Track,
+            ),
+        )
+        self.assertEqual(
+            [b1.track.token, c1.track.token],
+            self._database.filter('NOT has:date', token_type=token.Track),
+        )
+
+    def test_filter_sort_by_and_limit(self):
+        file1 = _audio_file('/a/1', {'artist': ('z',), 'genre': ('rock',)})
+        file2 = _audio_file('/a/2', {'artist': ('y',), 'genre': ('rock',)})
+        file3 = _audio_file('/a/3', {'artist': ('x',), 'genre': ('rock',)})
+        self._database.insert_files((file1, file2, file3))
+        self.assertEqual(
+            [file3.track.token, file2.track.token],
+            self._database.filter(
+                'genre=rock',
+                token_type=token.Track,
+                sort_by=collation.SortField.ARTIST,
+                limit=2,
+            ),
+        )
+        self.assertEqual(
+            [file1.track.token],
+            self._database.filter('genre=rock', token_type=token.Track,
+                                  limit=1),
+        )
+
+    def test_filter_invalid(self):
+        with self.assertRaisesRegex(ValueError, 'Invalid query'):
+            self._database.filter('(artist=x')
+
     def test_track_not_found(self):
         with self.assertRaises(KeyError):
             self._database.track(token.Track('foo'))
 
+    def test_tracks(self):
+        files = tuple(_audio_file(f'/a/{i}') for i in range(5))
+        self._database.insert_files(files)
+        self.assertEqual(
+            {file_info.track.token: file_info.track for file_info in files},
+            self._database.tracks(file_info.track.token for file_info in files),
+        )
+
+    def test_tracks_chunks_long_lists(self):
+        files = tuple(_audio_file(f'/a/{i}') for i in range(5))
+        self._database.insert_files(files)
+        with mock.patch.object(database, '_MAX_IN_PARAMETERS', 2):
+            self.assertEqual(
+                {file_info.track.token: file_info.track for file_info in files},
+                self._database.tracks(
+                    file_info.track.token for file_info in files),
+            )
+
+    def test_tracks_empty(self):
+        self.assertEqual({}, self._database.tracks(()))
+
+    def test_tracks_not_found(self):
+        file_info = _audio_file('/a/b')
+        self._database.insert_files((file_info,))
+        with self.assertRaisesRegex(KeyError, 'foo'):
+            self._database.tracks((file_info.track.token, token.Track('foo')))
+
+    def test_tracks_wrong_type_not_found(self):
+        file_info = _audio_file('/a/b')
+        self._database.insert_files((file_info,))
+        with self.assertRaises(KeyError):
+            self._database.tracks(
+                (token.Track(str(file_info.track.medium_token)),))
+
     def test_medium_not_found(self):
         with self.assertRaises(KeyError):
             self._database.medium(token.Medium('foo'))
@@ -194,20 +1489,88 @@ class DatabaseTest(unittest.TestCase):
             scan.AudioFile(filename='/dir1/file1',
                            dirname='/dir1',
                            basename='file1',
+                           fingerprint=None,
                            track=track1),
             scan.AudioFile(filename='/dir1/file2',
                            dirname='/dir1',
                            basename='file2',
+                           fingerprint=None,
                            track=track2),
             scan.AudioFile(filename='/dir1/file3',
                            dirname='/dir1',
                            basename='file3',
+                           fingerprint=None,
                            track=track_undefined),
         ))
         self.assertEqual(
             (track_undefined, track1, track2),
             self._database.medium(track_undefined.medium_token).tracks)
 
+    def test_album_uses_constant_number_of_queries(self):
+        small_album = _audio_file('/a/b', {'album': ('small',)})
+        big_album = tuple(
+            _audio_file(
+                f'/big/{disc}-{track}', {
+                    'album': ('big',),
+                    'discnumber': (str(disc),),
+                    'tracknumber': (str(track),),
+                }) for disc in range(3) for track in range(10))
+        self._database.insert_files((small_album, *big_album))
+
+        def count_statements(album_token):
+            statements = []
+            with self._database._db.snapshot() as snapshot:  # pylint: disable=protected-access
+                snapshot.set_trace_callback(statements.append)
+                try:
+                    self._database.album(album_token, snapshot=snapshot)
+                finally:
+                    snapshot.set_trace_callback(None)
+            return len(statements)
+
+        self.assertEqual(
+            count_statements(small_album.track.album_token),
+            count_statements(big_album[0].track.album_token),
+        )
+
+    def test_albums(self):
+        files = tuple(
+            _audio_file(f'/a/{i}', {'album': (str(i),)}) for i in range(3))
+        self._database.insert_files(files)
+        album_tokens = tuple(file_info.track.album_token for file_info in files)
+        albums = self._database.albums(album_tokens)
+        self.assertEqual(set(album_tokens), set(albums))
+        for file_info in files:
+            self.assertEqual(
+                self._database.album(file_info.track.album_token),
+                albums[file_info.track.album_token],
+            )
+            self.assertEqual(
+                self._database.medium(file_info.track.medium_token),
+                self._database.mediums((file_info.track.medium_token,
+                                       ))[file_info.track.medium_token],
+            )
+
+    def test_albums_uses_constant_number_of_queries(self):
+        files = tuple(
+            _audio_file(f'/a/{i}', {'album': (str(i),)}) for i in range(10))
+        self._database.insert_files(files)
+
+        def count_statements(album_tokens):
+            statements = []
+            with self._database._db.snapshot() as snapshot:  # pylint: disable=protected-access
+                snapshot.set_trace_callback(statements.append)
+                try:
+                    self._database.albums(album_tokens, snapshot=snapshot)
+                finally:
+                    snapshot.set_trace_callback(None)
+            return len(statements)
+
+        self.assertEqual(
+            count_statements((files[0].track.album_token,)),
+            count_statements(
+                tuple(file_info.track.album_token for file_info in files)),
+        )
+
     def test_album_not_found(self):
         with self.assertRaises(KeyError):
             self._database.album(token.Album('foo'))
@@ -232,24 +1595,264 @@ class DatabaseTest(unittest.TestCase):
             scan.AudioFile(filename='/dir1/file1',
                            dirname='/dir1',
                            basename='file1',
+                           fingerprint=None,
                            track=track1),
             scan.AudioFile(filename='/dir1/file2',
                            dirname='/dir1',
                            basename='file2',
+                           fingerprint=None,
                            track=track2),
             scan.AudioFile(filename='/dir1/file3',
                            dirname='/dir1',
                            basename='file3',
+                           fingerprint=None,
                            track=track_undefined),
         ))
         self.assertEqual(
             (medium_undefined, medium1, medium2),
             self._database.album(medium_undefined.album_token).mediums)
 
+    def test_cache_hits(self):
+        file_info = _audio_file('/a/1', {'album': ('foo',)})
+        self._database.insert_files((file_info,))
+        album = self._database.album(file_info.track.album_token)
+        self.assertEqual(album,
+                         self._database.album(file_info.track.album_token))
+        self.assertEqual(
+            database.CacheInfo(hits=1,
+                               misses=1,
+                               entries=1,
+                               max_entries=database._CACHE_SIZE),  # pylint: disable=protected-access
+            self._database.cache_info(),
+        )
+
+    def test_cache_bypassed_with_snapshot(self):
+        file_info = _audio_file('/a/1')
+        self._database.insert_files((file_info,))
+        with self._database._db.snapshot() as snapshot:  # pylint: disable=protected-access
+            self._database.track(file_info.track.token, snapshot=snapshot)
+        self.assertEqual(0, self._database.cache_info().entries)
+
+    def test_cache_evicts_least_recently_used(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        library_db = database.Database(database_dir=tempdir.name, cache_size=2)
+        files = tuple(_audio_file(f'/a/{i}') for i in range(3))
+        library_db.insert_files(files)
+        library_db.track(files[0].track.token)
+        library_db.track(files[1].track.token)
+        library_db.track(files[0].track.token)
+        library_db.track(files[2].track.token)
+        library_db.track(files[0].track.token)
+        library_db.track(files[1].track.token)
+        self.assertEqual(
+            database.CacheInfo(hits=2, misses=4, entries=2, max_entries=2),
+            library_db.cache_info(),
+        )
+
+    def test_cache_disabled(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        library_db = database.Database(database_dir=tempdir.name, cache_size=0)
+        file_info = _audio_file('/a/1')
+        library_db.insert_files((file_info,))
+        library_db.track(file_info.track.token)
+        library_db.track(file_info.track.token)
+        self.assertEqual(
+            database.CacheInfo(hits=0, misses=2, entries=0, max_entries=0),
+            library_db.cache_info(),
+        )
+
+    def test_cache_invalidated_by_changed_track(self):
+        track1 = _audio_file('/a/1', {'album': ('foo',), 'title': ('one',)})
+        track2 = _audio_file('/a/2', {'album': ('foo',), 'title': ('two',)})
+        other = _audio_file('/b/1', {'album': ('bar',)})
+        self._database.insert_files((track1, track2, other))
+        self._database.tracks((track1.track.token, track2.track.token))
+        self._database.album(track1.track.album_token)
+        self._database.album(other.track.album_token)
+        track1_changed = _audio_file('/a/1', {
+            'album': ('foo',),
+            'title': ('changed',),
+        })
+        self._database.update_files('/a',
+                                    (track1_changed, _unchanged_file(track2)))
+        self.assertEqual(2, self._database.cache_info().entries)
+        self.assertEqual(track1_changed.track,
+                         self._database.track(track1.track.token))
+        self.assertEqual(
+            (track1_changed.track, track2.track),
+            self._database.album(track1.track.album_token).mediums[0].tracks,
+        )
+        self.assertEqual(self._database.cache_info().misses, 6)
+
+    def test_cache_invalidated_by_added_track(self):
+        track1 = _audio_file('/a/1', {'album': ('foo',)})
+        track2 = _audio_file('/a/2', {'album': ('foo',)})
+        self._database.insert_files((track1,))
+        self._database.album(track1.track.album_token)
+        self._database.insert_files((track2,))
+        self.assertEqual(
+            (track1.track, track2.track),
+            self._database.album(track1.track.album_token).mediums[0].tracks,
+        )
+
+    def test_cache_invalidated_by_deleted_track(self):
+        track1 = _audio_file('/a/1', {'album': ('foo',)})
+        track2 = _audio_file('/a/2', {'album': ('foo',)})
+        self._database.insert_files((track1, track2))
+        self._database.track(track2.track.token)
+        self._database.album(track1.track.album_token)
+        self._database.update_files('/a', (_unchanged_file(track1),))
+        with self.assertRaises(KeyError):
+            self._database.track(track2.track.token)
+        self.assertEqual(
+            (track1.track,),
+            self._database.album(track1.track.album_token).mediums[0].tracks,
+        )
+
+    def test_cache_invalidated_by_deleted_album(self):
+        file_info = _audio_file('/a/1', {'album': ('foo',)})
+        self._database.insert_files((file_info,))
+        self._database.track(file_info.track.token)
+        self._database.medium(file_info.track.medium_token)
+        self._database.album(file_info.track.album_token)
+        self._database.update_files('/a', ())
+        self.assertEqual(0, self._database.cache_info().entries)
+        with self.assertRaises(KeyError):
+            self._database.album(file_info.track.album_token)
+
+    def test_cache_not_invalidated_by_rolled_back_transaction(self):
+        file_info = _audio_file('/a/1')
+        self._database.insert_files((file_info,))
+        self._database.track(file_info.track.token)
+        with self.assertRaises(sqlite3.IntegrityError):
+            self._database.insert_files((file_info,))
+        self.assertEqual(1, self._database.cache_info().entries)
+        with self._database._db.snapshot() as snapshot:  # pylint: disable=protected-access
+            self.assertFalse(
+                snapshot.execute('SELECT * FROM EntityChange').fetchall())
+
+    def test_cache_ignores_entities_loaded_before_invalidation(self):
+        file_info = _audio_file('/a/1', {'title': ('foo',)})
+        self._database.insert_files((file_info,))
+        original_entity_tree = self._database._entity_tree  # pylint: disable=protected-access
+
+        def entity_tree_then_write(*args, **kwargs):
+            tree = original_entity_tree(*args, **kwargs)
+            # Connections are per-thread, so this write doesn't wait for the
+            # snapshot that's loading the entity.
+            writer = threading.Thread(
+                target=self._database.update_files,
+                args=('/a', (_audio_file('/a/1', {'title': ('bar',)}),)),
+            )
+            writer.start()
+            writer.join()
+            return tree
+
+        with mock.patch.object(self._database,
+                               '_entity_tree',
+                               side_effect=entity_tree_then_write):
+            self.assertEqual(file_info.track,
+                             self._database.track(file_info.track.token))
+        self.assertEqual(0, self._database.cache_info().entries)
+
 
 class DatabaseReverseUnorderedSelectsTest(DatabaseTest):
     REVERSE_UNORDERED_SELECTS = True
 
 
+class SchemaTest(unittest.TestCase):
+
+    def test_schema_changes_bump_version(self):
+        # Existing databases of a version must match its items. If this fails
+        # because the items changed, change the version, add a migration from
+        # the old version, then update the digest here.
+        schema = database._SCHEMA  # pylint: disable=protected-access
+        digest = hashlib.sha256('\n'.join(
+            sqlite3_db.normalize_sql(item.create)
+            for item in schema.items).encode('utf-8')).hexdigest()
+        self.assertEqual(
+            (
+                'v1alpha2',
+                'dc449bff9e34cc003732b42b0251c85e'
+                '9eb45d7703d7145a71a41a0c79ca82e0',
+            ),
+            (schema.version, digest),
+        )
+
+
+# Statements that are allowed to have full scans or temp B-trees, and why.
+_QUERY_PLAN_ALLOWED = {
+    r'FROM EntityChange ORDER BY change_id':
+        'The queue of changes is drained in every write transaction.',
+    r'WITH RECURSIVE Tree':
+        'The tree of a single album is sorted.',
+    r'FROM Entity ORDER BY browse_key LIMIT':
+        'Browsing reads the browse key index in order, until the limit.',
+    r'FROM TagSearch JOIN Tag':
+        'Search results are grouped and ranked after matching.',
+    r'FROM FacetPairCount WHERE':
+        'Values for a single filter are few enough to sort.',
+    r'FROM Tag AS Filter CROSS JOIN Entity':
+        'Facets with other filters group the matching entities.',
+    r'WITH Result \(entity_id, token, type, browse_key\)':
+        'Filter results are sorted after matching.',
+}
+
+
+class DatabaseQueryPlanTest(sqlite3_db_testlib.TestCase):
+
+    def test_statements_use_indexes(self):
+        files = tuple(
+            _audio_file(
+                f'/album{album}/{disc}.{track}', {
+                    'album': (f'album{album}',),
+                    'artist': (f'artist{album % 2}',),
+                    'genre': (f'genre{album % 3}',),
+                    'date': (f'{2000 + album}',),
+                    'discnumber': (str(disc),),
+                    'tracknumber': (str(track),),
+                }) for album in range(3) for disc in range(1, 3)
+            for track in range(1, 3))
+        with sqlite3_db_testlib.record_statements() as statements:
+            tempdir = tempfile.TemporaryDirectory()
+            self.addCleanup(tempdir.cleanup)
+            library_db = database.Database(database_dir=tempdir.name)
+            library_db.insert_files(files)
+            library_db.track(files[0].track.token)
+            library_db.medium(files[0].track.medium_token)
+            library_db.album(files[0].track.album_token)
+            library_db.search('album1')
+            library_db.search('artist:artist0 album',
+                              sort_by=collation.SortField.ALBUM)
+            page = library_db.search_page(page_size=2)
+            library_db.search_page(page_size=2, page_token=page.next_page_token)
+            library_db.facet(tag.ARTIST)
+            library_db.facet(tag.ARTIST, filter_by=(tag.GENRE, 'genre0'))
+            library_db.facet(tag.ARTIST, filter_by=(tag.ALBUM, 'album0'))
+            library_db.filter('genre=genre0 NOT ~parsed_year<2001 album:album')
+            library_db.random_sample(2)
+            library_db.update_files('/', files[1:])
+            library_db.insert_files(files[:1])
+            library_db.remove_files((files[0].filename,))
+            library_db.delete_orphans()
+            music_dirpath = pathlib.Path(tempdir.name, 'music')
+            music_dirpath.mkdir()
+            foo = music_dirpath.joinpath('foo.flac')
+            foo.write_bytes(scan_testlib.flac_with_tags({'title': ('Foo',)}))
+            library_db.rescan(str(music_dirpath),
+                              skip_unchanged_directories=True)
+            foo.rename(music_dirpath.joinpath('bar.flac'))
+            with mock.patch.object(scan.mutagen,
+                                   'File',
+                                   side_effect=AssertionError('Read a file.')):
+                library_db.rescan(str(music_dirpath))
+            library_db.directories(str(music_dirpath))
+            library_db.file_partial_hashes(str(music_dirpath))
+        self.assert_query_plans_use_indexes(statements,
+                                            allowed=_QUERY_PLAN_ALLOWED)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,544 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Query language for filtering the library by tags.
+
+Queries are parsed into a tree of Nodes, optimized, and compiled into a SQL
+condition on the Tag and TagSearch tables of library.database. The syntax is:
+
+    foo                 Any value of any tag contains the words in foo, with the
+                        last word as a prefix, ignoring case and diacritics.
+    artist:foo          Same, but only for values of artist.
+    artist=foo          Any value of artist is exactly foo.
+    artist!=foo         No value of artist is exactly foo.
+    ~parsed_year>=1990  Any value of ~parsed_year is at least 1990. The <, <=,
+                        >, and >= operators compare numerically if the value is
+                        a number, and by code point otherwise.
+    ~parsed_year=1990..1999
+                        Any value of ~parsed_year is in the inclusive range.
+                        Either end can be omitted, e.g., 1990.. for at least
+                        1990.
+    has:artist          There's any value of artist.
+    a b, a AND b        Both a and b match.
+    a OR b              Either a or b matches.
+    NOT a               a doesn't match.
+    (a OR b) c          Parentheses group terms.
+
+NOT binds tighter than AND, which binds tighter than OR. Keywords are
+case-sensitive, so 'and', 'or', and 'not' are just words. Values with spaces or
+special characters can be double quoted, with "" for a literal double quote,
+e.g., title="foo ""bar"" baz". Numeric comparisons use the number at the start
+of each value, so date>=1990 matches a date of 1999-12-31, and values that
+don't start with a digit never match them. Terms without any words, e.g., '&',
+are ignored, like in Database.search().
+"""
+
+import dataclasses
+import enum
+import re
+from typing import Any, Callable, List, Optional, Sequence, Tuple, Union
+
+from pepper_music_player import sqlite3_db
+
+_TOKEN_REGEX = re.compile(
+    r"""
+    \s*
+    (?:
+        (?P<paren>[()])
+        | "(?P<quoted>(?:[^"]|"")*)"
+        | (?P<operator>!=|<=|>=|[=<>:])
+        | (?P<word>(?:[^\s()"=<>:!]|!(?!=))+)
+        | (?P<invalid>\S)
+    )
+    """,
+    re.VERBOSE,
+)
+
+_NUMBER_REGEX = re.compile(r'\d+(?:\.\d+)?')
+
+_KEYWORDS = frozenset(('AND', 'OR', 'NOT'))
+
+
+class Operator(enum.Enum):
+    """Comparison operator."""
+    EQ = '='
+    LT = '<'
+    LE = '<='
+    GT = '>'
+    GE = '>='
+
+
+# Value in a comparison. Numbers are compared numerically, and strings by code
+# point.
+Value = Union[str, float]
+
+
+@dataclasses.dataclass(frozen=True)
+class Node:
+    """Base class for nodes in a parsed query."""
+
+
+@dataclasses.dataclass(frozen=True)
+class Match(Node):
+    """Full text match of tag values, like a term in Database.search().
+
+    Attributes:
+        tag_name: Tag to match, or None for any tag.
+        text: Text to find in the tag's values.
+    """
+    tag_name: Optional[str]
+    text: str
+
+
+@dataclasses.dataclass(frozen=True)
+class Compare(Node):
+    """Comparison of tag values to a value.
+
+    Attributes:
+        tag_name: Tag to compare.
+        operator: How to compare the tag's values to value.
+        value: Value to compare to.
+    """
+    tag_name: str
+    operator: Operator
+    value: Value
+
+
+@dataclasses.dataclass(frozen=True)
+class Range(Node):
+    """Inclusive range of tag values.
+
+    Attributes:
+        tag_name: Tag to compare.
+        low: Lowest value in the range, or None for no lower bound.
+        high: Highest value in the range, or None for no upper bound.
+    """
+    tag_name: str
+    low: Optional[Value]
+    high: Optional[Value]
+
+
+@dataclasses.dataclass(frozen=True)
+class Has(Node):
+    """Existence of any value of a tag.
+
+    Attributes:
+        tag_name: Tag to look for.
+    """
+    tag_name: str
+
+
+@dataclasses.dataclass(frozen=True)
+class And(Node):
+    """Conjunction of nodes. With no operands, this matches everything.
+
+    Attributes:
+        operands: Nodes that must all match.
+    """
+    operands: Tuple[Node, ...] = ()
+
+
+@dataclasses.dataclass(frozen=True)
+class Or(Node):
+    """Disjunction of nodes. With no operands, this matches nothing.
+
+    Attributes:
+        operands: Nodes, any of which must match.
+    """
+    operands: Tuple[Node, ...] = ()
+
+
+@dataclasses.dataclass(frozen=True)
+class Not(Node):
+    """Negation of a node.
+
+    Attributes:
+        operand: Node that must not match.
+    """
+    operand: Node
+
+
+_MATCH_ALL = And()
+_MATCH_NONE = Or()
+
+
+def _tokenize(query: str) -> List[Tuple[str, str]]:
+    """Returns (kind, text) for each token in the query."""
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = _TOKEN_REGEX.match(query, position)
+        if match is None or match.lastgroup == 'invalid':
+            raise ValueError(f'Invalid query {query!r}: unexpected character '
+                             f'at position {position}.')
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'quoted':
+            text = text.replace('""', '"')
+        elif kind == 'word' and text in _KEYWORDS:
+            kind = 'keyword'
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+def _value(text: str, *, quoted: bool) -> Value:
+    """Returns the value of a comparison operand."""
+    if not quoted and _NUMBER_REGEX.fullmatch(text):
+        return float(text)
+    return text
+
+
+class _Parser:
+    """Recursive descent parser for queries."""
+
+    def __init__(self, query: str) -> None:
+        self._query = query
+        self._tokens = _tokenize(query)
+        self._index = 0
+
+    def _error(self, message: str) -> ValueError:
+        return ValueError(f'Invalid query {self._query!r}: {message}')
+
+    def _peek(self) -> Optional[Tuple[str, str]]:
+        if self._index < len(self._tokens):
+            return self._tokens[self._index]
+        return None
+
+    def _next(self) -> Tuple[str, str]:
+        token = self._peek()
+        if token is None:
+            raise self._error('unexpected end of query.')
+        self._index += 1
+        return token
+
+    def parse(self) -> Node:
+        if not self._tokens:
+            return _MATCH_ALL
+        node = self._or()
+        if self._peek() is not None:
+            raise self._error(f'unexpected {self._peek()[1]!r}.')
+        return node
+
+    def _or(self) -> Node:
+        operands = [self._and()]
+        while self._peek() == ('keyword', 'OR'):
+            self._next()
+            operands.append(self._and())
+        return operands[0] if len(operands) == 1 else Or(tuple(operands))
+
+    def _and(self) -> Node:
+        operands = [self._unary()]
+        while True:
+            token = self._peek()
+            if token is None or token in (('keyword', 'OR'), ('paren', ')')):
+                break
+            if token == ('keyword', 'AND'):
+                self._next()
+            operands.append(self._unary())
+        return operands[0] if len(operands) == 1 else And(tuple(operands))
+
+    def _unary(self) -> Node:
+        if self._peek() == ('keyword', 'NOT'):
+            self._next()
+            return Not(self._unary())
+        return self._atom()
+
+    def _operand(self) -> Tuple[str, bool]:
+        """Returns the text of the next token and whether it was quoted."""
+        kind, text = self._next()
+        if kind not in ('word', 'quoted', 'keyword'):
+            raise self._error(f'expected a value, got {text!r}.')
+        return text, kind == 'quoted'
+
+    def _atom(self) -> Node:
+        """Returns a parenthesized query, a search term, or a comparison."""
+        kind, text = self._next()
+        if (kind, text) == ('paren', '('):
+            node = self._or()
+            if self._peek() != ('paren', ')'):
+                raise self._error('expected ")".')
+            self._next()
+            return node
+        if kind == 'quoted':
+            return _match(None, text)
+        if kind != 'word':
+            raise self._error(f'unexpected {text!r}.')
+        next_token = self._peek()
+        if next_token is None or next_token[0] != 'operator':
+            return _match(None, text)
+        tag_name = text.lower()
+        operator = self._next()[1]
+        value, quoted = self._operand()
+        if operator == ':':
+            if tag_name == 'has':
+                return Has(value.lower())
+            return _match(tag_name, value)
+        elif operator == '!=':
+            return Not(Compare(tag_name, Operator.EQ, value))
+        elif operator == '=' and not quoted and '..' in value:
+            bounds = [bound or None for bound in value.split('..', 1)]
+            if bounds == [None, None]:
+                raise self._error(f'range {value!r} has no bounds.')
+            # Both bounds are numbers, or neither is.
+            numeric = all(bound is None or _NUMBER_REGEX.fullmatch(bound)
+                          for bound in bounds)
+            low, high = (_value(bound, quoted=not numeric)
+                         if bound is not None else None for bound in bounds)
+            return Range(tag_name, low=low, high=high)
+        elif operator == '=':
+            return Compare(tag_name, Operator.EQ, value)
+        compared_value = _value(value, quoted=quoted)
+        return Compare(tag_name, Operator(operator), compared_value)
+
+
+def _match(tag_name: Optional[str], text: str) -> Node:
+    """Returns a Match node, or a node matching everything without words."""
+    if re.search(r'\w', text) is None:
+        return _MATCH_ALL
+    return Match(tag_name, text)
+
+
+def parse(query: str) -> Node:
+    """Parses a query.
+
+    Args:
+        query: Query, see the module docstring for the syntax.
+
+    Returns:
+        Root of the parsed query.
+
+    Raises:
+        ValueError: The query is invalid.
+    """
+    return _Parser(query).parse()
+
+
+# Estimated fraction of entities that match each type of node, for nodes that
+# the estimate function passed to optimize() doesn't know about.
+_DEFAULT_SELECTIVITY = {
+    Compare: 0.01,
+    Match: 0.05,
+    Range: 0.2,
+    Has: 0.5,
+}
+
+
+def default_selectivity(node: Node) -> float:
+    """Returns the estimated fraction of entities that match a leaf node."""
+    if isinstance(node, Compare) and node.operator is not Operator.EQ:
+        return _DEFAULT_SELECTIVITY[Range]
+    return _DEFAULT_SELECTIVITY[type(node)]
+
+
+def _selectivity(node: Node, estimate: Callable[[Node], float]) -> float:
+    """Returns the estimated fraction of entities that match any node."""
+    if isinstance(node, And):
+        selectivity = 1.0
+        for operand in node.operands:
+            selectivity *= _selectivity(operand, estimate)
+        return selectivity
+    elif isinstance(node, Or):
+        non_selectivity = 1.0
+        for operand in node.operands:
+            non_selectivity *= 1.0 - _selectivity(operand, estimate)
+        return 1.0 - non_selectivity
+    elif isinstance(node, Not):
+        return 1.0 - _selectivity(node.operand, estimate)
+    else:
+        return estimate(node)
+
+
+def optimize(
+        node: Node,
+        estimate: Callable[[Node], float] = default_selectivity,
+) -> Node:
+    """Returns an equivalent node that's faster to evaluate.
+
+    Nested conjunctions and disjunctions are flattened, double negations are
+    removed, and operands are reordered so that the most selective operand of
+    each conjunction is first, and the least selective operand of each
+    disjunction is first. compile_condition() uses the first operand of the
+    top-level conjunction to find candidates, and SQLite stops evaluating each
+    conjunction or disjunction as soon as its result is known.
+
+    Args:
+        node: Node to optimize.
+        estimate: Function that returns the estimated fraction of entities
+            that match a leaf node, i.e., Match, Compare, Range, or Has.
+    """
+    if isinstance(node, Not):
+        operand = optimize(node.operand, estimate)
+        if isinstance(operand, Not):
+            return operand.operand
+        elif operand == _MATCH_ALL:
+            return _MATCH_NONE
+        elif operand == _MATCH_NONE:
+            return _MATCH_ALL
+        return Not(operand)
+    elif not isinstance(node, (And, Or)):
+        return node
+    node_type = type(node)
+    # The identity of each operation, e.g., _MATCH_ALL for And, has no operands,
+    # so flattening removes it.
+    absorbing = _MATCH_NONE if node_type is And else _MATCH_ALL
+    operands = []
+    for operand in node.operands:
+        operand = optimize(operand, estimate)
+        if operand == absorbing:
+            return absorbing
+        for flattened in (operand.operands
+                          if isinstance(operand, node_type) else (operand,)):
+            if flattened not in operands:
+                operands.append(flattened)
+    if len(operands) == 1:
+        return operands[0]
+    selectivities = {
+        operand: _selectivity(operand, estimate) for operand in operands
+    }
+    operands.sort(key=selectivities.__getitem__, reverse=node_type is Or)
+    return node_type(tuple(operands))
+
+
+def _append_tag_condition(
+        builder: sqlite3_db.QueryBuilder,
+        node: Node,
+        *,
+        lookup: bool,
+) -> None:
+    """Appends a condition on Tag for a Compare or Range node.
+
+    Args:
+        builder: Builder to append to.
+        node: Node to append a condition for.
+        lookup: Whether to use the index on (tag_name, tag_value). If not, the
+            condition is for checking the tags of a single entity.
+    """
+    if isinstance(node, Compare):
+        bounds = ((node.operator.value, node.value),)
+    else:
+        bounds = tuple(
+            (operator, value)
+            for operator, value in (('>=', node.low), ('<=', node.high))
+            if value is not None)
+    if all(isinstance(value, str) for _, value in bounds):
+        # Text comparisons can use the index on (tag_name, tag_value), which
+        # is slower than the index on entity_id for checking one entity.
+        for operator, value in bounds:
+            builder.append(
+                f'AND {"" if lookup else "+"}tag_value {operator} ?',
+                (value,),
+            )
+    else:
+        builder.append("AND tag_value GLOB '[0-9]*'")
+        for operator, value in bounds:
+            builder.append(f'AND CAST(tag_value AS REAL) {operator} ?',
+                           (value,))
+
+
+def _append_condition(
+        builder: sqlite3_db.QueryBuilder,
+        node: Node,
+        entity_id: str,
+        *,
+        lookup: bool,
+) -> None:
+    """Appends a condition for a node, see compile_condition().
+
+    Args:
+        builder: Builder to append to.
+        node: Node to append a condition for.
+        entity_id: See compile_condition().
+        lookup: Whether the condition can be used to look up candidates, or
+            only to check candidates found some other way.
+    """
+    if isinstance(node, (And, Or)):
+        if not node.operands:
+            builder.append('1' if isinstance(node, And) else '0')
+            return
+        builder.append('(')
+        for index, operand in enumerate(node.operands):
+            if index > 0:
+                builder.append('AND' if isinstance(node, And) else 'OR')
+            # Only the first operand of a conjunction is used to look up
+            # candidates, since the others are expected to match more entities.
+            _append_condition(
+                builder,
+                operand,
+                entity_id,
+                lookup=lookup and (index == 0 or isinstance(node, Or)),
+            )
+        builder.append(')')
+    elif isinstance(node, Not):
+        builder.append('NOT')
+        _append_condition(builder, node.operand, entity_id, lookup=False)
+    elif isinstance(node, Match):
+        # The full text query runs once either way, so checking candidates
+        # uses the same list of matches as looking them up, with a unary + to
+        # keep SQLite from using it for lookups. CROSS JOIN makes SQLite run
+        # the full text query once, instead of once for each value of the tag.
+        builder.append(
+            f"""
+            {entity_id if lookup else f'+{entity_id}'} IN (
+                SELECT Tag.entity_id
+                FROM TagSearch CROSS JOIN Tag ON Tag.tag_id = TagSearch.rowid
+                WHERE TagSearch MATCH ?
+            """,
+            ('"' + node.text.replace('"', '""') + '" *',),
+        )
+        if node.tag_name is not None:
+            builder.append('AND Tag.tag_name = ?', (node.tag_name,))
+        builder.append(')')
+    elif isinstance(node, (Compare, Range, Has)):
+        if lookup:
+            builder.append(
+                f'{entity_id} IN (SELECT entity_id FROM Tag WHERE tag_name = ?',
+                (node.tag_name,),
+            )
+        else:
+            # Checking each candidate's own tags is cheaper than building the
+            # list of every entity that matches.
+            builder.append(
+                f"""
+                EXISTS (
+                    SELECT 1 FROM Tag
+                    WHERE Tag.entity_id = {entity_id} AND tag_name = ?
+                """,
+                (node.tag_name,),
+            )
+        if not isinstance(node, Has):
+            _append_tag_condition(builder, node, lookup=lookup)
+        builder.append(')')
+    else:
+        raise TypeError(f'Unknown node type: {node!r}')
+
+
+def compile_condition(
+        node: Node,
+        entity_id: str = 'Entity.entity_id',
+) -> Tuple[str, Sequence[Any]]:
+    """Compiles a node into a SQL condition.
+
+    Args:
+        node: Node to compile, typically from optimize().
+        entity_id: SQL expression for the ID of the entity to test, qualified
+            with its table name.
+
+    Returns:
+        SQL condition that's true for entities that match the node, and its
+        parameters.
+    """
+    builder = sqlite3_db.QueryBuilder()
+    _append_condition(builder, node, entity_id, lookup=True)
+    return builder.build()
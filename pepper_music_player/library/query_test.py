@@ -0,0 +1,182 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for pepper_music_player.library.query."""
+
+import unittest
+
+from pepper_music_player.library import query
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(query.And(), query.parse('  '))
+
+    def test_match(self):
+        self.assertEqual(
+            query.And((
+                query.Match(None, 'foo'),
+                query.Match('artist', 'bar baz'),
+                query.Match(None, 'a "quoted" phrase'),
+            )),
+            query.parse('foo Artist:"bar baz" "a ""quoted"" phrase"'),
+        )
+
+    def test_match_without_words(self):
+        self.assertEqual(
+            query.And((query.Match(None, 'foo'), query.And())),
+            query.parse('foo &'),
+        )
+
+    def test_comparisons(self):
+        self.assertEqual(
+            query.And((
+                query.Compare('artist', query.Operator.EQ, 'Foo'),
+                query.Not(query.Compare('genre', query.Operator.EQ, '1990')),
+                query.Compare('~parsed_year', query.Operator.GE, 1990.0),
+                query.Compare('~duration_seconds', query.Operator.LT, 2.5),
+                query.Compare('title', query.Operator.GT, 'm'),
+                query.Compare('title', query.Operator.LE, '5'),
+            )),
+            query.parse('artist=Foo genre!=1990 ~parsed_year>=1990 '
+                        '~duration_seconds<2.5 title>m title<="5"'),
+        )
+
+    def test_range(self):
+        self.assertEqual(
+            query.And((
+                query.Range('~parsed_year', 1990.0, 1999.0),
+                query.Range('~parsed_tracknumber', 3.0, None),
+                query.Range('album', None, 'm'),
+                query.Range('title', '1', 'b'),
+                query.Compare('album', query.Operator.EQ, 'a..b'),
+            )),
+            query.parse('~parsed_year=1990..1999 ~parsed_tracknumber=3.. '
+                        'album=..m title=1..b album="a..b"'),
+        )
+
+    def test_has(self):
+        self.assertEqual(query.Has('artist'), query.parse('has:Artist'))
+
+    def test_boolean_operators(self):
+        a = query.Match(None, 'a')
+        b = query.Match(None, 'b')
+        c = query.Match(None, 'c')
+        self.assertEqual(
+            query.Or((
+                query.And((a, query.Not(b))),
+                query.And((query.Or((a, b)), c)),
+            )),
+            query.parse('a AND NOT b OR (a OR b) c'),
+        )
+
+    def test_lowercase_keywords_are_words(self):
+        self.assertEqual(
+            query.And((
+                query.Match(None, 'not'),
+                query.Match(None, 'and'),
+                query.Match(None, 'or'),
+            )),
+            query.parse('not and or'),
+        )
+
+    def test_invalid(self):
+        for query_str in (
+                '(foo',
+                'foo)',
+                'artist=',
+                'artist=(',
+                'year=..',
+                'NOT',
+                'a OR',
+                '"unterminated',
+                '=foo',
+        ):
+            with self.subTest(query_str):
+                with self.assertRaisesRegex(ValueError, 'Invalid query'):
+                    query.parse(query_str)
+
+
+class OptimizeTest(unittest.TestCase):
+
+    def test_flattens_and_removes_identities(self):
+        a = query.Match(None, 'a')
+        b = query.Match(None, 'b')
+        self.assertEqual(
+            query.And((a, b)),
+            query.optimize(query.And((a, query.And((b, query.And(), a))))),
+        )
+
+    def test_removes_double_negation(self):
+        a = query.Match(None, 'a')
+        self.assertEqual(a, query.optimize(query.Not(query.Not(a))))
+
+    def test_absorbing(self):
+        a = query.Match(None, 'a')
+        self.assertEqual(
+            query.Or(),
+            query.optimize(query.And((a, query.Not(query.And())))),
+        )
+        self.assertEqual(
+            query.And(),
+            query.optimize(query.Or((a, query.And()))),
+        )
+
+    def test_orders_by_selectivity(self):
+        exact = query.Compare('artist', query.Operator.EQ, 'foo')
+        match = query.Match(None, 'foo')
+        has = query.Has('artist')
+        self.assertEqual(
+            query.And((exact, match, has)),
+            query.optimize(query.And((has, match, exact))),
+        )
+        self.assertEqual(
+            query.Or((has, match, exact)),
+            query.optimize(query.Or((exact, match, has))),
+        )
+
+    def test_uses_estimate(self):
+        common = query.Compare('genre', query.Operator.EQ, 'rock')
+        rare = query.Compare('genre', query.Operator.EQ, 'polka')
+        self.assertEqual(
+            query.And((rare, common)),
+            query.optimize(
+                query.And((common, rare)),
+                lambda node: 0.5 if node == common else 0.001,
+            ),
+        )
+
+
+class CompileConditionTest(unittest.TestCase):
+
+    def test_looks_up_candidates_with_first_operand_only(self):
+        sql, parameters = query.compile_condition(
+            query.And((
+                query.Compare('artist', query.Operator.EQ, 'foo'),
+                query.Not(query.Has('genre')),
+            )))
+        self.assertIn('( Entity.entity_id IN', sql)
+        self.assertRegex(sql, r'NOT\s+EXISTS')
+        self.assertIn('Tag.entity_id = Entity.entity_id', sql)
+        self.assertEqual(('artist', 'foo', 'genre'), parameters)
+
+    def test_numeric_comparison(self):
+        sql, parameters = query.compile_condition(
+            query.Range('~parsed_year', 1990.0, 1999.0))
+        self.assertIn('CAST(tag_value AS REAL) >= ?', sql)
+        self.assertEqual(('~parsed_year', 1990.0, 1999.0), parameters)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,18 +13,52 @@
 # limitations under the License.
 """Scanning code to find music in a library."""
 
+import collections
+from concurrent import futures
 import dataclasses
+import enum
+import hashlib
 import mimetypes
 import os
-import pathlib
-from typing import Iterable
+import time
+from typing import Collection, DefaultDict, Deque, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
 
+import frozendict
 import mutagen
 
 from pepper_music_player.metadata import entity
 from pepper_music_player.metadata import tag
 
 
+@dataclasses.dataclass(frozen=True)
+class Fingerprint:
+    """Information about a file that changes when the file changes.
+
+    If a file's fingerprint is the same as it was the last time the file was
+    read, the file is assumed to be unchanged, without reading it again.
+
+    Attributes:
+        size: Size of the file, in bytes.
+        mtime_ns: Modification time of the file, in nanoseconds.
+        inode: Inode number of the file.
+        device: Device that the file is on.
+    """
+    size: int
+    mtime_ns: int
+    inode: int
+    device: int
+
+    @classmethod
+    def from_stat(cls, stat_result: os.stat_result) -> 'Fingerprint':
+        """Returns the fingerprint for a result from os.stat()."""
+        return cls(
+            size=stat_result.st_size,
+            mtime_ns=stat_result.st_mtime_ns,
+            inode=stat_result.st_ino,
+            device=stat_result.st_dev,
+        )
+
+
 @dataclasses.dataclass(frozen=True)
 class File:
     """A file in the music library.
@@ -33,10 +67,36 @@ class File:
         filename: Absolute filename.
         dirname: Absolute name of the directory containing the file.
         basename: Name of the file, relative to dirname.
+        fingerprint: Fingerprint of the file when it was scanned, or None if
+            it's unknown.
     """
     filename: str
     dirname: str
     basename: str
+    fingerprint: Optional[Fingerprint]
+
+
+@dataclasses.dataclass(frozen=True)
+class UnchangedFile(File):
+    """A file that is unchanged since it was last scanned, so it wasn't read."""
+
+
+@dataclasses.dataclass(frozen=True)
+class MovedFile(File):
+    """An audio file with the same contents as a known file, so it wasn't read.
+
+    This is usually a file that was moved or renamed since it was last scanned,
+    but the source file could also still exist, e.g., if it's a hard link or a
+    copy.
+
+    Attributes:
+        source_filename: Absolute filename of the known file.
+        source_fingerprint: Known fingerprint of the source file. If the source
+            file's fingerprint in the database is different, its tags can't be
+            reused.
+    """
+    source_filename: str
+    source_fingerprint: Fingerprint
 
 
 @dataclasses.dataclass(frozen=True)
@@ -45,8 +105,10 @@ class AudioFile(File):
 
     Attributes:
         track: The track in the file.
+        partial_hash: See _partial_hash(), or None if it's unknown.
     """
     track: entity.Track
+    partial_hash: Optional[bytes] = None
 
 
 @dataclasses.dataclass(frozen=True)
@@ -59,6 +121,23 @@ class ImageFile(File):
     image: entity.Image
 
 
+@dataclasses.dataclass(frozen=True)
+class Directory:
+    """A directory in the music library.
+
+    Attributes:
+        dirname: Absolute name of the directory.
+        mtime_ns: Modification time of the directory when it was listed, in
+            nanoseconds, or None if it was modified too recently for its
+            modification time to reliably reflect later changes.
+        entry_count: Number of files and subdirectories in the directory, not
+            counting anything that scanning ignores, e.g., broken symlinks.
+    """
+    dirname: str
+    mtime_ns: Optional[int]
+    entry_count: int
+
+
 def _read_audio_tags(dirname: str, basename: str, filename: str) -> tag.Tags:
     """Returns tags read from an audio file."""
     file_info = mutagen.File(filename, easy=True)
@@ -82,38 +161,543 @@ def _read_image_tags(dirname: str, basename: str, filename: str) -> tag.Tags:
     }).derive()
 
 
-def scan(root_dirname: str) -> Iterable[File]:
-    """Scans a directory."""
-    # TODO: Keep track of errors with os.walk(onerror=...)
-    # TODO: Catch and handle per-file errors.
-    for dirname, _, basenames in os.walk(os.path.abspath(root_dirname)):
-        dirpath = pathlib.Path(dirname)
-        for basename in basenames:
-            filepath = dirpath.joinpath(basename)
-            mime, _ = mimetypes.guess_type(filepath.as_uri())
-            mime_major, _, _ = (mime or '').partition('/')
-            if mime_major == 'audio':
-                yield AudioFile(
-                    filename=str(filepath),
+# Number of bytes from each end of a file to include in _partial_hash().
+_PARTIAL_HASH_CHUNK_SIZE = 64 * 1024
+
+
+def _partial_hash(filename: str) -> bytes:
+    """Returns a hash of the beginning and end of a file.
+
+    This is much cheaper than hashing the entire file, and most audio formats
+    have their tags at one end or the other. Along with the file's size, it's
+    enough to recognize a known file that was copied to a new inode, e.g., by
+    moving it to a different filesystem.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as file_:
+        hasher.update(file_.read(_PARTIAL_HASH_CHUNK_SIZE))
+        size = os.fstat(file_.fileno()).st_size
+        if size > 2 * _PARTIAL_HASH_CHUNK_SIZE:
+            file_.seek(-_PARTIAL_HASH_CHUNK_SIZE, os.SEEK_END)
+        hasher.update(file_.read())
+    return hasher.digest()
+
+
+# Number of audio files to send to a worker process at once. Sending files in
+# batches amortizes the inter-process communication overhead, which is
+# significant compared to reading the tags of a single file.
+_AUDIO_BATCH_SIZE = 16
+
+# Max number of files and directories per worker process that can be waiting to
+# be yielded.
+# This bounds memory use when the directory walk gets ahead of the workers,
+# while still keeping every worker busy.
+_MAX_PENDING_PER_WORKER = 4 * _AUDIO_BATCH_SIZE
+
+# Resolution of directory modification times to assume. This is the resolution
+# of FAT, which is coarser than most other filesystems.
+_MTIME_RESOLUTION_NS = 2 * 10**9
+
+
+def _trusted_mtime_ns(stat_result: os.stat_result) -> Optional[int]:
+    """Returns a directory's mtime, or None if it's too recent to rely on."""
+    # If a directory changes again within the resolution of its mtime (e.g.,
+    # while it's being listed), the mtime might not change. An old enough mtime
+    # must have been set before the listing, so the listing is up to date.
+    if time.time_ns() - stat_result.st_mtime_ns < _MTIME_RESOLUTION_NS:
+        return None
+    else:
+        return stat_result.st_mtime_ns
+
+
+# Map from (size, partial hash) to filename.
+_SizeAndHashIndex = Dict[Tuple[int, bytes], str]
+
+
+class _Walker:
+    """Walks a directory tree, without reading any files."""
+
+    def __init__(
+            self,
+            *,
+            known_fingerprints: Mapping[str, Fingerprint],
+            known_directories: Optional[Mapping[str, Directory]],
+            known_partial_hashes: Mapping[str, bytes],
+            changed_dirnames: Collection[str] = (),
+    ) -> None:
+        """Initializer.
+
+        Args:
+            known_fingerprints: See scan().
+            known_directories: See scan().
+            known_partial_hashes: See scan().
+            changed_dirnames: See scan().
+        """
+        self._known_fingerprints = known_fingerprints
+        self._known_directories = known_directories
+        self._changed_dirnames = frozenset(changed_dirnames)
+        self._known_partial_hashes = known_partial_hashes
+        # Indexes for finding the source of a MovedFile, built only when
+        # they're first needed.
+        self._filenames_by_fingerprint: Optional[Dict[Fingerprint, str]] = None
+        self._filenames_by_size_and_hash: Optional[_SizeAndHashIndex] = None
+        self._known_basenames: DefaultDict[str, List[str]] = (
+            collections.defaultdict(list))
+        self._known_subdirnames: DefaultDict[str, List[str]] = (
+            collections.defaultdict(list))
+        if known_directories is not None:
+            for filename in known_fingerprints:
+                dirname, basename = os.path.split(filename)
+                self._known_basenames[dirname].append(basename)
+            for dirname in known_directories:
+                self._known_subdirnames[os.path.dirname(dirname)].append(
+                    dirname)
+
+    def _move_source(
+            self,
+            filename: str,
+            fingerprint: Fingerprint,
+    ) -> Optional[str]:
+        """Returns the known file with the same contents, if there is one."""
+        if self._filenames_by_fingerprint is None:
+            self._filenames_by_fingerprint = {
+                known_fingerprint: known_filename for known_filename,
+                known_fingerprint in self._known_fingerprints.items()
+            }
+        # Moving or renaming a file within a filesystem keeps its inode and
+        # modification time.
+        source_filename = self._filenames_by_fingerprint.get(fingerprint)
+        if source_filename is not None or not self._known_partial_hashes:
+            return source_filename
+        if self._filenames_by_size_and_hash is None:
+            self._filenames_by_size_and_hash = {}
+            known_hashes = self._known_partial_hashes
+            for known_filename, known_hash in known_hashes.items():
+                known_fingerprint = self._known_fingerprints.get(known_filename)
+                if known_fingerprint is not None:
+                    key = (known_fingerprint.size, known_hash)
+                    self._filenames_by_size_and_hash[key] = known_filename
+        try:
+            partial_hash = _partial_hash(filename)
+        except OSError:
+            return None
+        return self._filenames_by_size_and_hash.get(
+            (fingerprint.size, partial_hash))
+
+    def _file(self, entry: os.DirEntry) -> Optional[File]:
+        """Returns a File, UnchangedFile, or MovedFile, or None to ignore it."""
+        try:
+            # This reuses the stat result from the directory listing where
+            # possible, and caches it on entry where it isn't.
+            stat_result = entry.stat()
+        except FileNotFoundError:
+            # Either the file was deleted after its directory was listed, or
+            # it's a broken symlink. Either way, there's nothing to read.
+            return None
+        fingerprint = Fingerprint.from_stat(stat_result)
+        if fingerprint == self._known_fingerprints.get(entry.path):
+            return UnchangedFile(
+                filename=entry.path,
+                dirname=os.path.dirname(entry.path),
+                basename=entry.name,
+                fingerprint=fingerprint,
+            )
+        if self._known_fingerprints and _kind(entry.name) is _Kind.AUDIO:
+            source_filename = self._move_source(entry.path, fingerprint)
+        else:
+            source_filename = None
+        # A file that matches its own partial hash was rewritten in place, and
+        # its tags could have changed without changing its size.
+        if source_filename is not None and source_filename != entry.path:
+            return MovedFile(
+                filename=entry.path,
+                dirname=os.path.dirname(entry.path),
+                basename=entry.name,
+                fingerprint=fingerprint,
+                source_filename=source_filename,
+                source_fingerprint=self._known_fingerprints[source_filename],
+            )
+        return File(
+            filename=entry.path,
+            dirname=os.path.dirname(entry.path),
+            basename=entry.name,
+            fingerprint=fingerprint,
+        )
+
+    def _unchanged(
+            self,
+            dirname: str,
+            stat_result: os.stat_result,
+    ) -> Optional[Directory]:
+        """Returns the known directory if it's unchanged, or None."""
+        if (self._known_directories is None or
+                dirname in self._changed_dirnames):
+            return None
+        known_directory = self._known_directories.get(dirname)
+        if (known_directory is None or known_directory.mtime_ns is None or
+                known_directory.mtime_ns != stat_result.st_mtime_ns):
+            return None
+        # If the directory's contents are only partially known (e.g., if a
+        # previous scan was interrupted), the directory needs to be listed
+        # again.
+        known_entry_count = (len(self._known_basenames[dirname]) +
+                             len(self._known_subdirnames[dirname]))
+        if known_directory.entry_count != known_entry_count:
+            return None
+        return known_directory
+
+    # TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+    def walk(
+            self,
+            dirname: str,
+            *,
+            may_skip: bool,
+    ) -> Iterable[Union[File, Directory]]:  # yapf: disable
+        """Yields files and directories within a directory, recursively.
+
+        Args:
+            dirname: Absolute name of the directory to walk.
+            may_skip: Whether the directory may be skipped if it's unchanged.
+                Subdirectories can always be skipped.
+        """
+        try:
+            stat_result = os.stat(dirname)
+        except FileNotFoundError:
+            return
+        known_directory = (self._unchanged(dirname, stat_result)
+                           if may_skip else None)
+        if known_directory is not None:
+            for basename in self._known_basenames[dirname]:
+                filename = os.path.join(dirname, basename)
+                yield UnchangedFile(
+                    filename=filename,
                     dirname=dirname,
                     basename=basename,
-                    track=entity.Track(
-                        tags=_read_audio_tags(dirname=dirname,
-                                              basename=basename,
-                                              filename=str(filepath))),
+                    fingerprint=self._known_fingerprints[filename],
                 )
-            elif mime_major == 'image':
-                yield ImageFile(
-                    filename=str(filepath),
+            subdirnames = self._known_subdirnames[dirname]
+            yield known_directory
+        else:
+            try:
+                with os.scandir(dirname) as entries_iterator:
+                    entries = tuple(entries_iterator)
+            except OSError:
+                # Like os.walk(), this skips directories that can't be listed,
+                # e.g., because they're unreadable or were just deleted. Without
+                # a Directory, the next scan tries to list it again.
+                return
+            subdirnames = []
+            entry_count = 0
+            for entry in entries:
+                if entry.is_dir():
+                    # Like os.walk(), this doesn't follow symlinks to
+                    # directories.
+                    if not entry.is_symlink():
+                        subdirnames.append(entry.path)
+                        entry_count += 1
+                    continue
+                file_info = self._file(entry)
+                if file_info is not None:
+                    entry_count += 1
+                    yield file_info
+            if self._known_directories is not None:
+                yield Directory(
                     dirname=dirname,
-                    basename=basename,
-                    image=entity.Image(tags=_read_image_tags(
-                        dirname=dirname,
-                        basename=basename,
-                        filename=str(filepath),
-                    )),
+                    mtime_ns=_trusted_mtime_ns(stat_result),
+                    entry_count=entry_count,
                 )
+        for subdirname in subdirnames:
+            yield from self.walk(subdirname, may_skip=True)
+
+
+class _Kind(enum.Enum):
+    """Kind of file, for deciding how to read it."""
+    AUDIO = enum.auto()
+    IMAGE = enum.auto()
+    OTHER = enum.auto()
+
+
+# Audio file extensions, all of which mutagen can read. This is independent of
+# the system's MIME types, since some systems map some of these extensions to
+# non-audio types or don't know about them at all, and since mutagen can't read
+# every audio type that the system might know about.
+_AUDIO_EXTENSIONS = (
+    '.aac',
+    '.aif',
+    '.aifc',
+    '.aiff',
+    '.ape',
+    '.asf',
+    '.dsf',
+    '.flac',
+    '.m4a',
+    '.m4b',
+    '.mp2',
+    '.mp3',
+    '.mpc',
+    '.oga',
+    '.ogg',
+    '.opus',
+    '.spx',
+    '.tta',
+    '.wav',
+    '.wma',
+    '.wv',
+)
+
+# Image file extensions, in addition to those from the system's MIME types.
+_IMAGE_EXTENSIONS = (
+    '.bmp',
+    '.gif',
+    '.jpeg',
+    '.jpg',
+    '.png',
+    '.tif',
+    '.tiff',
+    '.webp',
+)
+
+
+def _kinds_by_extension() -> Mapping[str, _Kind]:
+    """Returns a map from lowercase file extension to kind of file."""
+    kinds_by_extension = {}
+    for extension, mime in mimetypes.types_map.items():
+        if mime.startswith('image/'):
+            kinds_by_extension[extension.lower()] = _Kind.IMAGE
+    for extension in _IMAGE_EXTENSIONS:
+        kinds_by_extension[extension] = _Kind.IMAGE
+    for extension in _AUDIO_EXTENSIONS:
+        kinds_by_extension[extension] = _Kind.AUDIO
+    return frozendict.frozendict(kinds_by_extension)
+
+
+mimetypes.init()
+_KINDS_BY_EXTENSION = _kinds_by_extension()
+
+
+def _kind(basename: str) -> _Kind:
+    """Returns the kind of a file, based on its name."""
+    _, extension = os.path.splitext(basename)
+    return _KINDS_BY_EXTENSION.get(extension.lower(), _Kind.OTHER)
+
+
+def _audio_file(file_info: File) -> AudioFile:
+    """Returns an audio file, with its tags read."""
+    return AudioFile(
+        filename=file_info.filename,
+        dirname=file_info.dirname,
+        basename=file_info.basename,
+        fingerprint=file_info.fingerprint,
+        track=entity.Track(tags=_read_audio_tags(
+            dirname=file_info.dirname,
+            basename=file_info.basename,
+            filename=file_info.filename,
+        )),
+        partial_hash=_partial_hash(file_info.filename),
+    )
+
+
+def _audio_files(files: Sequence[File]) -> Sequence[AudioFile]:
+    """Returns audio files, with their tags read."""
+    return tuple(_audio_file(file_info) for file_info in files)
+
+
+def _non_audio_file(file_info: File, kind: _Kind) -> File:
+    """Returns a File for anything other than an audio file."""
+    if kind is _Kind.IMAGE:
+        return ImageFile(
+            filename=file_info.filename,
+            dirname=file_info.dirname,
+            basename=file_info.basename,
+            fingerprint=file_info.fingerprint,
+            image=entity.Image(tags=_read_image_tags(
+                dirname=file_info.dirname,
+                basename=file_info.basename,
+                filename=file_info.filename,
+            )),
+        )
+    else:
+        return file_info
+
+
+class _AudioBatch:
+    """Batch of audio files to read in a worker process."""
+
+    def __init__(self, executor: futures.Executor) -> None:
+        self._executor = executor
+        self._files: List[File] = []
+        self._future: 'Optional[futures.Future[Sequence[AudioFile]]]' = None
+
+    def add(self, file_info: File) -> int:
+        """Adds a file to the batch, and returns its index in the batch."""
+        assert self._future is None
+        self._files.append(file_info)
+        return len(self._files) - 1
+
+    def full(self) -> bool:
+        """Returns whether the batch is ready to submit."""
+        return len(self._files) >= _AUDIO_BATCH_SIZE
+
+    def submitted(self) -> bool:
+        """Returns whether the batch was submitted, so it can't be added to."""
+        return self._future is not None
+
+    def submit(self) -> None:
+        """Submits the batch to a worker, if it wasn't already submitted."""
+        if self._future is None:
+            self._future = self._executor.submit(_audio_files,
+                                                 tuple(self._files))
+
+    def result(self, index: int) -> AudioFile:
+        """Waits for the batch to be read, then returns one file from it."""
+        self.submit()
+        return self._future.result()[index]
+
+
+# Something that _scan_parallel() will yield, possibly after waiting for a batch
+# of audio files to be read.
+_PendingItem = Union[File, Directory, Tuple[_AudioBatch, int]]
+
+
+def read_file(file_info: File) -> File:
+    """Returns a file with its tags read, e.g., for a MovedFile with no source.
+
+    Args:
+        file_info: File from scan(), which must not be an UnchangedFile.
+
+    Raises:
+        FileNotFoundError: The file needed to be read, but it was deleted since
+            it was scanned.
+    """
+    kind = _kind(file_info.basename)
+    if kind is _Kind.AUDIO:
+        # mutagen wraps errors from opening the file, so this checks for a
+        # deleted file first.
+        os.stat(file_info.filename)
+        return _audio_file(file_info)
+    else:
+        return _non_audio_file(
+            File(
+                filename=file_info.filename,
+                dirname=file_info.dirname,
+                basename=file_info.basename,
+                fingerprint=file_info.fingerprint,
+            ),
+            kind,
+        )
+
+
+def _resolve(pending_item: _PendingItem) -> Union[File, Directory]:
+    """Returns the file or directory for a pending item."""
+    if isinstance(pending_item, tuple):
+        batch, index = pending_item
+        return batch.result(index)
+    else:
+        return pending_item
+
+
+def _scan_serial(walker: _Walker,
+                 root_dirname: str) -> Iterable[Union[File, Directory]]:
+    """Scans a directory, reading tags in the current process."""
+    for item in walker.walk(root_dirname, may_skip=False):
+        if isinstance(item, (Directory, UnchangedFile, MovedFile)):
+            yield item
+            continue
+        kind = _kind(item.basename)
+        if kind is _Kind.AUDIO:
+            yield _audio_file(item)
+        else:
+            yield _non_audio_file(item, kind)
+
+
+def _scan_parallel(
+        walker: _Walker,
+        root_dirname: str,
+        *,
+        workers: int,
+) -> Iterable[Union[File, Directory]]:
+    """Scans a directory, reading audio tags in worker processes."""
+    # Everything is yielded in the same order as _scan_serial(), so a slow file
+    # only delays the files after it by at most the size of the pending queue.
+    pending: Deque[_PendingItem] = collections.deque()
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        batch = _AudioBatch(executor)
+        for item in walker.walk(root_dirname, may_skip=False):
+            if isinstance(item, (Directory, UnchangedFile, MovedFile)):
+                pending.append(item)
+            elif _kind(item.basename) is _Kind.AUDIO:
+                # Resolving a pending item from a batch that isn't full yet
+                # submits it early, so any batch can be submitted by now.
+                if batch.submitted():
+                    batch = _AudioBatch(executor)
+                pending.append((batch, batch.add(item)))
+                if batch.full():
+                    batch.submit()
             else:
-                yield File(filename=str(filepath),
-                           dirname=dirname,
-                           basename=basename)
+                pending.append(_non_audio_file(item, _kind(item.basename)))
+            while len(pending) > workers * _MAX_PENDING_PER_WORKER:
+                yield _resolve(pending.popleft())
+        while pending:
+            yield _resolve(pending.popleft())
+
+
+# TODO(https://github.com/google/yapf/issues/793): Remove yapf disable.
+def scan(
+        root_dirname: str,
+        *,
+        workers: int = 1,
+        known_fingerprints: Mapping[str, Fingerprint] = frozendict.frozendict(),
+        known_directories: Optional[Mapping[str, Directory]] = None,
+        known_partial_hashes: Mapping[str, bytes] = frozendict.frozendict(),
+        changed_dirnames: Collection[str] = (),
+) -> Iterable[Union[File, Directory]]:  # yapf: disable
+    """Scans a directory.
+
+    Args:
+        root_dirname: Directory to scan, recursively.
+        workers: Number of worker processes to read audio tags with. If this is
+            1, tags are read in the current process instead. The directory is
+            always walked in the current process, and everything is yielded in
+            the same order regardless of the number of workers.
+        known_fingerprints: Map from filename to the fingerprint of the file
+            when it was last read, e.g., from a previous scan. Files that still
+            have the same fingerprint are yielded as UnchangedFile, without
+            being read. Audio files that have the same fingerprint as a known
+            file with a different name, e.g., because it was renamed, are
+            yielded as MovedFile, also without being read.
+        known_directories: If None, only files are yielded. Otherwise, a
+            Directory is also yielded for every directory, after the files
+            directly in it. This is a map from dirname to the directory from a
+            previous scan. Subdirectories of root_dirname that have not been
+            modified since then are not listed again, and the files directly in
+            them are assumed to be unchanged, according to known_fingerprints.
+            Note that modifying a file in place does not modify its directory,
+            so this should only be used when those changes can be detected some
+            other way, or it's acceptable to miss them.
+        known_partial_hashes: Map from filename to the partial hash of the file
+            when it was last read. Audio files that don't match any known
+            fingerprint, but do have the same size and partial hash as a known
+            file, are yielded as MovedFile. This recognizes files that were
+            moved to a different filesystem, at the cost of reading a small
+            part of each new audio file.
+        changed_dirnames: Directories that are listed again even if
+            known_directories says they're unchanged, e.g., because files
+            directly in them are known to have been modified in place.
+
+    Raises:
+        ValueError: workers is less than 1.
+    """
+    # TODO: Catch and handle per-file errors.
+    if workers < 1:
+        raise ValueError(f'workers must be at least 1, not {workers}')
+    walker = _Walker(
+        known_fingerprints=known_fingerprints,
+        known_directories=known_directories,
+        known_partial_hashes=known_partial_hashes,
+        changed_dirnames=changed_dirnames,
+    )
+    root_dirname = os.path.abspath(root_dirname)
+    if workers == 1:
+        return _scan_serial(walker, root_dirname)
+    else:
+        return _scan_parallel(walker, root_dirname, workers=workers)
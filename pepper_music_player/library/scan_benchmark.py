@@ -0,0 +1,123 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for pepper_music_player.library.scan.
+
+Run with:
+    python -m pepper_music_player.library.scan_benchmark
+"""
+
+import mimetypes
+import os
+import pathlib
+import tempfile
+import time
+from typing import Iterable, Tuple
+
+from pepper_music_player.library import scan
+from pepper_music_player.library import scan_testlib
+
+_ALBUM_COUNT = 200
+_TRACKS_PER_ALBUM = 20
+
+# Size of the synthetic tree of empty files for benchmarking the walk, without
+# reading any tags.
+_WALK_DIR_COUNT = 1000
+_WALK_FILES_PER_DIR = 1000
+_WALK_EXTENSIONS = ('.flac', '.MP3', '.jpg', '.txt', '')
+
+
+def _make_library(root_dirpath: pathlib.Path) -> int:
+    """Fills a directory with a synthetic library, and returns its size."""
+    for album_index in range(_ALBUM_COUNT):
+        album_dirpath = root_dirpath.joinpath(f'album{album_index}')
+        album_dirpath.mkdir()
+        for track_index in range(_TRACKS_PER_ALBUM):
+            album_dirpath.joinpath(f'{track_index}.flac').write_bytes(
+                scan_testlib.flac_with_tags({
+                    'album': (f'Album {album_index}',),
+                    'artist': (f'Artist {album_index}',),
+                    'title': (f'Track {track_index}',),
+                    'tracknumber': (str(track_index + 1),),
+                }))
+    return _ALBUM_COUNT * _TRACKS_PER_ALBUM
+
+
+def _make_empty_files(root_dirpath: pathlib.Path) -> int:
+    """Fills a directory with empty files, and returns how many."""
+    for dir_index in range(_WALK_DIR_COUNT):
+        dirpath = root_dirpath.joinpath(f'dir{dir_index}')
+        dirpath.mkdir()
+        for file_index in range(_WALK_FILES_PER_DIR):
+            extension = _WALK_EXTENSIONS[file_index % len(_WALK_EXTENSIONS)]
+            dirpath.joinpath(f'{file_index}{extension}').touch()
+    return _WALK_DIR_COUNT * _WALK_FILES_PER_DIR
+
+
+def _legacy_walk(root_dirname: str) -> Iterable[Tuple[str, str]]:
+    """Walks and classifies files the way scan used to, before scandir."""
+    for dirname, _, basenames in os.walk(root_dirname):
+        dirpath = pathlib.Path(dirname)
+        for basename in basenames:
+            filepath = dirpath.joinpath(basename)
+            filepath.stat()
+            mime, _ = mimetypes.guess_type(filepath.as_uri())
+            mime_major, _, _ = (mime or '').partition('/')
+            yield str(filepath), mime_major
+
+
+def _walk(root_dirname: str) -> Iterable[Tuple[str, scan._Kind]]:
+    """Walks and classifies files the way scan does."""
+    walker = scan._Walker(  # pylint: disable=protected-access
+        known_fingerprints={},
+        known_directories=None,
+        known_partial_hashes={},
+    )
+    for file_info in walker.walk(root_dirname, may_skip=False):
+        yield file_info.filename, scan._kind(file_info.basename)  # pylint: disable=protected-access
+
+
+def benchmark_walk() -> None:
+    """Prints walk throughput for the legacy and current walkers."""
+    with tempfile.TemporaryDirectory() as root_dirname:
+        file_count = _make_empty_files(pathlib.Path(root_dirname))
+        for name, walk in (('legacy', _legacy_walk), ('scandir', _walk)):
+            start = time.perf_counter()
+            for _ in walk(root_dirname):
+                pass
+            elapsed = time.perf_counter() - start
+            print(f'walk={name}: {file_count} files in {elapsed:.2f}s, '
+                  f'{file_count / elapsed:.0f} files/s')
+
+
+def benchmark_workers() -> None:
+    """Prints scan throughput for different numbers of worker processes."""
+    worker_counts = sorted({1, 2, 4, 8, os.cpu_count() or 1})
+    with tempfile.TemporaryDirectory() as root_dirname:
+        file_count = _make_library(pathlib.Path(root_dirname))
+        for workers in worker_counts:
+            start = time.perf_counter()
+            for _ in scan.scan(root_dirname, workers=workers):
+                pass
+            elapsed = time.perf_counter() - start
+            print(f'workers={workers}: {file_count} files in {elapsed:.2f}s, '
+                  f'{file_count / elapsed:.0f} files/s')
+
+
+def main() -> None:
+    benchmark_walk()
+    benchmark_workers()
+
+
+if __name__ == '__main__':
+    main()
@@ -13,24 +13,31 @@
 # limitations under the License.
 """Tests for pepper_music_player.library.scan."""
 
-import io
+import os
 import pathlib
 import tempfile
 import unittest
-
-import mutagen.flac
+from unittest import mock
 
 from pepper_music_player.library import scan
+from pepper_music_player.library import scan_testlib
 from pepper_music_player.metadata import entity
 from pepper_music_player.metadata import tag
 
-# Empty audio file data with no tags.
-_FLAC = (
-    b'fLaC\x80\x00\x00"\x10\x00\x10\x00\xff\xff\xff\x00\x00\x00\x0b\xb8\x00\xf0'
-    b'\x00\x00\x00\x00\xd4\x1d\x8c\xd9\x8f\x00\xb2\x04\xe9\x80\t\x98\xec\xf8B~')
+# Modification time that's old enough to be trusted by scan.
+_OLD_MTIME_NS = 10**18
+
+
+def _fingerprint(path):
+    return scan.Fingerprint.from_stat(path.stat())
+
+
+def _set_old_mtime(path):
+    os.utime(path, ns=(_OLD_MTIME_NS, _OLD_MTIME_NS))
 
 
 class ScanTest(unittest.TestCase):
+    WORKERS = 1
 
     def setUp(self):
         super().setUp()
@@ -51,24 +58,31 @@ class ScanTest(unittest.TestCase):
             (
                 scan.File(filename=str(foo.joinpath('foo1')),
                           dirname=str(foo),
-                          basename='foo1'),
+                          basename='foo1',
+                          fingerprint=_fingerprint(foo.joinpath('foo1'))),
                 scan.File(filename=str(foo.joinpath('foo2')),
                           dirname=str(foo),
-                          basename='foo2'),
+                          basename='foo2',
+                          fingerprint=_fingerprint(foo.joinpath('foo2'))),
                 scan.File(filename=str(bar.joinpath('bar1')),
                           dirname=str(bar),
-                          basename='bar1'),
+                          basename='bar1',
+                          fingerprint=_fingerprint(bar.joinpath('bar1'))),
             ),
-            scan.scan(str(self._root_dirpath)),
+            scan.scan(str(self._root_dirpath), workers=self.WORKERS),
         )
 
     def test_parses_empty_tags(self):
-        self._root_dirpath.joinpath('foo.flac').write_bytes(_FLAC)
+        self._root_dirpath.joinpath('foo.flac').write_bytes(scan_testlib.FLAC)
+        partial_hash = scan._partial_hash(  # pylint: disable=protected-access
+            str(self._root_dirpath.joinpath('foo.flac')))
         self.assertCountEqual(
             (scan.AudioFile(
                 filename=str(self._root_dirpath.joinpath('foo.flac')),
                 dirname=str(self._root_dirpath),
                 basename='foo.flac',
+                fingerprint=_fingerprint(
+                    self._root_dirpath.joinpath('foo.flac')),
                 track=entity.Track(tags=tag.Tags({
                     tag.BASENAME: ('foo.flac',),
                     tag.DIRNAME: (str(self._root_dirpath),),
@@ -76,25 +90,27 @@ class ScanTest(unittest.TestCase):
                         (str(self._root_dirpath.joinpath('foo.flac')),),
                     tag.DURATION_SECONDS: ('0.0',),
                 }).derive()),
+                partial_hash=partial_hash,
             ),),
-            scan.scan(str(self._root_dirpath)),
+            scan.scan(str(self._root_dirpath), workers=self.WORKERS),
         )
 
     def test_parses_flac(self):
-        flac_data = io.BytesIO(_FLAC)
-        tags = mutagen.flac.FLAC(fileobj=flac_data)
-        tags['title'] = 'Foo'
-        tags['date'] = '2019-12-21'
-        tags['artists'] = ['artist1', 'artist2']
-        flac_data.seek(0)
-        tags.save(flac_data)
         self._root_dirpath.joinpath('foo.flac').write_bytes(
-            flac_data.getvalue())
+            scan_testlib.flac_with_tags({
+                'title': ('Foo',),
+                'date': ('2019-12-21',),
+                'artists': ('artist1', 'artist2'),
+            }))
+        partial_hash = scan._partial_hash(  # pylint: disable=protected-access
+            str(self._root_dirpath.joinpath('foo.flac')))
         self.assertCountEqual(
             (scan.AudioFile(
                 filename=str(self._root_dirpath.joinpath('foo.flac')),
                 dirname=str(self._root_dirpath),
                 basename='foo.flac',
+                fingerprint=_fingerprint(
+                    self._root_dirpath.joinpath('foo.flac')),
                 track=entity.Track(tags=tag.Tags({
                     'artists': ('artist1', 'artist2'),
                     'date': ('2019-12-21',),
@@ -105,8 +121,9 @@ class ScanTest(unittest.TestCase):
                         (str(self._root_dirpath.joinpath('foo.flac')),),
                     tag.DURATION_SECONDS: ('0.0',),
                 }).derive()),
+                partial_hash=partial_hash,
             ),),
-            scan.scan(str(self._root_dirpath)),
+            scan.scan(str(self._root_dirpath), workers=self.WORKERS),
         )
 
     def test_parses_image(self):
@@ -117,6 +134,8 @@ class ScanTest(unittest.TestCase):
                 filename=str(self._root_dirpath.joinpath('foo.png')),
                 dirname=str(self._root_dirpath),
                 basename='foo.png',
+                fingerprint=_fingerprint(
+                    self._root_dirpath.joinpath('foo.png')),
                 image=entity.Image(tags=tag.Tags({
                     tag.BASENAME: ('foo.png',),
                     tag.DIRNAME: (str(self._root_dirpath),),
@@ -124,9 +143,404 @@ class ScanTest(unittest.TestCase):
                         (str(self._root_dirpath.joinpath('foo.png')),),
                 }).derive()),
             ),),
-            scan.scan(str(self._root_dirpath)),
+            scan.scan(str(self._root_dirpath), workers=self.WORKERS),
+        )
+
+    def test_file_extensions_are_case_insensitive(self):
+        self._root_dirpath.joinpath('foo.FLAC').write_bytes(scan_testlib.FLAC)
+        self._root_dirpath.joinpath('foo.Png').write_bytes(b'')
+        self.assertCountEqual(
+            (scan.AudioFile, scan.ImageFile),
+            (type(file_info) for file_info in scan.scan(str(self._root_dirpath),
+                                                        workers=self.WORKERS)),
+        )
+
+    def test_skips_broken_symlink(self):
+        self._root_dirpath.joinpath('foo').symlink_to(
+            self._root_dirpath.joinpath('does-not-exist'))
+        self.assertFalse(
+            tuple(scan.scan(str(self._root_dirpath), workers=self.WORKERS)))
+
+    def test_unchanged_files_are_not_read(self):
+        foo = self._root_dirpath.joinpath('foo.flac')
+        # Invalid audio data, so that reading the file would fail.
+        foo.write_bytes(b'')
+        self.assertCountEqual(
+            (scan.UnchangedFile(
+                filename=str(foo),
+                dirname=str(self._root_dirpath),
+                basename='foo.flac',
+                fingerprint=_fingerprint(foo),
+            ),),
+            scan.scan(
+                str(self._root_dirpath),
+                workers=self.WORKERS,
+                known_fingerprints={str(foo): _fingerprint(foo)},
+            ),
+        )
+
+    def test_changed_files_are_read(self):
+        foo = self._root_dirpath.joinpath('foo.png')
+        foo.write_bytes(b'')
+        old_fingerprint = _fingerprint(foo)
+        foo.write_bytes(b'changed')
+        self.assertCountEqual(
+            (scan.ImageFile(
+                filename=str(foo),
+                dirname=str(self._root_dirpath),
+                basename='foo.png',
+                fingerprint=_fingerprint(foo),
+                image=entity.Image(tags=tag.Tags({
+                    tag.BASENAME: ('foo.png',),
+                    tag.DIRNAME: (str(self._root_dirpath),),
+                    tag.FILENAME: (str(foo),),
+                }).derive()),
+            ),),
+            scan.scan(
+                str(self._root_dirpath),
+                workers=self.WORKERS,
+                known_fingerprints={str(foo): old_fingerprint},
+            ),
+        )
+
+    def test_renamed_audio_files_are_not_read(self):
+        foo = self._root_dirpath.joinpath('foo.flac')
+        # Invalid audio data, so that reading the file would fail.
+        foo.write_bytes(b'')
+        fingerprint = _fingerprint(foo)
+        bar = self._root_dirpath.joinpath('bar.flac')
+        foo.rename(bar)
+        self.assertCountEqual(
+            (scan.MovedFile(
+                filename=str(bar),
+                dirname=str(self._root_dirpath),
+                basename='bar.flac',
+                fingerprint=fingerprint,
+                source_filename=str(foo),
+                source_fingerprint=fingerprint,
+            ),),
+            scan.scan(
+                str(self._root_dirpath),
+                workers=self.WORKERS,
+                known_fingerprints={str(foo): fingerprint},
+            ),
+        )
+
+    def test_copied_audio_files_are_matched_by_partial_hash(self):
+        foo = self._root_dirpath.joinpath('foo.flac')
+        foo.write_bytes(b'invalid audio data')
+        source_fingerprint = scan.Fingerprint(
+            size=len(b'invalid audio data'),
+            mtime_ns=0,
+            inode=0,
+            device=0,
+        )
+        self.assertCountEqual(
+            (scan.MovedFile(
+                filename=str(foo),
+                dirname=str(self._root_dirpath),
+                basename='foo.flac',
+                fingerprint=_fingerprint(foo),
+                source_filename='/other/foo.flac',
+                source_fingerprint=source_fingerprint,
+            ),),
+            scan.scan(
+                str(self._root_dirpath),
+                workers=self.WORKERS,
+                known_fingerprints={'/other/foo.flac': source_fingerprint},
+                known_partial_hashes={
+                    '/other/foo.flac': scan._partial_hash(str(foo)),  # pylint: disable=protected-access
+                },
+            ),
+        )
+
+    def test_audio_files_rewritten_in_place_are_read(self):
+        foo = self._root_dirpath.joinpath('foo.flac')
+        foo.write_bytes(scan_testlib.FLAC)
+        old_fingerprint = _fingerprint(foo)
+        # Same size and partial hash, but a different fingerprint.
+        foo.write_bytes(scan_testlib.FLAC)
+        os.utime(foo, ns=(_OLD_MTIME_NS, _OLD_MTIME_NS))
+        (file_info,) = scan.scan(
+            str(self._root_dirpath),
+            workers=self.WORKERS,
+            known_fingerprints={str(foo): old_fingerprint},
+            known_partial_hashes={
+                str(foo): scan._partial_hash(str(foo)),  # pylint: disable=protected-access
+            },
+        )
+        self.assertIsInstance(file_info, scan.AudioFile)
+
+    def test_partial_hash_ignores_middle_of_file(self):
+        foo = self._root_dirpath.joinpath('foo')
+        chunk = b'x' * scan._PARTIAL_HASH_CHUNK_SIZE  # pylint: disable=protected-access
+        foo.write_bytes(chunk + b'a' + chunk)
+        original = scan._partial_hash(str(foo))  # pylint: disable=protected-access
+        foo.write_bytes(chunk + b'b' + chunk)
+        self.assertEqual(original, scan._partial_hash(str(foo)))  # pylint: disable=protected-access
+        foo.write_bytes(chunk + b'a' + chunk + b'a')
+        self.assertNotEqual(original, scan._partial_hash(str(foo)))  # pylint: disable=protected-access
+
+    def test_yields_directories(self):
+        foo = self._root_dirpath.joinpath('foo')
+        foo.mkdir()
+        foo.joinpath('foo1').touch()
+        foo.joinpath('foo2').touch()
+        _set_old_mtime(foo)
+        results = tuple(
+            scan.scan(str(self._root_dirpath),
+                      workers=self.WORKERS,
+                      known_directories={}))
+        self.assertCountEqual(
+            (
+                scan.File(filename=str(foo.joinpath('foo1')),
+                          dirname=str(foo),
+                          basename='foo1',
+                          fingerprint=_fingerprint(foo.joinpath('foo1'))),
+                scan.File(filename=str(foo.joinpath('foo2')),
+                          dirname=str(foo),
+                          basename='foo2',
+                          fingerprint=_fingerprint(foo.joinpath('foo2'))),
+                scan.Directory(dirname=str(self._root_dirpath),
+                               mtime_ns=None,
+                               entry_count=1),
+                scan.Directory(
+                    dirname=str(foo), mtime_ns=_OLD_MTIME_NS, entry_count=2),
+            ),
+            results,
+        )
+        self.assertEqual(
+            scan.Directory(dirname=str(foo),
+                           mtime_ns=_OLD_MTIME_NS,
+                           entry_count=2),
+            results[-1],
+            'Directories should be yielded after their files.',
+        )
+
+    def test_skips_directories_that_cannot_be_listed(self):
+        unreadable = self._root_dirpath.joinpath('unreadable')
+        unreadable.mkdir()
+        unreadable.joinpath('foo').touch()
+        bar = self._root_dirpath.joinpath('bar')
+        bar.touch()
+        scandir = os.scandir
+
+        def scandir_except_unreadable(path):
+            if path == str(unreadable):
+                raise PermissionError(path)
+            return scandir(path)
+
+        with mock.patch.object(scan.os,
+                               'scandir',
+                               side_effect=scandir_except_unreadable):
+            results = tuple(
+                scan.scan(str(self._root_dirpath),
+                          workers=self.WORKERS,
+                          known_directories={}))
+        self.assertCountEqual(
+            (
+                scan.File(filename=str(bar),
+                          dirname=str(self._root_dirpath),
+                          basename='bar',
+                          fingerprint=_fingerprint(bar)),
+                scan.Directory(dirname=str(self._root_dirpath),
+                               mtime_ns=None,
+                               entry_count=2),
+            ),
+            results,
         )
 
+    def test_skips_unchanged_directories(self):
+        foo = self._root_dirpath.joinpath('foo')
+        foo.mkdir()
+        foo1 = foo.joinpath('foo1')
+        foo1.touch()
+        bar = foo.joinpath('bar')
+        bar.mkdir()
+        bar1 = bar.joinpath('bar1')
+        bar1.touch()
+        known_directories = {
+            str(foo):
+                scan.Directory(dirname=str(foo),
+                               mtime_ns=_OLD_MTIME_NS,
+                               entry_count=2),
+            str(bar):
+                scan.Directory(dirname=str(bar), mtime_ns=None, entry_count=1),
+        }
+        known_fingerprints = {
+            str(foo1): _fingerprint(foo1),
+            str(bar1): _fingerprint(bar1),
+        }
+        # Both of these files are new, but only the one in bar should be found,
+        # since foo looks unchanged.
+        foo.joinpath('foo2').touch()
+        bar.joinpath('bar2').touch()
+        _set_old_mtime(foo)
+        self.assertCountEqual(
+            (
+                scan.UnchangedFile(filename=str(foo1),
+                                   dirname=str(foo),
+                                   basename='foo1',
+                                   fingerprint=_fingerprint(foo1)),
+                scan.UnchangedFile(filename=str(bar1),
+                                   dirname=str(bar),
+                                   basename='bar1',
+                                   fingerprint=_fingerprint(bar1)),
+                scan.File(filename=str(bar.joinpath('bar2')),
+                          dirname=str(bar),
+                          basename='bar2',
+                          fingerprint=_fingerprint(bar.joinpath('bar2'))),
+                scan.Directory(dirname=str(self._root_dirpath),
+                               mtime_ns=None,
+                               entry_count=1),
+                known_directories[str(foo)],
+                scan.Directory(dirname=str(bar), mtime_ns=None, entry_count=2),
+            ),
+            scan.scan(
+                str(self._root_dirpath),
+                workers=self.WORKERS,
+                known_fingerprints=known_fingerprints,
+                known_directories=known_directories,
+            ),
+        )
+
+    def test_lists_changed_directories(self):
+        foo = self._root_dirpath.joinpath('foo')
+        foo.mkdir()
+        foo1 = foo.joinpath('foo1')
+        foo1.touch()
+        _set_old_mtime(foo)
+        known_directories = {
+            str(foo):
+                scan.Directory(dirname=str(foo),
+                               mtime_ns=_OLD_MTIME_NS,
+                               entry_count=1),
+        }
+        known_fingerprints = {str(foo1): _fingerprint(foo1)}
+        # Rewriting a file in place doesn't change its directory's mtime.
+        foo1.write_bytes(b'changed')
+        _set_old_mtime(foo)
+        self.assertCountEqual(
+            (
+                scan.File(filename=str(foo1),
+                          dirname=str(foo),
+                          basename='foo1',
+                          fingerprint=_fingerprint(foo1)),
+                scan.Directory(dirname=str(self._root_dirpath),
+                               mtime_ns=None,
+                               entry_count=1),
+                scan.Directory(
+                    dirname=str(foo), mtime_ns=_OLD_MTIME_NS, entry_count=1),
+            ),
+            scan.scan(
+                str(self._root_dirpath),
+                workers=self.WORKERS,
+                known_fingerprints=known_fingerprints,
+                known_directories=known_directories,
+                changed_dirnames=(str(foo),),
+            ),
+        )
+
+    def test_does_not_skip_root_directory(self):
+        foo = self._root_dirpath.joinpath('foo')
+        foo.touch()
+        _set_old_mtime(self._root_dirpath)
+        self.assertCountEqual(
+            (
+                scan.UnchangedFile(filename=str(foo),
+                                   dirname=str(self._root_dirpath),
+                                   basename='foo',
+                                   fingerprint=_fingerprint(foo)),
+                scan.Directory(dirname=str(self._root_dirpath),
+                               mtime_ns=_OLD_MTIME_NS,
+                               entry_count=1),
+            ),
+            scan.scan(
+                str(self._root_dirpath),
+                workers=self.WORKERS,
+                known_fingerprints={str(foo): _fingerprint(foo)},
+                known_directories={
+                    str(self._root_dirpath):
+                        scan.Directory(dirname=str(self._root_dirpath),
+                                       mtime_ns=_OLD_MTIME_NS,
+                                       entry_count=0),
+                },
+            ),
+        )
+
+    def test_does_not_skip_partially_known_directory(self):
+        foo = self._root_dirpath.joinpath('foo')
+        foo.mkdir()
+        foo1 = foo.joinpath('foo1')
+        foo1.touch()
+        _set_old_mtime(foo)
+        self.assertIn(
+            scan.File(filename=str(foo1),
+                      dirname=str(foo),
+                      basename='foo1',
+                      fingerprint=_fingerprint(foo1)),
+            tuple(
+                scan.scan(
+                    str(self._root_dirpath),
+                    workers=self.WORKERS,
+                    known_directories={
+                        str(foo):
+                            scan.Directory(dirname=str(foo),
+                                           mtime_ns=_OLD_MTIME_NS,
+                                           entry_count=1),
+                    },
+                )),
+        )
+
+    def test_yields_files_in_walk_order(self):
+        # More files than can be pending at once, to make sure that yielding
+        # files while others are still pending doesn't reorder anything.
+        file_count = self.WORKERS * scan._MAX_PENDING_PER_WORKER * 2 + 1  # pylint: disable=protected-access
+        basenames = tuple(f'{index:04}.flac' for index in range(file_count))
+        for basename in basenames:
+            self._root_dirpath.joinpath(basename).write_bytes(scan_testlib.FLAC)
+        self._root_dirpath.joinpath('foo.png').write_bytes(b'')
+        serial_basenames = tuple(
+            file_info.basename
+            for file_info in scan.scan(str(self._root_dirpath), workers=1))
+        self.assertCountEqual((*basenames, 'foo.png'), serial_basenames)
+        self.assertSequenceEqual(
+            serial_basenames,
+            tuple(file_info.basename
+                  for file_info in scan.scan(str(self._root_dirpath),
+                                             workers=self.WORKERS)),
+        )
+
+    def test_yields_files_in_walk_order_with_partial_batches(self):
+        # With few pending items and non-audio files between audio files, audio
+        # files are yielded before their batch is full.
+        basenames = []
+        for index in range(scan._AUDIO_BATCH_SIZE * 2 + 1):  # pylint: disable=protected-access
+            basenames.append(f'{index:04}.flac')
+            self._root_dirpath.joinpath(basenames[-1]).write_bytes(
+                scan_testlib.FLAC)
+            basenames.append(f'{index:04}.png')
+            self._root_dirpath.joinpath(basenames[-1]).write_bytes(b'')
+        serial_basenames = tuple(
+            file_info.basename
+            for file_info in scan.scan(str(self._root_dirpath), workers=1))
+        self.assertCountEqual(basenames, serial_basenames)
+        with mock.patch.object(scan, '_MAX_PENDING_PER_WORKER', 1):
+            self.assertSequenceEqual(
+                serial_basenames,
+                tuple(file_info.basename
+                      for file_info in scan.scan(str(self._root_dirpath),
+                                                 workers=self.WORKERS)),
+            )
+
+    def test_invalid_workers(self):
+        with self.assertRaisesRegex(ValueError, 'workers'):
+            scan.scan(str(self._root_dirpath), workers=0)
+
+
+class ScanParallelTest(ScanTest):
+    WORKERS = 2
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,35 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers for testing and benchmarking code that scans files."""
+
+import io
+from typing import Mapping, Sequence
+
+import mutagen.flac
+
+# Empty audio file data with no tags.
+FLAC = (
+    b'fLaC\x80\x00\x00"\x10\x00\x10\x00\xff\xff\xff\x00\x00\x00\x0b\xb8\x00\xf0'
+    b'\x00\x00\x00\x00\xd4\x1d\x8c\xd9\x8f\x00\xb2\x04\xe9\x80\t\x98\xec\xf8B~')
+
+
+def flac_with_tags(tags: Mapping[str, Sequence[str]]) -> bytes:
+    """Returns empty audio file data with the given tags."""
+    flac_data = io.BytesIO(FLAC)
+    flac_file = mutagen.flac.FLAC(fileobj=flac_data)
+    for name, values in tags.items():
+        flac_file[name] = list(values)
+    flac_data.seek(0)
+    flac_file.save(flac_data)
+    return flac_data.getvalue()
@@ -0,0 +1,292 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Watching library directories for changes, using Linux's inotify."""
+
+import ctypes
+import ctypes.util
+import dataclasses
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from pepper_music_player.library import database
+
+# Constants from <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+# Events that can change what's in a directory. Modifications are only noticed
+# once the file is closed, so that a file being copied in is read only once.
+_WATCH_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+               _IN_DELETE | _IN_ONLYDIR | _IN_DONT_FOLLOW)
+
+# struct inotify_event, without the trailing name.
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Max number of bytes to read at once. This is big enough for hundreds of
+# events, and for any single event.
+_READ_SIZE = 64 * 1024
+
+
+def is_supported() -> bool:
+    """Returns whether watching is supported on this system."""
+    return sys.platform.startswith('linux')
+
+
+@dataclasses.dataclass(frozen=True)
+class _Event:
+    """Event from inotify.
+
+    Attributes:
+        wd: Watch descriptor the event is for.
+        mask: Bitmask of the _IN_* constants above.
+        name: Basename of the file or directory within the watched directory
+            that the event is about, or empty if it's about the watched
+            directory itself.
+    """
+    wd: int
+    mask: int
+    name: str
+
+
+class _Inotify:
+    """Minimal wrapper around an inotify instance."""
+
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self._inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                            ctypes.c_uint32)
+        self._inotify_add_watch.restype = ctypes.c_int
+        self._inotify_rm_watch = libc.inotify_rm_watch
+        self._inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self._inotify_rm_watch.restype = ctypes.c_int
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def add_watch(self, dirname: str) -> int:
+        """Watches a directory, and returns its watch descriptor.
+
+        Raises:
+            OSError: The directory could not be watched, e.g., because it was
+                deleted or isn't a directory.
+        """
+        wd = self._inotify_add_watch(self._fd, os.fsencode(dirname),
+                                     _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dirname)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        """Stops watching, ignoring errors from already removed watches."""
+        self._inotify_rm_watch(self._fd, wd)
+
+    def read(self) -> List[_Event]:
+        """Returns all available events, without blocking."""
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            events.append(_Event(wd=wd, mask=mask, name=os.fsdecode(name)))
+        return events
+
+
+def _outermost(dirnames: Iterable[str]) -> Set[str]:
+    """Returns the dirnames that are not within any of the other dirnames."""
+    outermost = set()
+    for dirname in sorted(dirnames):
+        if not any(
+                dirname == other or dirname.startswith(os.path.join(other, ''))
+                for other in outermost):
+            outermost.add(dirname)
+    return outermost
+
+
+class Watcher:
+    """Watches library directories, and keeps the database up to date.
+
+    Changes are batched until there's a quiet period, so that e.g. copying in a
+    whole album only updates the database once. Then only the directories that
+    changed are rescanned.
+
+    Since each rescan only knows about the files within its own directory, a
+    file that's moved between sibling directories is read again instead of
+    keeping its tags from before the move, unless their common parent directory
+    also changed in the same batch.
+    """
+
+    def __init__(
+            self,
+            *,
+            library_db: database.Database,
+            root_dirnames: Iterable[str],
+            debounce_seconds: float = 1.0,
+    ) -> None:
+        """Initializer.
+
+        Args:
+            library_db: Library database to update.
+            root_dirnames: Directories to watch, recursively.
+            debounce_seconds: How long to wait after the last change before
+                updating the database.
+
+        Raises:
+            OSError: Watching is not supported, or some other error.
+        """
+        if not is_supported():
+            raise OSError(f'Watching is not supported on {sys.platform}.')
+        self._library_db = library_db
+        self._root_dirnames = tuple(
+            os.path.abspath(dirname) for dirname in root_dirnames)
+        self._debounce_seconds = debounce_seconds
+        self._inotify = _Inotify()
+        self._dirnames_by_wd: Dict[int, str] = {}
+        self._stop_read_fd, self._stop_write_fd = os.pipe()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        """Starts watching, in a background thread."""
+        for root_dirname in self._root_dirnames:
+            self._watch_recursively(root_dirname)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops watching, and waits for any in-progress update to finish."""
+        os.write(self._stop_write_fd, b'\0')
+        self._thread.join()
+        self._inotify.close()
+        os.close(self._stop_read_fd)
+        os.close(self._stop_write_fd)
+
+    def _watch_recursively(self, root_dirname: str) -> None:
+        """Watches a directory and its subdirectories."""
+        for dirname, _, _ in os.walk(root_dirname):
+            try:
+                wd = self._inotify.add_watch(dirname)
+            except OSError:
+                # The directory was removed or replaced since os.walk() listed
+                # it. Whatever happened should generate an event for its parent.
+                continue
+            self._dirnames_by_wd[wd] = dirname
+
+    def _unwatch_recursively(self, root_dirname: str) -> None:
+        """Stops watching a directory and its subdirectories."""
+        for wd, dirname in tuple(self._dirnames_by_wd.items()):
+            if (dirname == root_dirname or
+                    dirname.startswith(os.path.join(root_dirname, ''))):
+                del self._dirnames_by_wd[wd]
+                self._inotify.rm_watch(wd)
+
+    def _changed_dirnames(self, events: Iterable[_Event]) -> Set[str]:
+        """Handles events, and returns the directories they changed."""
+        changed = set()
+        for event in events:
+            if event.mask & _IN_Q_OVERFLOW:
+                # Some events were lost, so anything could have changed.
+                changed.update(self._root_dirnames)
+                continue
+            if event.mask & _IN_IGNORED:
+                self._dirnames_by_wd.pop(event.wd, None)
+                continue
+            dirname = self._dirnames_by_wd.get(event.wd)
+            if dirname is None:
+                # The watch was removed after the event was queued.
+                continue
+            changed.add(dirname)
+            if event.mask & _IN_ISDIR:
+                subdirname = os.path.join(dirname, event.name)
+                if event.mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._watch_recursively(subdirname)
+                elif event.mask & _IN_MOVED_FROM:
+                    # Deleted directories have their watches removed
+                    # automatically, but moved directories keep them, with
+                    # dirnames that are no longer accurate.
+                    self._unwatch_recursively(subdirname)
+        return changed
+
+    def _update(self, dirnames: Iterable[str]) -> None:
+        """Updates the database to match the given directories."""
+        dirnames = frozenset(dirnames)
+        for dirname in sorted(_outermost(dirnames)):
+            try:
+                # Changes within subdirectories generate their own events, so
+                # any subdirectory without a change of its own can be skipped.
+                # Subdirectories with changes of their own are listed even if
+                # their mtimes didn't change, e.g., because a file in them was
+                # rewritten in place.
+                self._library_db.rescan(
+                    dirname,
+                    skip_unchanged_directories=True,
+                    changed_dirnames=dirnames,
+                )
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Failed to update directory %r', dirname)
+
+    def _run(self) -> None:
+        """Waits for and handles changes, until stopped."""
+        poller = select.poll()
+        poller.register(self._inotify.fileno(), select.POLLIN)
+        poller.register(self._stop_read_fd, select.POLLIN)
+        changed: Set[str] = set()
+        last_change: Optional[float] = None
+        while True:
+            if last_change is None:
+                timeout_ms = None
+            else:
+                remaining = (last_change + self._debounce_seconds -
+                             time.monotonic())
+                timeout_ms = max(0, int(remaining * 1000))
+            ready_fds = {fd for fd, _ in poller.poll(timeout_ms)}
+            if self._stop_read_fd in ready_fds:
+                return
+            if self._inotify.fileno() in ready_fds:
+                new_changes = self._changed_dirnames(self._inotify.read())
+                if new_changes:
+                    changed.update(new_changes)
+                    last_change = time.monotonic()
+            elif last_change is not None:
+                self._update(changed)
+                changed = set()
+                last_change = None
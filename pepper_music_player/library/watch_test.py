@@ -0,0 +1,163 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for pepper_music_player.library.watch."""
+
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from pepper_music_player.library import database
+from pepper_music_player.library import scan
+from pepper_music_player.library import scan_testlib
+from pepper_music_player.library import watch
+
+_TIMEOUT_SECONDS = 10
+
+# Modification time that's old enough to be trusted by scan.
+_OLD_MTIME_NS = 10**18
+
+
+@unittest.skipUnless(watch.is_supported(), 'Watching is not supported.')
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        database_dirpath = pathlib.Path(tempdir.name).joinpath('database')
+        database_dirpath.mkdir()
+        self._library_db = database.Database(database_dir=str(database_dirpath))
+        self._root_dirpath = pathlib.Path(tempdir.name).joinpath('library')
+        self._root_dirpath.mkdir()
+
+    def _start_watcher(self):
+        watcher = watch.Watcher(
+            library_db=self._library_db,
+            root_dirnames=(str(self._root_dirpath),),
+            debounce_seconds=0.01,
+        )
+        watcher.start()
+        self.addCleanup(watcher.stop)
+
+    def _assert_eventually_filenames(self, filenames):
+        deadline = time.monotonic() + _TIMEOUT_SECONDS
+        while True:
+            actual = set(
+                self._library_db.file_fingerprints(str(self._root_dirpath)))
+            if actual == set(filenames) or time.monotonic() > deadline:
+                break
+            time.sleep(0.01)
+        self.assertCountEqual(filenames, actual)
+
+    def test_adds_new_file(self):
+        self._start_watcher()
+        foo = self._root_dirpath.joinpath('foo.flac')
+        foo.write_bytes(scan_testlib.FLAC)
+        self._assert_eventually_filenames((str(foo),))
+
+    def test_adds_files_in_new_directories(self):
+        self._start_watcher()
+        foo = self._root_dirpath.joinpath('foo')
+        foo.mkdir()
+        foo.joinpath('bar').mkdir()
+        foo1 = foo.joinpath('bar', 'foo1.flac')
+        foo1.write_bytes(scan_testlib.FLAC)
+        self._assert_eventually_filenames((str(foo1),))
+        foo2 = foo.joinpath('bar', 'foo2.flac')
+        foo2.write_bytes(scan_testlib.FLAC)
+        self._assert_eventually_filenames((str(foo1), str(foo2)))
+
+    def test_removes_deleted_file(self):
+        foo = self._root_dirpath.joinpath('foo.flac')
+        foo.write_bytes(scan_testlib.FLAC)
+        self._library_db.rescan(str(self._root_dirpath))
+        self._start_watcher()
+        foo.unlink()
+        self._assert_eventually_filenames(())
+
+    def test_follows_moved_directory(self):
+        foo = self._root_dirpath.joinpath('foo')
+        foo.mkdir()
+        foo.joinpath('foo1.flac').write_bytes(scan_testlib.FLAC)
+        self._library_db.rescan(str(self._root_dirpath))
+        self._start_watcher()
+        bar = self._root_dirpath.joinpath('bar')
+        foo.rename(bar)
+        self._assert_eventually_filenames((str(bar.joinpath('foo1.flac')),))
+        bar.joinpath('bar1.flac').write_bytes(scan_testlib.FLAC)
+        self._assert_eventually_filenames((
+            str(bar.joinpath('foo1.flac')),
+            str(bar.joinpath('bar1.flac')),
+        ))
+
+    def test_rescans_outermost_changed_directories(self):
+        library_db = mock.create_autospec(database.Database, instance=True)
+        foo = self._root_dirpath.joinpath('foo')
+        foo.mkdir()
+        watcher = watch.Watcher(
+            library_db=library_db,
+            root_dirnames=(str(self._root_dirpath),),
+        )
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        changed_dirnames = frozenset((
+            str(foo),
+            str(self._root_dirpath),
+            str(self._root_dirpath) + '-other',
+        ))
+        watcher._update(changed_dirnames)  # pylint: disable=protected-access
+        self.assertCountEqual(
+            (
+                mock.call(str(self._root_dirpath),
+                          skip_unchanged_directories=True,
+                          changed_dirnames=changed_dirnames),
+                mock.call(str(self._root_dirpath) + '-other',
+                          skip_unchanged_directories=True,
+                          changed_dirnames=changed_dirnames),
+            ),
+            library_db.rescan.mock_calls,
+        )
+
+    def test_reads_file_rewritten_in_nested_changed_directory(self):
+        foo = self._root_dirpath.joinpath('foo')
+        foo.mkdir()
+        foo1 = foo.joinpath('foo1.flac')
+        foo1.write_bytes(scan_testlib.FLAC)
+        os.utime(foo, ns=(_OLD_MTIME_NS, _OLD_MTIME_NS))
+        self._library_db.rescan(str(self._root_dirpath))
+        watcher = watch.Watcher(
+            library_db=self._library_db,
+            root_dirnames=(str(self._root_dirpath),),
+            # Events are handled only by the explicit update below.
+            debounce_seconds=_TIMEOUT_SECONDS * 10,
+        )
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        # Rewriting foo1 in place doesn't change foo's mtime, and the new file
+        # makes the root directory an outer changed directory of foo.
+        foo1.write_bytes(scan_testlib.FLAC)
+        os.utime(foo1, ns=(_OLD_MTIME_NS + 1, _OLD_MTIME_NS + 1))
+        self._root_dirpath.joinpath('bar').touch()
+        watcher._update((str(self._root_dirpath), str(foo)))  # pylint: disable=protected-access
+        fingerprints = self._library_db.file_fingerprints(
+            str(self._root_dirpath))
+        self.assertEqual(scan.Fingerprint.from_stat(foo1.stat()),
+                         fingerprints[str(foo1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
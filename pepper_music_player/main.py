@@ -14,13 +14,14 @@
 """Main application."""
 
 import os
+from typing import Optional
 
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
 
 from pepper_music_player.library import database
-from pepper_music_player.library import scan
+from pepper_music_player.library import watch
 from pepper_music_player.player import player
 from pepper_music_player.player import playlist
 from pepper_music_player import pubsub
@@ -30,13 +31,23 @@ from pepper_music_player.ui import application
 def main() -> None:
     # TODO(dseomn): Switch to the real default database_dir, once there is one.
     database_dir = '.'
-    library_db = database.Database(database_dir=database_dir)
+    pubsub_bus = pubsub.PubSub()
+    library_db = database.Database(
+        database_dir=database_dir,
+        pubsub_bus=pubsub_bus,
+    )
     # TODO(dseomn): Make scanning controllable by the UI instead of doing it
     # here.
     library_scan_dir = os.getenv('PEPPER_SCAN')
+    watcher: Optional[watch.Watcher] = None
     if library_scan_dir:
-        library_db.insert_files(scan.scan(library_scan_dir))
-    pubsub_bus = pubsub.PubSub()
+        library_db.rescan(library_scan_dir)
+        if watch.is_supported():
+            watcher = watch.Watcher(
+                library_db=library_db,
+                root_dirnames=(library_scan_dir,),
+            )
+            watcher.start()
     player_ = player.Player(pubsub_bus=pubsub_bus)
     playlist_ = playlist.Playlist(
         library_db=library_db,
@@ -50,7 +61,12 @@ def main() -> None:
         player_,
         playlist_,
     ).window.show_all()
-    Gtk.main()
+    try:
+        Gtk.main()
+    finally:
+        # Gtk.main() returns once the window is destroyed.
+        if watcher is not None:
+            watcher.stop()
 
 
 if __name__ == '__main__':
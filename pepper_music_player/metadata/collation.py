@@ -0,0 +1,125 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sort keys for ordering entities by their tags."""
+
+import dataclasses
+import enum
+import re
+import unicodedata
+
+from pepper_music_player.metadata import tag
+
+# Articles to ignore at the start of values that aren't already from a sort
+# tag, e.g., 'The Beatles' sorts as 'beatles'.
+_LEADING_ARTICLE_REGEX = re.compile(r'\A(?:the|an?)\s+(?=\S)')
+
+_NUMBER_REGEX = re.compile(r'\d+')
+
+# Prefix for numbers in sort keys. This is the same byte as '0', which can't
+# appear anywhere else in a key since all digits are part of numbers.
+_NUMBER_PREFIX = b'0'
+
+# Sort key for entities without any value for a field. This sorts after any
+# other key, since UTF-8 never contains this byte.
+_MISSING = b'\xff'
+
+
+@dataclasses.dataclass(frozen=True)
+class _Source:
+    """Tag to get the value for a SortField from.
+
+    Attributes:
+        tag: Tag with the value.
+        is_sort_tag: Whether the tag is already in sort order, e.g., 'Beatles,
+            The' instead of 'The Beatles'.
+    """
+    tag: tag.Tag
+    is_sort_tag: bool
+
+
+class SortField(enum.Enum):
+    """Field that entities can be sorted by.
+
+    Each value is a sequence of sources, and the first one that's present in an
+    entity's tags is used.
+    """
+    ALBUMARTIST = (
+        _Source(tag.ALBUMARTISTSORT, is_sort_tag=True),
+        _Source(tag.ALBUMARTIST, is_sort_tag=False),
+        _Source(tag.ARTISTSORT, is_sort_tag=True),
+        _Source(tag.ARTIST, is_sort_tag=False),
+    )
+    ARTIST = (
+        _Source(tag.ARTISTSORT, is_sort_tag=True),
+        _Source(tag.ARTIST, is_sort_tag=False),
+    )
+    ALBUM = (
+        _Source(tag.ALBUMSORT, is_sort_tag=True),
+        _Source(tag.ALBUM, is_sort_tag=False),
+    )
+    TITLE = (
+        _Source(tag.TITLESORT, is_sort_tag=True),
+        _Source(tag.TITLE, is_sort_tag=False),
+    )
+    DATE = (_Source(tag.DATE, is_sort_tag=False),)
+
+
+def _normalize(value: str) -> str:
+    """Returns a value without case or diacritics."""
+    decomposed = unicodedata.normalize('NFKD', value.casefold())
+    return ''.join(
+        char for char in decomposed if not unicodedata.combining(char))
+
+
+def _encode(value: str) -> bytes:
+    """Returns a normalized value encoded so that numbers sort numerically."""
+    key = bytearray()
+    position = 0
+    for number_match in _NUMBER_REGEX.finditer(value):
+        key += value[position:number_match.start()].encode('utf-8')
+        digits = str(int(number_match.group()))
+        # Longer numbers are bigger, and numbers with the same length compare
+        # digit by digit.
+        key += _NUMBER_PREFIX
+        key += min(len(digits), 0xff).to_bytes(1, 'big')
+        key += digits.encode('ascii')
+        position = number_match.end()
+    key += value[position:].encode('utf-8')
+    return bytes(key)
+
+
+def sort_key(field: SortField, tags: tag.Tags) -> bytes:
+    """Returns a key for sorting by a field.
+
+    Keys compare as bytes, so they can be stored and indexed in a database. They
+    ignore case and diacritics, and compare numbers within values numerically,
+    e.g., 'Disc 9' sorts before 'Disc 10'. Values that aren't from a sort tag
+    also ignore a leading English article. Unlike locale-based collation, keys
+    don't depend on the environment they were computed in.
+
+    Args:
+        field: Field to sort by.
+        tags: Tags of the entity to get a key for.
+
+    Returns:
+        Sort key, which sorts after every other key if the entity has no value
+        for the field.
+    """
+    for source in field.value:
+        if source.tag in tags:
+            value = _normalize(tags.singular(source.tag))
+            if not source.is_sort_tag:
+                value = _LEADING_ARTICLE_REGEX.sub('', value, count=1)
+            return _encode(value)
+    return _MISSING
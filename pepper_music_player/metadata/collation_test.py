@@ -0,0 +1,137 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for pepper_music_player.metadata.collation."""
+
+import unittest
+
+from pepper_music_player.metadata import collation
+from pepper_music_player.metadata import tag
+
+
+def _sorted_values(field, tag_name, values):
+    return sorted(
+        values,
+        key=lambda value: collation.sort_key(field,
+                                             tag.Tags({tag_name: (value,)})),
+    )
+
+
+class SortKeyTest(unittest.TestCase):
+
+    def test_missing_sorts_last(self):
+        self.assertGreater(
+            collation.sort_key(collation.SortField.ALBUM, tag.Tags({})),
+            collation.sort_key(collation.SortField.ALBUM,
+                               tag.Tags({'album': ('\U0010ffff',)})),
+        )
+
+    def test_ignores_case_and_diacritics(self):
+        self.assertEqual(
+            collation.sort_key(collation.SortField.TITLE,
+                               tag.Tags({'title': ('Jóga',)})),
+            collation.sort_key(collation.SortField.TITLE,
+                               tag.Tags({'title': ('JOGA',)})),
+        )
+
+    def test_sorts_numbers_numerically(self):
+        self.assertEqual(
+            ['Disc 2', 'Disc 09', 'disc 10', 'Disc 10a', 'Disc 100'],
+            _sorted_values(
+                collation.SortField.ALBUM,
+                'album',
+                ['Disc 100', 'Disc 10a', 'disc 10', 'Disc 09', 'Disc 2'],
+            ),
+        )
+
+    def test_sorts_dates(self):
+        self.assertEqual(
+            ['1999', '2000-01-02', '2000-1-10', '2000-02'],
+            _sorted_values(
+                collation.SortField.DATE,
+                'date',
+                ['2000-02', '2000-1-10', '1999', '2000-01-02'],
+            ),
+        )
+
+    def test_ignores_leading_article(self):
+        self.assertEqual(
+            [
+                'Abbey Road',
+                'The Beatles',
+                'A Day in the Life',
+                'The',
+                'Theatre',
+            ],
+            _sorted_values(
+                collation.SortField.ALBUM,
+                'album',
+                [
+                    'The',
+                    'Theatre',
+                    'A Day in the Life',
+                    'The Beatles',
+                    'Abbey Road',
+                ],
+            ),
+        )
+
+    def test_sort_tag_keeps_leading_article(self):
+        self.assertEqual(
+            collation.sort_key(collation.SortField.ARTIST,
+                               tag.Tags({'artist': ('the foo',)})),
+            collation.sort_key(collation.SortField.ARTIST,
+                               tag.Tags({'artist': ('foo',)})),
+        )
+        self.assertNotEqual(
+            collation.sort_key(collation.SortField.ARTIST,
+                               tag.Tags({'artistsort': ('the foo',)})),
+            collation.sort_key(collation.SortField.ARTIST,
+                               tag.Tags({'artistsort': ('foo',)})),
+        )
+
+    def test_prefers_sort_tag(self):
+        self.assertEqual(
+            collation.sort_key(collation.SortField.ARTIST,
+                               tag.Tags({'artist': ('beatles, the',)})),
+            collation.sort_key(
+                collation.SortField.ARTIST,
+                tag.Tags({
+                    'artist': ('The Beatles',),
+                    'artistsort': ('Beatles, The',),
+                }),
+            ),
+        )
+
+    def test_albumartist_falls_back_to_artist(self):
+        self.assertEqual(
+            collation.sort_key(collation.SortField.ALBUMARTIST,
+                               tag.Tags({'albumartist': ('foo',)})),
+            collation.sort_key(collation.SortField.ALBUMARTIST,
+                               tag.Tags({'artist': ('foo',)})),
+        )
+        self.assertEqual(
+            collation.sort_key(collation.SortField.ALBUMARTIST,
+                               tag.Tags({'albumartist': ('foo',)})),
+            collation.sort_key(
+                collation.SortField.ALBUMARTIST,
+                tag.Tags({
+                    'albumartist': ('foo',),
+                    'artistsort': ('bar',),
+                }),
+            ),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
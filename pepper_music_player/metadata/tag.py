@@ -144,16 +144,43 @@ class IndexOrTotalTag(DerivedTag):
         return None if matched_value is None else (matched_value,)
 
 
+@dataclasses.dataclass(frozen=True)
+class YearTag(DerivedTag):
+    """Tag deriving the year from dates, e.g., '2019' from '2019-12-31'.
+
+    Attributes:
+        date_tag: Tag containing dates that start with a four-digit year.
+    """
+    # TODO(https://github.com/PyCQA/pylint/issues/3405): Remove pylint disable.
+    _YEAR_REGEX: ClassVar[Pattern[str]] = re.compile(  # pylint: disable=invalid-name
+        r'(?P<year>\d{4})(?!\d)')
+    date_tag: Tag
+
+    def derive(self, tags: 'Tags') -> Optional[Sequence[str]]:
+        """See base class."""
+        years = []
+        for date in tags.get(self.date_tag, ()):
+            year_match = self._YEAR_REGEX.match(date)
+            if year_match is not None and year_match.group('year') not in years:
+                years.append(year_match.group('year'))
+        return tuple(years) or None
+
+
 ALBUM = Tag('album')
 ALBUMARTIST = Tag('albumartist')
+ALBUMARTISTSORT = Tag('albumartistsort')
+ALBUMSORT = Tag('albumsort')
 ARTIST = Tag('artist')
+ARTISTSORT = Tag('artistsort')
 DATE = Tag('date')
 DISCNUMBER = Tag('discnumber')  # Prefer PARSED_DISCNUMBER below.
 DISCTOTAL = Tag('disctotal')  # Prefer PARSED_TOTALDISCS below.
 DISCSUBTITLE = Tag('discsubtitle')
+GENRE = Tag('genre')
 MEDIA = Tag('media')
 MUSICBRAINZ_ALBUMID = Tag('musicbrainz_albumid')
 TITLE = Tag('title')
+TITLESORT = Tag('titlesort')
 TOTALDISCS = Tag('totaldiscs')  # Prefer PARSED_TOTALDISCS below.
 TOTALTRACKS = Tag('totaltracks')  # Prefer PARSED_TOTALTRACKS below.
 TRACKNUMBER = Tag('tracknumber')  # Prefer PARSED_TRACKNUMBER below.
@@ -180,6 +207,7 @@ PARSED_TOTALTRACKS = IndexOrTotalTag('~parsed_totaltracks',
 PARSED_TRACKNUMBER = IndexOrTotalTag('~parsed_tracknumber',
                                      is_index=True,
                                      composite_tag=TRACKNUMBER)
+PARSED_YEAR = YearTag('~parsed_year', date_tag=DATE)
 
 _DERIVED_TAGS = (
     DURATION_HUMAN,
@@ -187,6 +215,7 @@ _DERIVED_TAGS = (
     PARSED_TOTALDISCS,
     PARSED_TOTALTRACKS,
     PARSED_TRACKNUMBER,
+    PARSED_YEAR,
 )
 
 
@@ -106,6 +106,24 @@ class IndexOrTotalTagTest(unittest.TestCase):
         self.assertEqual(('20',), tag.PARSED_TOTALDISCS.derive(tags))
 
 
+class YearTagTest(unittest.TestCase):
+
+    def test_none(self):
+        self.assertIs(None, tag.PARSED_YEAR.derive(tag.Tags({})))
+
+    def test_invalid(self):
+        self.assertIs(
+            None,
+            tag.PARSED_YEAR.derive(tag.Tags({'date': ('unknown', '12345')})))
+
+    def test_dates(self):
+        self.assertEqual(
+            ('2019', '1970'),
+            tag.PARSED_YEAR.derive(
+                tag.Tags({'date': ('2019-12-31', '1970', '2019')})),
+        )
+
+
 class TagsTest(unittest.TestCase):
 
     def test_init_converts_names_to_str(self):
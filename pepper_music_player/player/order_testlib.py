@@ -73,6 +73,7 @@ class TestCase(unittest.TestCase):
                     scan.AudioFile(filename=filename,
                                    dirname=dirname,
                                    basename=basename,
+                                   fingerprint=None,
                                    track=track))
         self.library_db.insert_files(files)
         return self.library_db.album(track.album_token)
@@ -96,6 +96,7 @@ class Playlist(Iterable[entity.PlaylistEntry]):
             library_db: database.Database,
             pubsub_bus: pubsub.PubSub,
             database_dir: str,
+            instrumentation: Optional[sqlite3_db.Instrumentation] = None,
             reverse_unordered_selects: bool = False,
     ) -> None:
         """Initializer.
@@ -104,11 +105,13 @@ class Playlist(Iterable[entity.PlaylistEntry]):
             library_db: Library database.
             pubsub_bus: PubSub bus.
             database_dir: Directory containing databases.
+            instrumentation: See sqlite3_db.Database.
             reverse_unordered_selects: For tests only, see sqlite3_db.Database.
         """
         self._db = sqlite3_db.Database(
             _SCHEMA,
             database_dir=database_dir,
+            instrumentation=instrumentation,
             reverse_unordered_selects=reverse_unordered_selects,
         )
         self._library_db = library_db
@@ -193,7 +196,9 @@ class Playlist(Iterable[entity.PlaylistEntry]):
                     FROM Entry
                     WHERE next_token IS ?
                 """
-            else:
+            elif entry_token is None:
+                # TODO(dseomn): Keep track of the first entry, so this doesn't
+                # need to scan every entry.
                 query = """
                     SELECT
                         Entry.token,
@@ -204,6 +209,16 @@ class Playlist(Iterable[entity.PlaylistEntry]):
                         ON PreviousEntry.next_token = Entry.token
                     WHERE PreviousEntry.token IS ?
                 """
+            else:
+                query = """
+                    SELECT
+                        Entry.token,
+                        Entry.library_token_type,
+                        Entry.library_token
+                    FROM Entry AS PreviousEntry
+                    JOIN Entry ON Entry.token = PreviousEntry.next_token
+                    WHERE PreviousEntry.token = ?
+                """
             row = snapshot_.execute(
                 query,
                 (None if entry_token is None else str(entry_token),),
@@ -13,6 +13,7 @@
 # limitations under the License.
 """Tests for pepper_music_player.player.playlist."""
 
+import os
 import tempfile
 import unittest
 from unittest import mock
@@ -24,6 +25,7 @@ from pepper_music_player.metadata import tag
 from pepper_music_player.metadata import token
 from pepper_music_player.player import playlist
 from pepper_music_player import pubsub
+from pepper_music_player import sqlite3_db_testlib
 
 
 def _insert_album(library_db, album_name):
@@ -63,6 +65,7 @@ def _insert_album(library_db, album_name):
             filename=track.tags.one(tag.FILENAME),
             dirname=track.tags.one(tag.DIRNAME),
             basename=track.tags.one(tag.BASENAME),
+            fingerprint=None,
             track=track,
         ),))
     return library_db.album(tracks[0].album_token)
@@ -200,5 +203,38 @@ class PlaylistReverseUnorderedSelectsTest(PlaylistTest):
     REVERSE_UNORDERED_SELECTS = True
 
 
+class PlaylistQueryPlanTest(sqlite3_db_testlib.TestCase):
+
+    def test_statements_use_indexes(self):
+        with sqlite3_db_testlib.record_statements() as statements:
+            tempdir = tempfile.TemporaryDirectory()
+            self.addCleanup(tempdir.cleanup)
+            library_db = database.Database(database_dir=tempdir.name)
+            album = _insert_album(library_db, 'album')
+            playlist_ = playlist.Playlist(
+                library_db=library_db,
+                pubsub_bus=pubsub.PubSub(),
+                database_dir=tempdir.name,
+            )
+            entry1 = playlist_.append(album.token)
+            entry2 = playlist_.append(album.mediums[0].tracks[0].token)
+            list(playlist_)
+            playlist_.previous_entry(None)
+            playlist_.previous_entry(entry2.token)
+            playlist_.playable_units(entry1)
+        # Statements on the library database are checked in database_test.
+        self.assert_query_plans_use_indexes(
+            [
+                statement for statement in statements
+                if os.path.basename(statement.filename).startswith('playlist.')
+            ],
+            allowed={
+                r'LEFT JOIN Entry AS PreviousEntry':
+                    'Finding the first entry scans for one without a '
+                    'previous entry.',
+            },
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,11 +15,22 @@
 
 import contextlib
 import dataclasses
+import enum
+import functools
+import json
+import logging
+import math
 import os
+import random
+import re
 import sqlite3
 import threading
+import time
 import typing
-from typing import Any, ContextManager, Generator, List, NewType, Optional, Sequence, Tuple, Type, TypeVar
+import weakref
+from typing import Any, Callable, ContextManager, Dict, Generator, List, Mapping, MutableSet, NewType, Optional, Sequence, Tuple, Type, TypeVar, Union
+
+_PARAMETER_LIST_REGEX = re.compile(r'\?(?:\s*,\s*\?)+')
 
 
 @dataclasses.dataclass(frozen=True)
@@ -32,6 +43,26 @@ class SchemaItem:
     create: str
 
 
+# Step of a migration: either a SQL statement, or a function that changes the
+# database with a transaction, e.g., to re-tokenize values in Python.
+MigrationStep = Union[str, Callable[['Transaction'], None]]
+
+
+@dataclasses.dataclass(frozen=True)
+class Migration:
+    """Steps to upgrade a database from one version of its schema to another.
+
+    Attributes:
+        from_version: Version to upgrade from.
+        to_version: Version to upgrade to.
+        steps: Steps to run in order, e.g., 'ALTER TABLE Foo ADD COLUMN bar',
+            'CREATE INDEX ...', or an UPDATE to backfill a derived column.
+    """
+    from_version: str
+    to_version: str
+    steps: Sequence[MigrationStep]
+
+
 @dataclasses.dataclass(frozen=True)
 class Schema:
     """An entire schema.
@@ -41,10 +72,459 @@ class Schema:
             library.
         version: Version of the schema, e.g., 'v1'.
         items: Things in the schema, e.g., tables and indexes.
+        migrations: Migrations from older versions. Chaining migrations from
+            an older version up to the current version must result in the same
+            schema as items.
     """
     name: str
     version: str
     items: Sequence[SchemaItem]
+    migrations: Sequence[Migration] = ()
+
+
+@dataclasses.dataclass(frozen=True)
+class MigrationProgress:
+    """Progress of migrating a database to the current version of its schema.
+
+    Attributes:
+        from_version: Version of the existing database.
+        to_version: Version that the database is being migrated to.
+        steps_done: Number of steps that have run so far. All steps run in a
+            single transaction, so none of them are committed until done.
+        steps_total: Number of steps in all migrations from from_version to
+            to_version.
+        done: Whether the migration is committed.
+    """
+    from_version: str
+    to_version: str
+    steps_done: int
+    steps_total: int
+    done: bool
+
+
+class Synchronous(enum.Enum):
+    """See https://www.sqlite.org/pragma.html#pragma_synchronous."""
+    OFF = 'OFF'
+    NORMAL = 'NORMAL'
+    FULL = 'FULL'
+    EXTRA = 'EXTRA'
+
+
+class TempStore(enum.Enum):
+    """See https://www.sqlite.org/pragma.html#pragma_temp_store."""
+    DEFAULT = 'DEFAULT'
+    FILE = 'FILE'
+    MEMORY = 'MEMORY'
+
+
+@dataclasses.dataclass(frozen=True)
+class Profile:
+    """Performance settings for connections to a database.
+
+    Each attribute can be None to leave the setting alone.
+
+    Attributes:
+        synchronous: How often to wait for data to reach the disk. Since
+            databases use WAL mode, NORMAL can lose the most recent
+            transactions on power loss, but does not corrupt the database.
+        cache_size: Max size of the page cache in KiB.
+        mmap_size: Max number of bytes of the database to memory-map.
+        temp_store: Where to store temporary tables and indexes, e.g., for
+            sorting.
+        busy_timeout_seconds: How long to wait for locks held by other
+            connections.
+        cached_statements: Number of prepared statements to cache per
+            connection. This is only set when a connection is opened, so it's
+            ignored for profiles that are used for a single transaction.
+    """
+    synchronous: Optional[Synchronous] = None
+    cache_size: Optional[int] = None
+    mmap_size: Optional[int] = None
+    temp_store: Optional[TempStore] = None
+    busy_timeout_seconds: Optional[float] = None
+    cached_statements: Optional[int] = None
+
+
+# Profile for responding quickly to users, without risking their changes.
+INTERACTIVE = Profile(
+    synchronous=Synchronous.FULL,
+    cache_size=16 * 1024,
+    mmap_size=256 * 1024 * 1024,
+    temp_store=TempStore.MEMORY,
+    busy_timeout_seconds=5.0,
+    cached_statements=256,
+)
+
+# Profile for writing lots of data that could be written again if it's lost,
+# e.g., the results of scanning the library.
+BULK_INGEST = Profile(
+    synchronous=Synchronous.NORMAL,
+    cache_size=64 * 1024,
+    mmap_size=256 * 1024 * 1024,
+    temp_store=TempStore.MEMORY,
+    busy_timeout_seconds=30.0,
+    cached_statements=256,
+)
+
+
+def _apply_profile(connection: sqlite3.Connection, profile: Profile) -> None:
+    """Applies a profile's settings to a connection, outside of transactions."""
+    if profile.synchronous is not None:
+        connection.execute(f'PRAGMA synchronous={profile.synchronous.value}')
+    if profile.cache_size is not None:
+        # Negative values are in KiB instead of pages.
+        connection.execute(f'PRAGMA cache_size={-int(profile.cache_size)}')
+    if profile.mmap_size is not None:
+        connection.execute(f'PRAGMA mmap_size={int(profile.mmap_size)}')
+    if profile.temp_store is not None:
+        connection.execute(f'PRAGMA temp_store={profile.temp_store.value}')
+    if profile.busy_timeout_seconds is not None:
+        connection.execute('PRAGMA busy_timeout='
+                           f'{int(profile.busy_timeout_seconds * 1000)}')
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    """Returns SQL with whitespace collapsed, for grouping similar statements.
+
+    Lists of parameters, e.g., from IN (?, ?, ?), are collapsed to a single ?,
+    so that statements built for different numbers of values are grouped
+    together.
+    """
+    return ' '.join(_PARAMETER_LIST_REGEX.sub('?', sql).split())
+
+
+@dataclasses.dataclass(frozen=True)
+class LatencyStats:
+    """Summary of how long something took, over multiple runs.
+
+    Attributes:
+        count: Number of runs.
+        total_seconds: Time of all runs combined.
+        max_seconds: Time of the slowest run.
+        p50_seconds: Median time.
+        p90_seconds: 90th percentile time.
+        p99_seconds: 99th percentile time.
+    """
+    count: int
+    total_seconds: float
+    max_seconds: float
+    p50_seconds: float
+    p90_seconds: float
+    p99_seconds: float
+
+
+@dataclasses.dataclass(frozen=True)
+class StatementStats:
+    """Statistics about runs of similar statements.
+
+    Attributes:
+        sql: Normalized SQL of the statements, see normalize_sql().
+        latency: Time spent in sqlite3 running the statements and fetching
+            their results. This does not include time that callers spent between
+            fetching rows.
+        rows: Number of rows returned by all runs combined.
+    """
+    sql: str
+    latency: LatencyStats
+    rows: int
+
+
+class _Latencies:
+    """Latencies of multiple runs, not thread-safe.
+
+    Percentiles are estimated from a uniform random sample of runs, to bound
+    memory use.
+    """
+
+    def __init__(self, max_samples: int, random_: random.Random) -> None:
+        self._max_samples = max_samples
+        self._random = random_
+        self._samples: List[float] = []
+        self._count = 0
+        self._total_seconds = 0.0
+        self._max_seconds = 0.0
+
+    def add(self, seconds: float) -> None:
+        """Records a run that took the given number of seconds."""
+        self._count += 1
+        self._total_seconds += seconds
+        self._max_seconds = max(self._max_seconds, seconds)
+        if len(self._samples) < self._max_samples:
+            self._samples.append(seconds)
+        else:
+            # https://en.wikipedia.org/wiki/Reservoir_sampling
+            index = self._random.randrange(self._count)
+            if index < self._max_samples:
+                self._samples[index] = seconds
+
+    def stats(self) -> LatencyStats:
+        """Returns statistics about all the runs so far."""
+        samples = sorted(self._samples)
+
+        def percentile(percent: float) -> float:
+            if not samples:
+                return 0.0
+            # https://en.wikipedia.org/wiki/Percentile#The_nearest-rank_method
+            rank = math.ceil(percent / 100 * len(samples))
+            return samples[max(rank, 1) - 1]
+
+        return LatencyStats(
+            count=self._count,
+            total_seconds=self._total_seconds,
+            max_seconds=self._max_seconds,
+            p50_seconds=percentile(50),
+            p90_seconds=percentile(90),
+            p99_seconds=percentile(99),
+        )
+
+
+class Instrumentation:
+    """Statistics about the statements and transactions of databases.
+
+    This is opt-in, since timing every statement has some overhead. It can be
+    shared between threads and between databases. Statements and transactions
+    that take longer than their thresholds are also logged, with normalized SQL
+    only, so that parameters (which could contain personal data) are not
+    logged.
+    """
+
+    def __init__(
+            self,
+            *,
+            slow_statement_seconds: Optional[float] = 0.1,
+            slow_transaction_seconds: Optional[float] = 1.0,
+            max_samples: int = 1000,
+    ) -> None:
+        """Initializer.
+
+        Args:
+            slow_statement_seconds: Threshold for logging a slow statement, or
+                None to not log statements.
+            slow_transaction_seconds: Threshold for logging a slow snapshot or
+                transaction, or None to not log them.
+            max_samples: Max number of runs per statement or type of
+                transaction to keep for estimating percentiles.
+        """
+        if max_samples < 1:
+            raise ValueError(f'max_samples must be positive: {max_samples}')
+        self._slow_statement_seconds = slow_statement_seconds
+        self._slow_transaction_seconds = slow_transaction_seconds
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._statement_latencies: Dict[str, _Latencies] = {}
+        self._statement_rows: Dict[str, int] = {}
+        self._transaction_latencies: Dict[str, _Latencies] = {}
+
+    def record_statement(self, sql: str, seconds: float, rows: int) -> None:
+        """Records a run of a statement, see StatementStats."""
+        sql = normalize_sql(sql)
+        with self._lock:
+            if sql not in self._statement_latencies:
+                self._statement_latencies[sql] = _Latencies(
+                    self._max_samples, self._random)
+                self._statement_rows[sql] = 0
+            self._statement_latencies[sql].add(seconds)
+            self._statement_rows[sql] += rows
+        if (self._slow_statement_seconds is not None and
+                seconds >= self._slow_statement_seconds):
+            logging.warning('Slow statement took %.3fs for %d rows: %s',
+                            seconds, rows, sql)
+
+    def record_transaction(self, kind: str, seconds: float) -> None:
+        """Records how long a snapshot or transaction was held."""
+        with self._lock:
+            if kind not in self._transaction_latencies:
+                self._transaction_latencies[kind] = _Latencies(
+                    self._max_samples, self._random)
+            self._transaction_latencies[kind].add(seconds)
+        if (self._slow_transaction_seconds is not None and
+                seconds >= self._slow_transaction_seconds):
+            logging.warning('Slow %s was held for %.3fs', kind, seconds)
+
+    def statements(self) -> Tuple[StatementStats, ...]:
+        """Returns stats for each normalized statement, slowest total first."""
+        with self._lock:
+            stats = [
+                StatementStats(
+                    sql=sql,
+                    latency=latencies.stats(),
+                    rows=self._statement_rows[sql],
+                ) for sql, latencies in self._statement_latencies.items()
+            ]
+        stats.sort(key=lambda item: item.latency.total_seconds, reverse=True)
+        return tuple(stats)
+
+    def transactions(self) -> Mapping[str, LatencyStats]:
+        """Returns hold times, keyed by 'snapshot' or 'transaction'."""
+        with self._lock:
+            return {
+                kind: latencies.stats()
+                for kind, latencies in self._transaction_latencies.items()
+            }
+
+    def to_json(self) -> str:
+        """Returns all stats as JSON, for offline analysis."""
+        statements = [dataclasses.asdict(stats) for stats in self.statements()]
+        return json.dumps(
+            {
+                'statements': statements,
+                'transactions': {
+                    kind: dataclasses.asdict(stats)
+                    for kind, stats in self.transactions().items()
+                },
+            },
+            indent=2,
+        )
+
+    def reset(self) -> None:
+        """Discards all stats recorded so far."""
+        with self._lock:
+            self._statement_latencies.clear()
+            self._statement_rows.clear()
+            self._transaction_latencies.clear()
+
+
+class _InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records its statements to Instrumentation.
+
+    A run of a statement is recorded when its results are exhausted, when the
+    cursor runs another statement or is garbage collected, or when the
+    transaction ends, whichever is first.
+    """
+
+    connection: '_InstrumentedConnection'
+
+    def __init__(self, connection: '_InstrumentedConnection') -> None:
+        super().__init__(connection)
+        self._sql: Optional[str] = None
+        self._seconds = 0.0
+        self._rows = 0
+
+    def __del__(self) -> None:
+        self.finish()
+
+    def _start(self, sql: str) -> None:
+        self.finish()
+        self._sql = sql
+        self._seconds = 0.0
+        self._rows = 0
+        self.connection.unfinished_cursors.add(self)
+
+    def finish(self) -> None:
+        """Records the current statement, if it wasn't already recorded."""
+        if self._sql is None:
+            return
+        self.connection.instrumentation.record_statement(
+            self._sql, self._seconds, self._rows)
+        self._sql = None
+        self.connection.unfinished_cursors.discard(self)
+
+    def execute(self, sql, parameters=()):
+        """Runs a statement, and records it once its results are read."""
+        self._start(sql)
+        start = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        except:
+            self._seconds += time.perf_counter() - start
+            self.finish()
+            raise
+        self._seconds += time.perf_counter() - start
+        if self.description is None:
+            self.finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        """Runs a statement for each set of parameters, and records it."""
+        self._start(sql)
+        start = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        finally:
+            self._seconds += time.perf_counter() - start
+            self.finish()
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._seconds += time.perf_counter() - start
+            self.finish()
+            raise
+        self._seconds += time.perf_counter() - start
+        self._rows += 1
+        return row
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._seconds += time.perf_counter() - start
+        if row is None:
+            self.finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._seconds += time.perf_counter() - start
+        self._rows += len(rows)
+        if len(rows) < size:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._seconds += time.perf_counter() - start
+        self._rows += len(rows)
+        self.finish()
+        return rows
+
+
+class _InstrumentedConnection(sqlite3.Connection):
+    """Connection that records its statements to Instrumentation.
+
+    Attributes:
+        instrumentation: Where to record statements.
+        unfinished_cursors: Cursors with statements that are not recorded
+            yet. This uses weak references, since cursors that are still
+            referenced keep their statements in progress, which prevents
+            committing.
+    """
+
+    instrumentation: Instrumentation
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.unfinished_cursors: MutableSet[_InstrumentedCursor] = (
+            weakref.WeakSet())
+
+    def execute(self, sql, parameters=()):
+        return self.cursor(_InstrumentedCursor).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor(_InstrumentedCursor).executemany(
+            sql, seq_of_parameters)
+
+    def finish_statements(self) -> None:
+        """Records all statements that weren't recorded yet."""
+        for cursor in tuple(self.unfinished_cursors):
+            cursor.finish()
+
+
+def _remove_database_files(filename: str) -> None:
+    """Removes a database and its journal files, if they exist."""
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(f'{filename}{suffix}'):
+            os.remove(f'{filename}{suffix}')
 
 
 # Any type of transaction that supports reading.
@@ -60,6 +540,46 @@ Transaction = NewType('Transaction', AbstractSnapshot)
 AnyTransaction = TypeVar('AnyTransaction', Snapshot, Transaction)
 
 
+def _copy_database(from_filename: str, connection: sqlite3.Connection) -> None:
+    """Copies a database into an open connection."""
+    source = sqlite3.connect(from_filename, isolation_level=None)
+    try:
+        source.backup(connection)
+    finally:
+        source.close()
+
+
+def _run_migration_steps(
+        connection: sqlite3.Connection,
+        migrations: Sequence[Migration],
+        step_callback: Callable[[int], None],
+) -> None:
+    """Runs all steps of migrations, within the connection's transaction.
+
+    Args:
+        connection: Connection to the database to migrate.
+        migrations: Migrations to run in order.
+        step_callback: Function to call with the number of steps done so far,
+            after each step.
+    """
+    steps_done = 0
+    for migration in migrations:
+        for step in migration.steps:
+            if isinstance(step, str):
+                connection.execute(step)
+            else:
+                step(Transaction(AbstractSnapshot(connection)))
+            steps_done += 1
+            step_callback(steps_done)
+
+
+def _check_foreign_keys(connection: sqlite3.Connection) -> None:
+    """Raises ValueError if a migration left any foreign keys violated."""
+    violations = connection.execute('PRAGMA foreign_key_check').fetchall()
+    if violations:
+        raise ValueError(f'Migration violates foreign keys: {violations!r}')
+
+
 class Database:
     """Wrapper around a sqlite3 database.
 
@@ -67,20 +587,33 @@ class Database:
     making transaction management explicit) and choose reasonable defaults.
     """
 
-    # TODO(dseomn): Add support for database schema version migration.
-
     def __init__(
             self,
             schema: Schema,
             *,
             database_dir: str,
+            profile: Profile = INTERACTIVE,
+            instrumentation: Optional[Instrumentation] = None,
+            migration_callback: Optional[Callable[[MigrationProgress],
+                                                  None]] = None,
             reverse_unordered_selects: bool = False,
     ) -> None:
         """Initializer.
 
+        If there's no database for the current version of the schema, but there
+        is one for an older version with migrations to the current version,
+        the older one is migrated and replaced. Otherwise, a new database is
+        created.
+
         Args:
             schema: Schema for the database.
             database_dir: Directory containing databases.
+            profile: Performance settings for connections, outside of
+                transactions with their own profile.
+            instrumentation: Where to record statistics about statements and
+                transactions, or None to not record them.
+            migration_callback: Function to call with progress of migrating
+                from an older version, or None.
             reverse_unordered_selects: See
                 https://www.sqlite.org/pragma.html#pragma_reverse_unordered_selects.
                 This is probably only useful for tests to make sure they're not
@@ -88,16 +621,114 @@ class Database:
         """
         # TODO(dseomn): Change database_dir to Optional[str], where None
         # indicates to use the default directory.
-        self._filename = os.path.join(
-            database_dir, f'{schema.name}.{schema.version}.sqlite3')
+        self._database_dir = database_dir
         self._schema = schema
+        self._filename = self._version_filename(schema.version)
+        self._profile = profile
+        self._instrumentation = instrumentation
         self._reverse_unordered_selects = reverse_unordered_selects
         self._local = threading.local()
 
         if not os.path.exists(self._filename):
-            with self.transaction() as transaction:
-                for item in self._schema.items:
-                    transaction.execute(item.create)
+            migrations = self._migrations_from_existing_version()
+            if migrations:
+                self._migrate(migrations, migration_callback)
+            else:
+                with self.transaction() as transaction:
+                    for item in self._schema.items:
+                        transaction.execute(item.create)
+
+    def _version_filename(self, version: str) -> str:
+        """Returns the filename of the database for a version of the schema."""
+        return os.path.join(self._database_dir,
+                            f'{self._schema.name}.{version}.sqlite3')
+
+    def _migrations_from_existing_version(self) -> Tuple[Migration, ...]:
+        """Returns migrations from the newest existing older version, if any."""
+        migrations_by_to_version = {}
+        for migration in self._schema.migrations:
+            if migration.to_version in migrations_by_to_version:
+                raise ValueError(
+                    f'Multiple migrations to {migration.to_version!r}.')
+            migrations_by_to_version[migration.to_version] = migration
+        migrations = []
+        version = self._schema.version
+        while version in migrations_by_to_version:
+            migration = migrations_by_to_version[version]
+            migrations.insert(0, migration)
+            if len(migrations) > len(self._schema.migrations):
+                raise ValueError(
+                    f'Migrations to {self._schema.version!r} have a cycle.')
+            version = migration.from_version
+            if os.path.exists(self._version_filename(version)):
+                return tuple(migrations)
+        return ()
+
+    def _migrate(
+            self,
+            migrations: Sequence[Migration],
+            callback: Optional[Callable[[MigrationProgress], None]],
+    ) -> None:
+        """Migrates an older database, and replaces it with the result.
+
+        The older database is copied, and the copy is migrated in a single
+        transaction. Then the copy is renamed to the current version's
+        filename, so that if anything fails, the older database is untouched
+        and the migration can run again next time.
+
+        Args:
+            migrations: Consecutive migrations from the older version to the
+                current version.
+            callback: See migration_callback in __init__.
+        """
+        from_filename = self._version_filename(migrations[0].from_version)
+        temp_filename = f'{self._filename}.migrating'
+        _remove_database_files(temp_filename)
+        steps_total = sum(len(migration.steps) for migration in migrations)
+
+        def report_progress(steps_done: int, done: bool) -> None:
+            if callback is not None:
+                callback(
+                    MigrationProgress(
+                        from_version=migrations[0].from_version,
+                        to_version=self._schema.version,
+                        steps_done=steps_done,
+                        steps_total=steps_total,
+                        done=done,
+                    ))
+
+        try:
+            connection = sqlite3.connect(temp_filename, isolation_level=None)
+            try:
+                _copy_database(from_filename, connection)
+                _apply_profile(connection, self._profile)
+                # Foreign keys are checked after all steps instead of during
+                # each one, see
+                # https://www.sqlite.org/lang_altertable.html#otheralter
+                connection.execute('PRAGMA foreign_keys=OFF')
+                connection.execute('BEGIN EXCLUSIVE TRANSACTION')
+                try:
+                    report_progress(0, done=False)
+                    _run_migration_steps(
+                        connection,
+                        migrations,
+                        lambda steps_done: report_progress(steps_done,
+                                                           done=False),
+                    )
+                    _check_foreign_keys(connection)
+                except:
+                    connection.rollback()
+                    raise
+                else:
+                    connection.commit()
+            finally:
+                connection.close()
+            os.replace(temp_filename, self._filename)
+        except:
+            _remove_database_files(temp_filename)
+            raise
+        _remove_database_files(from_filename)
+        report_progress(steps_total, done=True)
 
     @property
     def _connection(self) -> sqlite3.Connection:
@@ -105,13 +736,23 @@ class Database:
         # https://docs.python.org/3.8/library/sqlite3.html#multithreading says
         # that sqlite3 connections shouldn't be shared between threads.
         if not hasattr(self._local, 'connection'):
+            connect_kwargs = {}
+            if self._profile.cached_statements is not None:
+                connect_kwargs['cached_statements'] = (
+                    self._profile.cached_statements)
+            if self._instrumentation is not None:
+                connect_kwargs['factory'] = _InstrumentedConnection
             self._local.connection = sqlite3.connect(self._filename,
-                                                     isolation_level=None)
+                                                     isolation_level=None,
+                                                     **connect_kwargs)
+            if self._instrumentation is not None:
+                self._local.connection.instrumentation = self._instrumentation
             self._local.connection.execute('PRAGMA journal_mode=WAL')
             self._local.connection.execute('PRAGMA foreign_keys=ON')
             if self._reverse_unordered_selects:
                 self._local.connection.execute(
                     'PRAGMA reverse_unordered_selects=ON')
+            _apply_profile(self._local.connection, self._profile)
         return self._local.connection
 
     @contextlib.contextmanager
@@ -119,6 +760,7 @@ class Database:
             self,
             mode: str,
             transaction_type: Type[AnyTransaction],
+            profile: Optional[Profile] = None,
     ) -> Generator[AnyTransaction, None, None]:  # yapf: disable
         """Returns a context manager around a transaction.
 
@@ -134,17 +776,35 @@ class Database:
                 https://www.sqlite.org/lang_transaction.html
             transaction_type: Which type of transaction to return. (This should
                 match mode.)
+            profile: Profile to use for the duration of the transaction, or
+                None to use the database's profile.
         """
         # TODO(https://github.com/google/yapf/issues/793): Remove the yapf
         # disable comment above.
-        self._connection.execute(f'BEGIN {mode} TRANSACTION')
+        if profile is not None:
+            # Some settings can't be changed inside a transaction, so they're
+            # changed before it starts and restored after it ends.
+            _apply_profile(self._connection, profile)
+        start = time.perf_counter()
         try:
-            yield transaction_type(self._connection)
-        except:
-            self._connection.rollback()
-            raise
-        else:
-            self._connection.commit()
+            self._connection.execute(f'BEGIN {mode} TRANSACTION')
+            try:
+                yield transaction_type(self._connection)
+            except:
+                self._connection.rollback()
+                raise
+            else:
+                self._connection.commit()
+        finally:
+            if self._instrumentation is not None:
+                typing.cast(_InstrumentedConnection,
+                            self._connection).finish_statements()
+                self._instrumentation.record_transaction(
+                    transaction_type.__name__.lower(),
+                    time.perf_counter() - start,
+                )
+            if profile is not None:
+                _apply_profile(self._connection, self._profile)
 
     @typing.overload
     def snapshot(self, snapshot: None = None) -> ContextManager[Snapshot]:
@@ -180,15 +840,20 @@ class Database:
     def transaction(
             self,
             transaction: Optional[Transaction] = None,
+            *,
+            profile: Optional[Profile] = None,
     ) -> ContextManager[Transaction]:  # yapf: disable
         """Returns a context manager around a read-write transaction.
 
         Args:
             transaction: An existing transaction to reuse instead of starting
                 another one.
+            profile: Profile to use for the duration of the transaction, e.g.,
+                BULK_INGEST, or None to use the database's profile. This is
+                ignored when reusing a transaction.
         """
         if transaction is None:
-            return self._transaction('EXCLUSIVE', Transaction)
+            return self._transaction('EXCLUSIVE', Transaction, profile)
         else:
             return contextlib.nullcontext(transaction)
 
@@ -13,6 +13,8 @@
 # limitations under the License.
 """Tests for pepper_music_player.sqlite3_db."""
 
+import json
+import os
 import tempfile
 import unittest
 
@@ -109,6 +111,425 @@ class DatabaseTest(unittest.TestCase):
         self.assertSequenceEqual(normal_order, tuple(reversed(reverse_order)))
 
 
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self._database_dir = tempdir.name
+
+    def _settings(self, snapshot):
+        return tuple(
+            snapshot.execute(f'PRAGMA {pragma}').fetchone()[0]
+            for pragma in ('synchronous', 'cache_size', 'mmap_size',
+                           'temp_store', 'busy_timeout'))
+
+    def test_profile_applied_to_connections(self):
+        db = sqlite3_db.Database(
+            _SCHEMA,
+            database_dir=self._database_dir,
+            profile=sqlite3_db.Profile(
+                synchronous=sqlite3_db.Synchronous.OFF,
+                cache_size=1234,
+                mmap_size=0,
+                temp_store=sqlite3_db.TempStore.MEMORY,
+                busy_timeout_seconds=1.5,
+            ),
+        )
+        with db.snapshot() as snapshot:
+            self.assertEqual((0, -1234, 0, 2, 1500), self._settings(snapshot))
+
+    def test_empty_profile_leaves_defaults(self):
+        db = sqlite3_db.Database(_SCHEMA,
+                                 database_dir=self._database_dir,
+                                 profile=sqlite3_db.Profile())
+        with db.snapshot() as snapshot:
+            # The busy timeout is the default from sqlite3.connect().
+            self.assertEqual((2, -2000, 0, 0, 5000), self._settings(snapshot))
+
+    def test_transaction_profile(self):
+        db = sqlite3_db.Database(_SCHEMA, database_dir=self._database_dir)
+        with db.transaction(profile=sqlite3_db.BULK_INGEST) as transaction:
+            self.assertEqual(1, self._settings(transaction)[0])
+            self.assertEqual(-64 * 1024, self._settings(transaction)[1])
+            transaction.execute(
+                "INSERT INTO Test (foo, bar) VALUES ('foo1', 'bar1')")
+        with db.snapshot() as snapshot:
+            self.assertEqual(2, self._settings(snapshot)[0])
+            self.assertEqual(-16 * 1024, self._settings(snapshot)[1])
+            self.assertTrue(snapshot.execute('SELECT * FROM Test').fetchall())
+
+    def test_transaction_profile_restored_after_exception(self):
+        db = sqlite3_db.Database(_SCHEMA, database_dir=self._database_dir)
+        with self.assertRaisesRegex(ValueError, 'this should propagate'):
+            with db.transaction(profile=sqlite3_db.BULK_INGEST):
+                raise ValueError('this should propagate')
+        with db.snapshot() as snapshot:
+            self.assertEqual(2, self._settings(snapshot)[0])
+
+    def test_reused_transaction_ignores_profile(self):
+        db = sqlite3_db.Database(_SCHEMA, database_dir=self._database_dir)
+        with db.transaction() as transaction:
+            with db.transaction(transaction,
+                                profile=sqlite3_db.BULK_INGEST) as reused:
+                self.assertEqual(2, self._settings(reused)[0])
+
+
+class NormalizeSqlTest(unittest.TestCase):
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            'SELECT * FROM Test WHERE foo IN (?) AND bar = ?',
+            sqlite3_db.normalize_sql("""
+                SELECT * FROM Test
+                WHERE foo IN (?, ?,?) AND bar = ?
+            """),
+        )
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self._instrumentation = sqlite3_db.Instrumentation(
+            slow_statement_seconds=None,
+            slow_transaction_seconds=None,
+        )
+        self._db = sqlite3_db.Database(
+            _SCHEMA,
+            database_dir=tempdir.name,
+            instrumentation=self._instrumentation,
+        )
+        with self._db.transaction() as transaction:
+            transaction.executemany(
+                'INSERT INTO Test (foo, bar) VALUES (?, ?)',
+                (('foo1', 'bar1'), ('foo2', 'bar2'), ('foo3', 'bar3')),
+            )
+        self._instrumentation.reset()
+
+    def _statement(self, sql):
+        stats_by_sql = {
+            stats.sql: stats for stats in self._instrumentation.statements()
+        }
+        self.assertIn(sql, stats_by_sql)
+        return stats_by_sql[sql]
+
+    def test_counts_runs_and_rows(self):
+        with self._db.snapshot() as snapshot:
+            for foos in (('foo1',), ('foo2', 'foo3'), ('bar1',)):
+                snapshot.execute(
+                    'SELECT * FROM Test WHERE foo IN '
+                    f'({", ".join("?" for _ in foos)})',
+                    foos,
+                ).fetchall()
+        stats = self._statement('SELECT * FROM Test WHERE foo IN (?)')
+        self.assertEqual(3, stats.latency.count)
+        self.assertEqual(3, stats.rows)
+        self.assertGreater(stats.latency.total_seconds, 0)
+        self.assertGreaterEqual(stats.latency.max_seconds,
+                                stats.latency.p99_seconds)
+        self.assertGreaterEqual(stats.latency.p99_seconds,
+                                stats.latency.p50_seconds)
+
+    def test_records_each_way_of_fetching(self):
+        with self._db.snapshot() as snapshot:
+            self.assertEqual(3,
+                             len(tuple(snapshot.execute('SELECT * FROM Test'))))
+            self.assertEqual(
+                2, len(snapshot.execute('SELECT foo FROM Test').fetchmany(2)))
+            snapshot.execute('SELECT bar FROM Test').fetchone()
+            snapshot.execute("SELECT * FROM Test WHERE foo = 'x'").fetchone()
+        self.assertEqual(3, self._statement('SELECT * FROM Test').rows)
+        self.assertEqual(2, self._statement('SELECT foo FROM Test').rows)
+        self.assertEqual(1, self._statement('SELECT bar FROM Test').rows)
+        self.assertEqual(
+            0,
+            self._statement("SELECT * FROM Test WHERE foo = 'x'").rows,
+        )
+
+    def test_records_failed_statements(self):
+        with self.assertRaises(sqlite3_db.sqlite3.IntegrityError):
+            with self._db.transaction() as transaction:
+                transaction.execute(
+                    "INSERT INTO Test (foo, bar) VALUES ('foo1', 'bar1')")
+        self.assertEqual(
+            1,
+            self._statement(
+                "INSERT INTO Test (foo, bar) VALUES ('foo1', 'bar1')",
+            ).latency.count,
+        )
+
+    def test_transactions(self):
+        with self._db.snapshot():
+            pass
+        with self._db.snapshot():
+            pass
+        with self._db.transaction():
+            pass
+        transactions = self._instrumentation.transactions()
+        self.assertEqual({'snapshot', 'transaction'}, set(transactions))
+        self.assertEqual(2, transactions['snapshot'].count)
+        self.assertEqual(1, transactions['transaction'].count)
+
+    def test_percentiles(self):
+        instrumentation = sqlite3_db.Instrumentation(max_samples=1000)
+        for seconds in range(1, 101):
+            instrumentation.record_transaction('snapshot', seconds / 1000)
+        stats = instrumentation.transactions()['snapshot']
+        self.assertEqual(100, stats.count)
+        self.assertAlmostEqual(5.05, stats.total_seconds)
+        self.assertAlmostEqual(0.1, stats.max_seconds)
+        self.assertAlmostEqual(0.05, stats.p50_seconds)
+        self.assertAlmostEqual(0.09, stats.p90_seconds)
+        self.assertAlmostEqual(0.099, stats.p99_seconds)
+
+    def test_samples_are_bounded(self):
+        instrumentation = sqlite3_db.Instrumentation(max_samples=10)
+        for seconds in range(1000):
+            instrumentation.record_statement('SELECT 1', seconds, 1)
+        (stats,) = instrumentation.statements()
+        self.assertEqual(1000, stats.latency.count)
+        self.assertEqual(1000, stats.rows)
+        self.assertEqual(999, stats.latency.max_seconds)
+
+    def test_invalid_max_samples(self):
+        with self.assertRaisesRegex(ValueError, 'max_samples'):
+            sqlite3_db.Instrumentation(max_samples=0)
+
+    def test_slow_log(self):
+        instrumentation = sqlite3_db.Instrumentation(
+            slow_statement_seconds=1.0,
+            slow_transaction_seconds=2.0,
+        )
+        with self.assertLogs() as logs:
+            instrumentation.record_statement('SELECT 1', 0.5, 1)
+            instrumentation.record_statement('SELECT  2', 1.5, 3)
+            instrumentation.record_transaction('snapshot', 1.5)
+            instrumentation.record_transaction('transaction', 2.5)
+        self.assertEqual(
+            [
+                'Slow statement took 1.500s for 3 rows: SELECT 2',
+                'Slow transaction was held for 2.500s',
+            ],
+            [record.getMessage() for record in logs.records],
+        )
+
+    def test_to_json(self):
+        with self._db.snapshot() as snapshot:
+            snapshot.execute('SELECT * FROM Test').fetchall()
+        stats = json.loads(self._instrumentation.to_json())
+        (statement,) = (statement for statement in stats['statements']
+                        if statement['sql'] == 'SELECT * FROM Test')
+        self.assertEqual(3, statement['rows'])
+        self.assertEqual(1, statement['latency']['count'])
+        self.assertEqual(1, stats['transactions']['snapshot']['count'])
+
+    def test_reset(self):
+        with self._db.snapshot() as snapshot:
+            snapshot.execute('SELECT * FROM Test').fetchall()
+        self._instrumentation.reset()
+        self.assertEqual((), self._instrumentation.statements())
+        self.assertEqual({}, self._instrumentation.transactions())
+
+
+def _backfill_upper(transaction):
+    transaction.executemany(
+        'UPDATE Test SET upper = ? WHERE foo = ?',
+        tuple((foo.upper(), foo)
+              for foo, in transaction.execute('SELECT foo FROM Test')),
+    )
+
+
+_MIGRATION_V1_TO_V2 = sqlite3_db.Migration(
+    from_version='v1',
+    to_version='v2',
+    steps=(
+        'ALTER TABLE Test ADD COLUMN baz TEXT',
+        "UPDATE Test SET baz = bar || '!'",
+    ),
+)
+_MIGRATION_V2_TO_V3 = sqlite3_db.Migration(
+    from_version='v2',
+    to_version='v3',
+    steps=(
+        'ALTER TABLE Test ADD COLUMN upper TEXT',
+        _backfill_upper,
+        'CREATE INDEX Test_BazIndex ON Test (baz)',
+    ),
+)
+
+
+def _schema_version(version, migrations=()):
+    return sqlite3_db.Schema(
+        name=_SCHEMA.name,
+        version=version,
+        items=_SCHEMA.items,
+        migrations=migrations,
+    )
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self._database_dir = tempdir.name
+        with sqlite3_db.Database(
+                _schema_version('v1'),
+                database_dir=self._database_dir,
+        ).transaction() as transaction:
+            transaction.executemany(
+                'INSERT INTO Test (foo, bar) VALUES (?, ?)',
+                (('foo1', 'bar1'), ('foo2', 'bar2')),
+            )
+            transaction.execute(
+                "INSERT INTO DependsOnTest (foo) VALUES ('foo1')")
+
+    def _filenames(self):
+        return sorted(filename for filename in os.listdir(self._database_dir)
+                      if filename.endswith('.sqlite3'))
+
+    def test_migrates_through_versions(self):
+        progress = []
+        db = sqlite3_db.Database(
+            _schema_version('v3', (_MIGRATION_V2_TO_V3, _MIGRATION_V1_TO_V2)),
+            database_dir=self._database_dir,
+            migration_callback=progress.append,
+        )
+        with db.snapshot() as snapshot:
+            self.assertEqual(
+                [('foo1', 'bar1', 'bar1!', 'FOO1'),
+                 ('foo2', 'bar2', 'bar2!', 'FOO2')],
+                snapshot.execute("""
+                    SELECT foo, bar, baz, upper FROM Test ORDER BY foo
+                """).fetchall(),
+            )
+            self.assertEqual(
+                [('foo1',)],
+                snapshot.execute('SELECT foo FROM DependsOnTest').fetchall(),
+            )
+            self.assertIn(
+                ('Test_BazIndex',),
+                snapshot.execute("""
+                    SELECT name FROM sqlite_master WHERE type = 'index'
+                """).fetchall(),
+            )
+        self.assertEqual(['test.v3.sqlite3'], self._filenames())
+        self.assertEqual(
+            [(0, False), (1, False), (2, False), (3, False), (4, False),
+             (5, False), (5, True)],
+            [(item.steps_done, item.done) for item in progress],
+        )
+        self.assertEqual(
+            sqlite3_db.MigrationProgress(
+                from_version='v1',
+                to_version='v3',
+                steps_done=5,
+                steps_total=5,
+                done=True,
+            ),
+            progress[-1],
+        )
+
+    def test_migrates_from_newest_existing_version(self):
+        sqlite3_db.Database(
+            _schema_version('v2', (_MIGRATION_V1_TO_V2,)),
+            database_dir=self._database_dir,
+        )
+        with sqlite3_db.Database(
+                _schema_version('v1'),
+                database_dir=self._database_dir,
+        ).transaction() as transaction:
+            transaction.execute('DELETE FROM Test')
+        progress = []
+        db = sqlite3_db.Database(
+            _schema_version('v3', (_MIGRATION_V1_TO_V2, _MIGRATION_V2_TO_V3)),
+            database_dir=self._database_dir,
+            migration_callback=progress.append,
+        )
+        self.assertEqual('v2', progress[-1].from_version)
+        with db.snapshot() as snapshot:
+            self.assertEqual(
+                2,
+                snapshot.execute('SELECT COUNT(*) FROM Test').fetchone()[0],
+            )
+        self.assertEqual(['test.v1.sqlite3', 'test.v3.sqlite3'],
+                         self._filenames())
+
+    def test_creates_new_database_without_migrations(self):
+        db = sqlite3_db.Database(
+            _schema_version('v3', (_MIGRATION_V2_TO_V3,)),
+            database_dir=self._database_dir,
+        )
+        with db.snapshot() as snapshot:
+            self.assertFalse(snapshot.execute('SELECT * FROM Test').fetchall())
+        self.assertEqual(['test.v1.sqlite3', 'test.v3.sqlite3'],
+                         self._filenames())
+
+    def test_failed_migration_leaves_old_database(self):
+
+        def fail(transaction):
+            del transaction  # Unused.
+            raise ValueError('this should propagate')
+
+        with self.assertRaisesRegex(ValueError, 'this should propagate'):
+            sqlite3_db.Database(
+                _schema_version(
+                    'v2',
+                    (sqlite3_db.Migration(
+                        from_version='v1',
+                        to_version='v2',
+                        steps=('ALTER TABLE Test ADD COLUMN baz TEXT', fail),
+                    ),),
+                ),
+                database_dir=self._database_dir,
+            )
+        self.assertEqual(['test.v1.sqlite3'], self._filenames())
+        db = sqlite3_db.Database(
+            _schema_version('v2', (_MIGRATION_V1_TO_V2,)),
+            database_dir=self._database_dir,
+        )
+        with db.snapshot() as snapshot:
+            self.assertEqual(
+                2,
+                snapshot.execute('SELECT COUNT(baz) FROM Test').fetchone()[0],
+            )
+
+    def test_foreign_key_violation(self):
+        with self.assertRaisesRegex(ValueError, 'violates foreign keys'):
+            sqlite3_db.Database(
+                _schema_version(
+                    'v2',
+                    (sqlite3_db.Migration(
+                        from_version='v1',
+                        to_version='v2',
+                        steps=("DELETE FROM Test WHERE foo = 'foo1'",),
+                    ),),
+                ),
+                database_dir=self._database_dir,
+            )
+        self.assertEqual(['test.v1.sqlite3'], self._filenames())
+
+    def test_invalid_migrations(self):
+        for migrations, error_regex in (
+            ((_MIGRATION_V1_TO_V2, _MIGRATION_V1_TO_V2), 'Multiple migrations'),
+            ((
+                sqlite3_db.Migration('v3', 'v2', steps=()),
+                sqlite3_db.Migration('v2', 'v3', steps=()),
+            ), 'cycle'),
+        ):
+            with self.subTest(error_regex):
+                with self.assertRaisesRegex(ValueError, error_regex):
+                    sqlite3_db.Database(
+                        _schema_version('v3', migrations),
+                        database_dir=self._database_dir,
+                    )
+
+
 class QueryBuilderTest(unittest.TestCase):
 
     def test_builder(self):
@@ -0,0 +1,252 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test utilities for checking the SQL that code runs with sqlite3_db."""
+
+import contextlib
+import dataclasses
+import re
+import sqlite3
+import threading
+import time
+from typing import Generator, List, Mapping, Optional, Sequence, Tuple
+import unittest
+from unittest import mock
+
+from pepper_music_player import sqlite3_db
+
+_STRING_REGEX = re.compile(r"'(?:[^']|'')*'")
+
+# Table names like 'main'.'TagSearch_data' in statements that SQLite runs
+# internally.
+_INTERNAL_TABLE_REGEX = re.compile(r"'\w+'\.'\w+'")
+
+# Literal values in SQL with parameters expanded, see _normalize().
+_LITERAL_REGEX = re.compile(
+    r"""
+    '(?:[^']|'')*'
+    | \b[xX]'[0-9a-fA-F]*'
+    | (?<![\w.])-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b
+    | \bNULL\b
+    """,
+    re.VERBOSE,
+)
+
+# References to the row of a trigger, which only make sense inside it.
+_TRIGGER_ROW_REGEX = re.compile(r'\b(?:NEW|OLD)\.\w+', re.IGNORECASE)
+
+_PLANNED_STATEMENT_REGEX = re.compile(
+    r'\A\s*(?:SELECT|WITH|INSERT|REPLACE|UPDATE|DELETE)\b',
+    re.IGNORECASE,
+)
+
+# Steps of a query plan that aren't a table, e.g., 'SCAN CONSTANT ROW'.
+_NON_TABLE_SCANS = frozenset(('CONSTANT ROW',))
+
+
+@dataclasses.dataclass(frozen=True)
+class Statement:
+    """Statement that sqlite3 ran.
+
+    Attributes:
+        filename: Database file that the statement ran on.
+        sql: SQL of the statement. Parameters are expanded into literals, and
+            references to the row of a trigger are replaced with NULL.
+        trigger: Name of the trigger that ran the statement, or None if it
+            wasn't run by a trigger.
+    """
+    filename: str
+    sql: str
+    trigger: Optional[str] = None
+
+    @property
+    def normalized_sql(self) -> str:
+        """SQL with literals replaced by ?, for grouping similar statements."""
+        return _normalize(self.sql)
+
+
+def _normalize(sql: str) -> str:
+    """Returns SQL with whitespace collapsed and literals replaced by ?.
+
+    Lists of literals, e.g., from IN (?, ?, ?), are collapsed to a single ?.
+    """
+    return sqlite3_db.normalize_sql(_LITERAL_REGEX.sub('?', sql))
+
+
+@contextlib.contextmanager
+def record_statements() -> Generator[List[Statement], None, None]:
+    """Records statements run on any connections opened in the context.
+
+    Connections are opened lazily by sqlite3_db.Database, so the Database
+    should be created inside the context.
+
+    Yields:
+        List that statements are appended to as they run.
+    """
+    statements: List[Statement] = []
+    lock = threading.Lock()
+    real_connect = sqlite3.connect
+
+    def connect(filename, *args, **kwargs):
+        connection = real_connect(filename, *args, **kwargs)
+        trigger = None
+
+        def trace(sql: str) -> None:
+            nonlocal trigger
+            if not sql.startswith('-- '):
+                trigger = None
+                statement = Statement(filename=filename, sql=sql)
+            elif sql.startswith('-- TRIGGER '):
+                trigger = sql[len('-- TRIGGER '):].strip()
+                return
+            else:
+                statement = Statement(
+                    filename=filename,
+                    sql=_TRIGGER_ROW_REGEX.sub('NULL', sql[len('-- '):]),
+                    trigger=trigger,
+                )
+            with lock:
+                statements.append(statement)
+
+        connection.set_trace_callback(trace)
+        return connection
+
+    with mock.patch.object(sqlite3_db.sqlite3, 'connect', connect):
+        yield statements
+
+
+def distinct_statements(
+        statements: Sequence[Statement]) -> Tuple[Statement, ...]:
+    """Returns the first statement with each normalized_sql, in order.
+
+    Statements without query plans, e.g., BEGIN, are skipped. So are statements
+    that SQLite runs internally, e.g., for FTS5 to maintain its own tables,
+    which have unexpanded parameters or quoted schema names.
+    """
+    distinct = {}
+    for statement in statements:
+        if (_PLANNED_STATEMENT_REGEX.match(statement.sql) is None or
+                '?' in _STRING_REGEX.sub('', statement.sql) or
+                _INTERNAL_TABLE_REGEX.search(statement.sql) is not None):
+            continue
+        distinct.setdefault(
+            (statement.filename, statement.normalized_sql),
+            statement,
+        )
+    return tuple(distinct.values())
+
+
+def query_plan(statement: Statement) -> Tuple[str, ...]:
+    """Returns the steps of EXPLAIN QUERY PLAN for a statement."""
+    connection = sqlite3.connect(statement.filename, isolation_level=None)
+    try:
+        return tuple(detail for _, _, _, detail in connection.execute(
+            f'EXPLAIN QUERY PLAN {statement.sql}'))
+    finally:
+        connection.close()
+
+
+def plan_problems(plan: Sequence[str]) -> Tuple[str, ...]:
+    """Returns steps of a query plan that don't scale with the data.
+
+    Problems are full scans of tables or indexes, and temporary B-trees for
+    sorting or grouping. Scans of virtual tables, e.g., full text indexes, and
+    of subqueries or common table expressions are not problems on their own,
+    since the statements inside them have their own steps.
+    """
+    subqueries = set()
+    for step in plan:
+        match = re.match(r'(?:MATERIALIZE|CO-ROUTINE) (\S+)', step)
+        if match is not None:
+            subqueries.add(match.group(1))
+    problems = []
+    for step in plan:
+        if step.startswith('USE TEMP B-TREE'):
+            problems.append(step)
+            continue
+        match = re.match(r'SCAN (\S+(?: \S+)?)', step)
+        if (match is None or 'VIRTUAL TABLE' in step or
+                match.group(1) in _NON_TABLE_SCANS or
+                match.group(1).split()[0] in subqueries or
+                match.group(1).startswith('(')):
+            continue
+        problems.append(step)
+    return tuple(problems)
+
+
+def statement_latencies(
+        statements: Sequence[Statement],
+        *,
+        repeat: int = 10,
+) -> Tuple[Tuple[Statement, float], ...]:
+    """Returns the mean latency of each read-only statement, slowest first.
+
+    Statements are re-run on a fresh connection, so this only includes
+    statements that don't modify the database.
+    """
+    latencies = []
+    for statement in distinct_statements(statements):
+        if statement.trigger is not None:
+            continue
+        connection = sqlite3.connect(statement.filename, isolation_level=None)
+        try:
+            opcodes = {
+                opcode for _, opcode, *_ in connection.execute(
+                    f'EXPLAIN {statement.sql}')
+            }
+            if opcodes & {'OpenWrite', 'VUpdate'}:
+                continue
+            start = time.perf_counter()
+            for _ in range(repeat):
+                connection.execute(statement.sql).fetchall()
+            latencies.append(
+                (statement, (time.perf_counter() - start) / repeat))
+        finally:
+            connection.close()
+    latencies.sort(key=lambda item: item[1], reverse=True)
+    return tuple(latencies)
+
+
+class TestCase(unittest.TestCase):
+    """Test case with assertions about query plans."""
+
+    def assert_query_plans_use_indexes(
+            self,
+            statements: Sequence[Statement],
+            *,
+            allowed: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        """Asserts that statements don't scan tables or sort in temp B-trees.
+
+        Args:
+            statements: Statements to check, typically from
+                record_statements().
+            allowed: Map from regex to the reason why statements with
+                normalized SQL that matches the regex can have problems, e.g.,
+                because they always read every row of a small table.
+        """
+        allowed = allowed or {}
+        failures = []
+        for statement in distinct_statements(statements):
+            if any(
+                    re.search(pattern, statement.normalized_sql)
+                    for pattern in allowed):
+                continue
+            problems = plan_problems(query_plan(statement))
+            if problems:
+                failures.append(f'{statement.normalized_sql}\n'
+                                f'  trigger: {statement.trigger}\n'
+                                f'  problems: {problems}')
+        if failures:
+            self.fail('Query plans with full scans or temp B-trees:\n' +
+                      '\n'.join(failures))
@@ -13,8 +13,9 @@
 # limitations under the License.
 """Cards for things in the library, and lists of those cards."""
 
+import collections
 from importlib import resources
-from typing import Collection, Generic, Iterable, Mapping, Optional, Type, TypeVar
+from typing import Collection, Dict, Generic, Iterable, Mapping, Optional, Type, TypeVar, Union
 
 import frozendict
 import gi
@@ -183,6 +184,14 @@ class List(Generic[ListItemType]):
         )
         self.widget: Gtk.ListBox = builder.get_object('list')
         self.store = Gio.ListStore.new(list_item_type.__gtype__)
+        # Entities loaded in bulk for items that were just added to the store,
+        # but don't have cards yet.
+        self._prefetched: Dict[token.LibraryToken,
+                               Union[entity.Track, entity.Medium,
+                                     entity.Album]] = {}
+        # This must be connected before bind_model(), so that it runs before
+        # the cards are created.
+        self.store.connect('items-changed', self._prefetch)
         self.widget.bind_model(self.store, self._card)
         self._track_builder_template = gtk_builder_template.Template(
             resources.read_text('pepper_music_player.ui',
@@ -297,17 +306,51 @@ class List(Generic[ListItemType]):
         for medium in album.mediums:
             yield from self._medium(list_item, medium, albumartist=artist)
 
+    def _prefetch(
+            self,
+            store: Gio.ListStore,
+            position: int,
+            removed: int,
+            added: int,
+    ) -> None:
+        """Handler for items-changed, that loads added items' entities in bulk.
+
+        Without this, each card would load its entity individually.
+        """
+        del removed  # Unused.
+        tokens_by_type = collections.defaultdict(list)
+        for index in range(position, position + added):
+            library_token = store.get_item(index).library_token
+            tokens_by_type[type(library_token)].append(library_token)
+        for token_type, lookup in (
+            (token.Track, self.library_db.tracks),
+            (token.Medium, self.library_db.mediums),
+            (token.Album, self.library_db.albums),
+        ):
+            if not tokens_by_type[token_type]:
+                continue
+            try:
+                self._prefetched.update(lookup(tokens_by_type[token_type]))
+            except KeyError:
+                # _card() will look up each entity individually, and raise the
+                # error for the missing ones.
+                pass
+
     def _card(self, item: ListItemType) -> Gtk.ListBoxRow:
         """Returns a card outer row for the given list item."""
+        library_entity = self._prefetched.pop(item.library_token, None)
         if isinstance(item.library_token, token.Track):
-            inner_rows = self._track(item,
-                                     self.library_db.track(item.library_token))
+            inner_rows = self._track(
+                item, library_entity or
+                self.library_db.track(item.library_token))
         elif isinstance(item.library_token, token.Medium):
             inner_rows = self._medium(
-                item, self.library_db.medium(item.library_token))
+                item, library_entity or
+                self.library_db.medium(item.library_token))
         elif isinstance(item.library_token, token.Album):
-            inner_rows = self._album(item,
-                                     self.library_db.album(item.library_token))
+            inner_rows = self._album(
+                item, library_entity or
+                self.library_db.album(item.library_token))
         else:
             raise ValueError(
                 f'Unknown library token type: {item.library_token}')
@@ -143,6 +143,7 @@ class LibraryCardTest(screenshot_testlib.TestCase):
             filename=filename,
             dirname=dirname,
             basename=basename,
+            fingerprint=None,
             track=track,
         ),))
         return track
@@ -196,6 +197,28 @@ class LibraryCardTest(screenshot_testlib.TestCase):
                 )
         return track.album_token
 
+    def test_loads_added_items_in_bulk(self):
+        track_token = self._insert_track(album='Foo').token
+        medium_token = self._insert_medium(album='Bar')
+        album_token = self._insert_album(album='Baz')
+        lookups = {
+            name: mock.patch.object(
+                self._library_db,
+                name,
+                wraps=getattr(self._library_db, name),
+            ).start() for name in ('tracks', 'mediums', 'albums', 'track',
+                                   'medium', 'album')
+        }
+        self.addCleanup(mock.patch.stopall)
+        self._set_tokens(track_token, medium_token, album_token)
+        self.assertEqual(3, len(self._library_card_list.widget.get_children()))
+        lookups['tracks'].assert_called_once_with([track_token])
+        lookups['mediums'].assert_called_once_with([medium_token])
+        lookups['albums'].assert_called_once_with([album_token])
+        lookups['track'].assert_not_called()
+        lookups['medium'].assert_not_called()
+        lookups['album'].assert_not_called()
+
     def test_track_ltr(self):
         self._set_tokens(
             self._insert_track(title='Cool Song', artist='Pop Star').token)
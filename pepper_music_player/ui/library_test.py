@@ -62,6 +62,7 @@ class LibraryTest(screenshot_testlib.TestCase):
             filename='/a/b',
             dirname='/a',
             basename='b',
+            fingerprint=None,
             track=track,
         ),))
         self._library.store.append(library_card.ListItem(track.token))
@@ -78,6 +78,7 @@ class PlaylistViewTest(screenshot_testlib.TestCase):
                     filename=filename,
                     dirname=directory,
                     basename=basename,
+                    fingerprint=None,
                     track=track,
                 ),))
         entry = self._playlist.append(track.album_token)